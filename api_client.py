@@ -0,0 +1,355 @@
+# api_client.py
+# app_streamlit.py から使うQA APIのクライアント
+#   - 接続を使い回すrequests.Session（keep-alive・再試行付き）
+#   - 読み込みはst.cache_dataでTTLの間キャッシュし、ウィジェット操作による再実行では再取得しない
+#   - TTL切れ後の再取得はETag（If-None-Match）で行い、変更がなければ304で本文を受け取らない
+#   - 削除・生成・提出の後は関係するキャッシュを明示的に破棄する
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# CDKデプロイ後に、Outputsから正しいAPI URLを取得して設定してください（環境変数でも指定可）
+API_URL = os.environ.get(
+    "QA_API_URL", "https://vedtxkcx72.execute-api.us-east-1.amazonaws.com/prod/"
+)
+TIMEOUT = (5, 60)  # (接続, 読み込み) 秒
+LIST_TTL = 60
+PAGE_SIZE = 20
+# この大きさ以上のファイルはマルチパートで並列にアップロードする
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4  # 1ファイルあたりの並列パート数
+UPLOAD_FILE_CONCURRENCY = 3  # 並列に送るファイル数
+PART_MAX_ATTEMPTS = 4
+DETAIL_TTL = 300
+
+
+def _url(path):
+    return f"{API_URL.rstrip('/')}/{path.lstrip('/')}"
+
+
+@st.cache_resource
+def get_session():
+    """Streamlitのプロセス内で1つだけ作り、TLS接続を再利用する"""
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        # 提出などのPOSTは二重に処理されるおそれがあるため再試行しない
+        allowed_methods=frozenset({"GET", "HEAD", "DELETE"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Acceptをapplication/jsonにすると、APIがgzip圧縮した本文を返せる
+    session.headers.update(
+        {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+    )
+    return session
+
+
+@st.cache_resource
+def _etag_store():
+    """URLとクエリごとに、最後に受け取ったETagと本文を保持する"""
+    return {"lock": threading.Lock(), "entries": {}}
+
+
+def _get_json(path, params=None):
+    """条件付きGET。304が返れば前回の本文をそのまま返す"""
+    store = _etag_store()
+    key = (path, tuple(sorted((params or {}).items())))
+    with store["lock"]:
+        cached = store["entries"].get(key)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+
+    response = get_session().get(
+        _url(path), params=params, headers=headers, timeout=TIMEOUT
+    )
+    if response.status_code == 304 and cached:
+        return cached[1]
+    response.raise_for_status()
+    body = response.json()
+    etag = response.headers.get("ETag")
+    if etag:
+        with store["lock"]:
+            store["entries"][key] = (etag, body)
+    return body
+
+
+def _forget(prefix):
+    store = _etag_store()
+    with store["lock"]:
+        for key in [k for k in store["entries"] if k[0].startswith(prefix)]:
+            del store["entries"][key]
+
+
+@st.cache_data(ttl=LIST_TTL, show_spinner=False)
+def list_qas_page(
+    theme=None, lecture_number=None, next_token=None, limit=PAGE_SIZE, view="summary"
+):
+    """GET /qas を1ページだけ読む。{"items": [...], "next_token": 次ページのカーソル}"""
+    params = {"view": view, "limit": limit}
+    if theme:
+        params["theme"] = theme
+    if lecture_number:
+        params["lecture_number"] = lecture_number
+    if next_token:
+        params["next_token"] = next_token
+    return _get_json("qas", params)
+
+
+@st.cache_data(ttl=DETAIL_TTL, show_spinner=False)
+def get_qa(qa_set_id):
+    """GET /qas/{id} で問題本体を含むQAセットを取得する"""
+    return _get_json(f"qas/{qa_set_id}")
+
+
+def invalidate_qas():
+    """一覧と詳細のキャッシュを破棄する（ETagも忘れて、次回は必ず本文を取得する）"""
+    list_qas_page.clear()
+    get_qa.clear()
+    _forget("qas")
+
+
+def delete_qa(qa_set_id):
+    response = get_session().delete(_url(f"qas/{qa_set_id}"), timeout=TIMEOUT)
+    if response.status_code == 204:
+        invalidate_qas()
+    return response
+
+
+def _post_upload_api(payload):
+    response = get_session().post(_url("get-upload-url"), json=payload, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def _file_size(fileobj):
+    position = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size
+
+
+def upload_pdfs(payload, files, on_progress=None):
+    """複数のPDFをまとめてS3にアップロードする。
+
+    files は {"fileobj": ファイル, "file_name": 名前, "lecture_number": 講義回数} のリスト、
+    payload はテーマなど全ファイル共通の生成条件。アップロード先は1回の一括リクエストで
+    発行し、ファイルは最大UPLOAD_FILE_CONCURRENCY件ずつ並列に送る。小さいファイルは
+    事前署名付きPOSTで1回で送り、大きいファイルはマルチパートでパートごとに並列に送る。
+    on_progress(ファイルの番号, 送信済みバイト数, 全体のバイト数) で進捗を通知する。
+    戻り値はファイルごとの {"job_id": 処理状況のID, "error": エラー（成功したらNone）} のリスト"""
+    sizes = [_file_size(f["fileobj"]) for f in files]
+    batch = _post_upload_api(
+        {
+            **payload,
+            "action": "batch",
+            "files": [
+                {
+                    "file_name": f["file_name"],
+                    "lecture_number": f["lecture_number"],
+                    **(
+                        {"upload_type": "multipart", "file_size": size}
+                        if size >= MULTIPART_THRESHOLD
+                        else {}
+                    ),
+                }
+                for f, size in zip(files, sizes)
+            ],
+        }
+    )
+
+    # Streamlitの要素はスクリプトのスレッドからしか更新できないため、
+    # 送信スレッドからは進捗をキューに積み、ここで取り出して通知する
+    events = queue.Queue()
+
+    def send(index):
+        upload, fileobj, size = (
+            batch["uploads"][index],
+            files[index]["fileobj"],
+            sizes[index],
+        )
+
+        def report(sent):
+            events.put((index, sent, size))
+
+        if upload.get("upload_type") == "multipart":
+            _send_multipart(upload, fileobj, size, report)
+        else:
+            _send_post(upload, fileobj, size, report)
+
+    results = [
+        {"job_id": upload.get("job_id"), "error": None} for upload in batch["uploads"]
+    ]
+    with ThreadPoolExecutor(max_workers=UPLOAD_FILE_CONCURRENCY) as executor:
+        futures = {executor.submit(send, i): i for i in range(len(files))}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    results[futures[future]]["error"] = str(future.exception())
+            while not events.empty():
+                if on_progress:
+                    on_progress(*events.get())
+                else:
+                    events.get()
+
+    # 生成後のQAが一覧に出るようキャッシュを破棄する
+    invalidate_qas()
+    return results
+
+
+def get_job(job_id, wait_seconds=0, etag=None):
+    """GET /jobs/{id}。wait_secondsを指定すると、etagの状態から変わるまでサーバー側で待つ。
+    変化が無ければNone、あれば (ジョブ, ETag) を返す"""
+    headers = {"If-None-Match": etag} if etag else {}
+    response = get_session().get(
+        _url(f"jobs/{job_id}"),
+        params={"wait": wait_seconds},
+        headers=headers,
+        timeout=(5, wait_seconds + 15),
+    )
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return response.json(), response.headers.get("ETag")
+
+
+POLL_CONCURRENCY = 8  # 同時に待つロングポーリングの数
+
+
+@st.cache_resource
+def _poll_state():
+    """ロングポーリングのスレッドプールと、実行中のポーリング {(ジョブID, ETag): Future}。
+    先に返した後も裏で続くポーリングは次の呼び出しで結果を引き継ぎ、同じジョブを重ねて待たない"""
+    return {
+        "lock": threading.Lock(),
+        "executor": ThreadPoolExecutor(max_workers=POLL_CONCURRENCY),
+        "inflight": {},
+        "last_polled": {},
+    }
+
+
+def poll_jobs(etags, wait_seconds=20):
+    """複数のジョブをロングポーリングし、いずれかの状態が変わった時点で
+    {ジョブID: (ジョブ, ETag)} を返す。待ち時間内にどれも変わらなければ空の辞書。
+    同時に待つのはPOLL_CONCURRENCY件までで、残りは前回待った時刻が古いものから順に待つ"""
+    state = _poll_state()
+    with state["lock"]:
+        inflight = state["inflight"]
+        # 表示しなくなったジョブや、状態が変わって古くなったETagのポーリングは取り消す
+        # （実行中のものは取り消せないが、結果は使わず、同じジョブを新たには待たない）
+        for poll_key in [k for k in inflight if etags.get(k[0]) != k[1]]:
+            inflight.pop(poll_key).cancel()
+        running = {key[0] for key in inflight}
+        waiting = sorted(
+            (job_id for job_id in etags if job_id not in running),
+            key=lambda job_id: state["last_polled"].get(job_id, 0),
+        )
+        for job_id in waiting[: max(0, POLL_CONCURRENCY - len(inflight))]:
+            state["last_polled"][job_id] = time.monotonic()
+            inflight[(job_id, etags[job_id])] = state["executor"].submit(
+                get_job, job_id, wait_seconds, etags[job_id]
+            )
+        futures = {future: key for key, future in inflight.items() if key[0] in etags}
+
+    changed = {}
+    pending = set(futures)
+    while pending and not changed:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        with state["lock"]:
+            for future in done:
+                state["inflight"].pop(futures[future], None)
+        for future in done:
+            result = future.result()
+            if result is not None:
+                changed[futures[future][0]] = result
+    return changed
+
+
+def _send_post(upload, fileobj, size, report):
+    fileobj.seek(0)
+    response = get_session().post(
+        upload["url"],
+        data=upload["fields"],
+        files={"file": fileobj},
+        timeout=(5, 300),
+    )
+    response.raise_for_status()
+    report(size)
+
+
+def _send_multipart(upload, fileobj, size, report):
+    target = {"key": upload["key"], "upload_id": upload["upload_id"]}
+    part_size = upload["part_size"]
+    lock = threading.Lock()
+
+    def read_part(part_number):
+        # 1つのファイルを共有するので、読み込みだけは排他にする。
+        # メモリ上に持つのは同時に送信中のパートの分だけになる
+        with lock:
+            fileobj.seek((part_number - 1) * part_size)
+            return fileobj.read(part_size)
+
+    def send_part(part):
+        data = read_part(part["part_number"])
+        for attempt in range(PART_MAX_ATTEMPTS):
+            try:
+                response = get_session().put(part["url"], data=data, timeout=(5, 120))
+                response.raise_for_status()
+                break
+            except requests.RequestException:
+                if attempt == PART_MAX_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, 2**attempt))
+        return len(data), {
+            "part_number": part["part_number"],
+            "etag": response.headers["ETag"],
+        }
+
+    try:
+        parts = []
+        sent = 0
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            futures = [executor.submit(send_part, part) for part in upload["parts"]]
+            try:
+                for future in as_completed(futures):
+                    length, part = future.result()
+                    parts.append(part)
+                    sent += length
+                    report(sent)
+            except Exception:
+                # 未着手のパートは送らずに打ち切る
+                for future in futures:
+                    future.cancel()
+                raise
+        _post_upload_api({"action": "complete", **target, "parts": parts})
+    except Exception:
+        # 途中まで送ったパートが残らないよう中止する（失敗しても元のエラーを優先する）
+        try:
+            _post_upload_api({"action": "abort", **target})
+        except requests.RequestException as e:
+            print(f"Failed to abort multipart upload: {e}")
+        raise
+
+
+def submit_answers(qa_set_id, answers):
+    """POST /qas/{id}/submit で採点する"""
+    response = get_session().post(
+        _url(f"qas/{qa_set_id}/submit"), json={"answers": answers}, timeout=TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
@@ -1,19 +1,28 @@
 import streamlit as st
-import requests
 import json
 import pandas as pd
 import base64
 
+import api_client
+
 # --- ページ設定とAPI URL ---
 st.set_page_config(
     page_title="QA作成ツール | AI自動問答生成", page_icon="💡", layout="wide"
 )
 
-# CDKデプロイ後に、Outputsから正しいAPI URLを取得して設定してください
-API_URL = "https://vedtxkcx72.execute-api.us-east-1.amazonaws.com/prod/" 
+# API URLとHTTP接続・キャッシュの設定は api_client.py にまとめている
+
+
+@st.cache_data(ttl=api_client.DETAIL_TTL, show_spinner=False)
+def question_frame(qa_set_id):
+    """問題一覧のDataFrameを作る。同じセットを再表示する時は作り直さない"""
+    qa_data = api_client.get_qa(qa_set_id).get("qa_data", {}).get("qa_set", [])
+    return pd.DataFrame(qa_data)
+
 
 # --- デザイン用カスタムCSS ---
-st.markdown("""
+st.markdown(
+    """
 <style>
     [data-testid="stAppViewContainer"] { background: linear-gradient(180deg, #001f3f, #000020); }
     [data-testid="stSidebar"] { background: rgba(38, 39, 48, 0.4); backdrop-filter: blur(10px); }
@@ -22,7 +31,9 @@ st.markdown("""
     .stButton > button:hover { opacity: 0.9; box-shadow: 0 0 15px #00c6ff; }
     h1, h2, h3 { color: #87CEFA; }
 </style>
-""", unsafe_allow_html=True)
+""",
+    unsafe_allow_html=True,
+)
 
 # --- session_stateの初期化 ---
 if "page" not in st.session_state:
@@ -31,6 +42,21 @@ if "selected_qa_set" not in st.session_state:
     st.session_state.selected_qa_set = None
 if "quiz_results" not in st.session_state:
     st.session_state.quiz_results = None
+if "qa_list" not in st.session_state:
+    st.session_state.qa_list = None
+if "jobs" not in st.session_state:
+    # アップロードしたPDFの処理状況 {ジョブID: {"file_name", "job", "etag"}}
+    st.session_state.jobs = {}
+
+JOB_STATE_LABELS = {
+    "waiting_for_upload": "⏳ アップロード待ち",
+    "uploaded": "📥 受付済み",
+    "ocr_running": "🔍 文字抽出中",
+    "generating": "🤖 QA生成中",
+    "deferred": "⏸️ 生成待ち（混雑中）",
+    "completed": "✅ 完了",
+    "failed": "❌ 失敗",
+}
 
 # --- サイドバー ---
 with st.sidebar:
@@ -39,13 +65,20 @@ with st.sidebar:
     page_options = ["QA生成", "QA管理"]
     if st.session_state.selected_qa_set is not None:
         page_options.append("クイズ受験")
-    st.session_state.page = st.radio("メニュー", page_options, index=page_options.index(st.session_state.page), label_visibility="collapsed")
+    st.session_state.page = st.radio(
+        "メニュー",
+        page_options,
+        index=page_options.index(st.session_state.page),
+        label_visibility="collapsed",
+    )
     st.markdown("---")
     if st.session_state.page == "QA生成":
         st.markdown("## ⚙️ 生成設定")
         st.session_state.num_q = st.slider("生成する問題数", 1, 10, 5)
         difficulty_map = {"易しい": "易", "普通": "中", "難しい": "難"}
-        selected_difficulty_label = st.radio("難易度", list(difficulty_map.keys()), index=1)
+        selected_difficulty_label = st.radio(
+            "難易度", list(difficulty_map.keys()), index=1
+        )
         st.session_state.difficulty_code = difficulty_map[selected_difficulty_label]
     st.info("講義資料のPDFから問題と回答を自動で作成します。")
 
@@ -58,51 +91,109 @@ if st.session_state.page == "QA生成":
 
     col1, col2 = st.columns(2)
     with col1:
-        theme_input = st.text_input("テーマ名", placeholder="例：サーバーレスアーキテクチャ")
+        theme_input = st.text_input(
+            "テーマ名", placeholder="例：サーバーレスアーキテクチャ"
+        )
     with col2:
-        lecture_number_input = st.number_input("講義回数（必須）", min_value=1, step=1, placeholder="例: 5")
+        lecture_number_input = st.number_input(
+            "講義回数（必須・複数ファイルの場合は最初の回）",
+            min_value=1,
+            step=1,
+            placeholder="例: 5",
+        )
 
     st.markdown("---")
-    
-    # PDFアップロード機能に一本化
-    uploaded_file = st.file_uploader(
+
+    # PDFアップロード機能に一本化（1コース分をまとめてアップロードできる）
+    uploaded_files = st.file_uploader(
         "講義資料のPDFファイルをアップロード",
         type=["pdf"],
-        label_visibility="visible"
+        accept_multiple_files=True,
+        label_visibility="visible",
     )
+    uploaded_files = sorted(uploaded_files or [], key=lambda f: f.name)
+
+    # 講義回数はファイル名順に連番で割り当て、必要なら表で修正できる
+    lecture_numbers = [
+        int(lecture_number_input or 1) + i for i in range(len(uploaded_files))
+    ]
+    if len(uploaded_files) > 1:
+        edited = st.data_editor(
+            pd.DataFrame(
+                {
+                    "ファイル名": [f.name for f in uploaded_files],
+                    "講義回数": lecture_numbers,
+                }
+            ),
+            disabled=["ファイル名"],
+            hide_index=True,
+            use_container_width=True,
+        )
+        lecture_numbers = [int(n) for n in edited["講義回数"]]
 
     if st.button("PDFからQAを生成", use_container_width=True, type="primary"):
-        if uploaded_file is None:
+        if not uploaded_files:
             st.warning("PDFファイルをアップロードしてください。")
         elif not theme_input or not lecture_number_input:
             st.warning("テーマ名と講義回数を入力してください。")
         else:
             with st.spinner("ファイルをアップロードしています..."):
                 try:
-                    # 1. メタデータ付きの事前署名付きPOST情報を取得
+                    # 1. 全ファイル共通の生成条件。S3オブジェクトのメタデータとして渡す
                     get_url_payload = {
-                        "file_name": uploaded_file.name,
                         "theme": theme_input,
-                        "lecture_number": int(lecture_number_input),
                         "num_questions": st.session_state.num_q,
                         "difficulty": st.session_state.difficulty_code,
                     }
-                    get_url_response = requests.post(f"{API_URL.rstrip('/')}/get-upload-url", json=get_url_payload)
-                    get_url_response.raise_for_status()
-                    post_info = get_url_response.json()
-
-                    # 2. S3にファイルをフォーム形式でPOST
-                    files = {"file": uploaded_file.getvalue()}
-                    upload_response = requests.post(post_info['url'], data=post_info['fields'], files=files)
-                    upload_response.raise_for_status()
+                    files = [
+                        {"fileobj": f, "file_name": f.name, "lecture_number": n}
+                        for f, n in zip(uploaded_files, lecture_numbers)
+                    ]
+                    # 2. アップロード先を一括で発行し、複数ファイルを並列にS3へ送る
+                    #    （大きいファイルはパートに分け、送信中のパートの分だけ読み込む）
+                    progress_bars = [
+                        st.progress(0.0, text=f"{f['file_name']}: 待機中...")
+                        for f in files
+                    ]
+
+                    def show_progress(index, sent, total):
+                        progress_bars[index].progress(
+                            sent / total,
+                            text=f"{files[index]['file_name']}: {sent / 2**20:.1f} / {total / 2**20:.1f} MiB",
+                        )
+
+                    results = api_client.upload_pdfs(
+                        get_url_payload, files, on_progress=show_progress
+                    )
 
-                    # 3. 成功メッセージを表示
-                    st.success("ファイルのアップロードが完了しました。")
-                    st.info("バックグラウンドで文字抽出とQA生成が開始されます。処理には数分かかる場合があります。しばらくしてから「QA管理」ページで結果を確認してください。")
-                    st.balloons()
+                    # 3. 結果を表示し、成功したファイルは下の処理状況で追跡する
+                    succeeded = 0
+                    for f, result in zip(files, results):
+                        if result["error"]:
+                            st.error(
+                                f"{f['file_name']} のアップロードに失敗しました: {result['error']}"
+                            )
+                            continue
+                        succeeded += 1
+                        if result["job_id"]:
+                            st.session_state.jobs[result["job_id"]] = {
+                                "file_name": f["file_name"],
+                                "job": None,
+                                "etag": None,
+                            }
+                    if succeeded:
+                        st.success(
+                            f"{succeeded}件のファイルのアップロードが完了しました。"
+                        )
+                        st.info(
+                            "バックグラウンドで文字抽出とQA生成が開始されます。処理には数分かかる場合があります。下の「処理状況」で進み具合を確認できます。"
+                        )
+                    if succeeded == len(files):
+                        st.balloons()
 
                 except Exception as e:
                     import traceback
+
                     st.error(f"処理中に予期せぬエラーが発生しました: {e}")
                     st.code(f"""
                     エラータイプ: {type(e).__name__}
@@ -111,6 +202,63 @@ if st.session_state.page == "QA生成":
                     {traceback.format_exc()}
                     """)
 
+    # --- 処理状況 ---
+    # GET /jobs/{id} のロングポーリングで、状態が変わった時点で表示を更新する
+    jobs = st.session_state.jobs
+    if jobs:
+        st.markdown("---")
+        st.subheader("処理状況")
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "ファイル名": entry["file_name"],
+                        "状態": JOB_STATE_LABELS.get(
+                            (entry["job"] or {}).get("state"), "⏳ 確認中"
+                        ),
+                        "文字抽出(秒)": (entry["job"] or {})
+                        .get("durations", {})
+                        .get("ocr"),
+                        "QA生成(秒)": (entry["job"] or {})
+                        .get("durations", {})
+                        .get("llm"),
+                        "合計(秒)": (entry["job"] or {})
+                        .get("durations", {})
+                        .get("total"),
+                        "エラー": (entry["job"] or {}).get("error", ""),
+                    }
+                    for entry in jobs.values()
+                ]
+            ),
+            hide_index=True,
+            use_container_width=True,
+        )
+        pending = {
+            job_id: entry["etag"]
+            for job_id, entry in jobs.items()
+            if (entry["job"] or {}).get("state") not in ("completed", "failed")
+        }
+        col_auto, col_clear_jobs = st.columns([3, 1])
+        with col_clear_jobs:
+            if st.button("表示をクリア", use_container_width=True):
+                st.session_state.jobs = {}
+                st.rerun()
+        with col_auto:
+            auto_refresh = st.toggle("完了まで自動で更新する", value=True)
+        if pending and auto_refresh:
+            try:
+                with st.spinner(f"{len(pending)}件を処理中です..."):
+                    changed = api_client.poll_jobs(pending)
+            except Exception as e:
+                st.error(f"処理状況の取得中にエラーが発生しました: {e}")
+            else:
+                for job_id, (job, etag) in changed.items():
+                    jobs[job_id].update(job=job, etag=etag)
+                    if job.get("state") == "completed":
+                        st.toast(f"{jobs[job_id]['file_name']} のQAが作成されました。")
+                        api_client.invalidate_qas()
+                st.rerun()
+
     st.markdown("</div>", unsafe_allow_html=True)
 # ============================
 # 2. QA管理ページ
@@ -133,72 +281,130 @@ elif st.session_state.page == "QA管理":
 
     col_search, col_clear, _ = st.columns([1, 1, 4])
     with col_search:
-        st.button("検索", use_container_width=True, type="primary")
+        if st.button("検索", use_container_width=True, type="primary"):
+            # 最新の一覧を1ページ目から読み直す（変更がなければETagで304になる）
+            api_client.list_qas_page.clear()
+            st.session_state.qa_list = None
     with col_clear:
         if st.button("クリア", use_container_width=True):
             st.rerun()
 
     st.markdown("---")
 
+    # 読み込んだページは検索条件ごとにsession_stateに保持し、再実行では再取得しない
+    filters = (
+        filter_theme or None,
+        int(filter_lecture_num) if filter_lecture_num else None,
+    )
+    qa_list = st.session_state.qa_list
+    if qa_list is None or qa_list["filters"] != filters:
+        qa_list = st.session_state.qa_list = {
+            "filters": filters,
+            "items": [],
+            "next_token": None,
+            "exhausted": False,
+            "page": 0,
+        }
+
+    page_size = api_client.PAGE_SIZE
     try:
-        params = {}
-        if filter_theme:
-            params["theme"] = filter_theme
-        if filter_lecture_num:
-            params["lecture_number"] = filter_lecture_num
-
-        with st.spinner("QAを読み込んでいます..."):
-            response = requests.get(
-                f"{API_URL.rstrip('/')}/qas", params=params, timeout=60
-            )
-            response.raise_for_status()
-            qas = response.json()
+        # 表示するページの分だけ、APIのカーソル（next_token）で続きを読み込む
+        while (
+            len(qa_list["items"]) < (qa_list["page"] + 1) * page_size
+            and not qa_list["exhausted"]
+        ):
+            with st.spinner("QAを読み込んでいます..."):
+                result = api_client.list_qas_page(
+                    theme=filters[0],
+                    lecture_number=filters[1],
+                    next_token=qa_list["next_token"],
+                )
+            qa_list["items"].extend(result.get("items", []))
+            qa_list["next_token"] = result.get("next_token")
+            qa_list["exhausted"] = not qa_list["next_token"]
+    except Exception as e:
+        st.error(f"QA一覧の取得中にエラーが発生しました: {e}")
 
-        if not qas:
+    qas = qa_list["items"]
+    # 削除で件数が減った場合は、表示できる最後のページに戻す
+    if qas and qa_list["page"] * page_size >= len(qas):
+        qa_list["page"] = (len(qas) - 1) // page_size
+    if not qas:
+        if qa_list["exhausted"]:
             st.info("該当するQAセットはありません。")
-        else:
-            st.info(f"{len(qas)}件のQAセットが見つかりました。")
-            st.markdown("---")
-            for item in qas:
-                qa_set_id = item["qa_set_id"]
-                display_title = f"テーマ: {item.get('theme', 'N/A')} | 第{item.get('lecture_number', '?')}回 | ID: `{qa_set_id}`"
-                with st.expander(display_title):
-                    qa_data = item.get("qa_data", {}).get("qa_set", [])
-                    if qa_data:
-                        st.dataframe(pd.DataFrame(qa_data))
+    else:
+        start = qa_list["page"] * page_size
+        page_items = qas[start : start + page_size]
+        more = "" if qa_list["exhausted"] else "以上"
+        st.info(
+            f"{start + 1}〜{start + len(page_items)}件目を表示中（{len(qas)}件{more}）"
+        )
+
+        col_prev, col_page, col_next = st.columns([1, 4, 1])
+        with col_prev:
+            if st.button(
+                "◀ 前へ", disabled=qa_list["page"] == 0, use_container_width=True
+            ):
+                qa_list["page"] -= 1
+                st.rerun()
+        with col_page:
+            st.caption(f"ページ {qa_list['page'] + 1}")
+        with col_next:
+            has_next = len(qas) > start + page_size or not qa_list["exhausted"]
+            if st.button("次へ ▶", disabled=not has_next, use_container_width=True):
+                qa_list["page"] += 1
+                st.rerun()
+        st.markdown("---")
+
+        # 表示中のページの分だけ描画する
+        for item in page_items:
+            qa_set_id = item["qa_set_id"]
+            display_title = f"テーマ: {item.get('theme', 'N/A')} | 第{item.get('lecture_number', '?')}回 | ID: `{qa_set_id}`"
+            with st.expander(display_title):
+                st.caption(f"問題数: {item.get('question_count', '?')}")
+                # 問題本体とDataFrameは、表示を選んだセットの分だけ取得・作成する
+                if st.toggle("問題を表示", key=f"show_{qa_set_id}"):
+                    try:
+                        questions = question_frame(qa_set_id)
+                    except Exception as e:
+                        st.error(f"問題の取得中にエラーが発生しました: {e}")
                     else:
-                        st.write("このセットにはQAデータがありません。")
-
-                    col1, col2 = st.columns([4, 1])
-                    with col1:
-                        if st.button(
-                            "このクイズに回答する",
-                            key=f"start_{qa_set_id}",
-                            type="primary",
-                            use_container_width=True,
-                        ):
-                            st.session_state.selected_qa_set = item
-                            st.session_state.quiz_results = None
-                            st.session_state.page = "クイズ受験"
+                        if questions.empty:
+                            st.write("このセットにはQAデータがありません。")
+                        else:
+                            st.dataframe(questions)
+
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    if st.button(
+                        "このクイズに回答する",
+                        key=f"start_{qa_set_id}",
+                        type="primary",
+                        use_container_width=True,
+                    ):
+                        st.session_state.selected_qa_set = api_client.get_qa(qa_set_id)
+                        st.session_state.quiz_results = None
+                        st.session_state.page = "クイズ受験"
+                        st.rerun()
+                with col2:
+                    if st.button(
+                        "削除",
+                        key=f"delete_{qa_set_id}",
+                        type="secondary",
+                        use_container_width=True,
+                    ):
+                        delete_response = api_client.delete_qa(qa_set_id)
+                        if delete_response.status_code == 204:
+                            st.success(f"ID: {qa_set_id} を削除しました。")
+                            # 読み込み済みのページから除き、表示中のページはそのままにする
+                            qa_list["items"] = [
+                                qa for qa in qas if qa["qa_set_id"] != qa_set_id
+                            ]
                             st.rerun()
-                    with col2:
-                        if st.button(
-                            "削除",
-                            key=f"delete_{qa_set_id}",
-                            type="secondary",
-                            use_container_width=True,
-                        ):
-                            delete_url = f"{API_URL.rstrip('/')}/qas/{qa_set_id}"
-                            delete_response = requests.delete(delete_url)
-                            if delete_response.status_code == 204:
-                                st.success(f"ID: {qa_set_id} を削除しました。")
-                                st.rerun()
-                            else:
-                                st.error(
-                                    f"削除に失敗しました。ステータスコード: {delete_response.status_code}"
-                                )
-    except Exception as e:
-        st.error(f"QA一覧の取得中にエラーが発生しました: {e}")
+                        else:
+                            st.error(
+                                f"削除に失敗しました。ステータスコード: {delete_response.status_code}"
+                            )
 
 # ============================
 # 3. クイズ受験ページ
@@ -253,14 +459,11 @@ elif st.session_state.page == "クイズ受験":
     if submitted:
         with st.spinner("採点中です..."):
             qa_set_id = selected_set["qa_set_id"]
-            api_url = f"{API_URL.rstrip('/')}/qas/{qa_set_id}/submit"
             try:
-                response = requests.post(
-                    api_url, json={"answers": user_answers_payload}, timeout=60
+                st.session_state.quiz_results = api_client.submit_answers(
+                    qa_set_id, user_answers_payload
                 )
-                response.raise_for_status()
                 st.success("採点が完了しました！")
-                st.session_state.quiz_results = response.json()
             except Exception as e:
                 st.error(f"採点中にエラーが発生しました: {e}")
 
@@ -296,7 +499,18 @@ elif st.session_state.page == "クイズ受験":
                 )
                 st.markdown(f"**模範解答:** {qa.get('correct_answer')}")
                 if qa.get("type") == "記述式":
-                    st.markdown(
-                        f"**必須キーワード:** `{'`, `'.join(qa.get('scoring_keywords', []))}`"
-                    )
+                    keyword_hits = result_detail.get("keyword_hits")
+                    if keyword_hits:
+                        keyword_marks = ", ".join(
+                            f"{'✅' if h['hit'] else '❌'} `{h['keyword']}`"
+                            for h in keyword_hits
+                        )
+                        st.markdown(
+                            f"**必須キーワード:** {keyword_marks}"
+                            f"（部分点: {result_detail.get('partial_score', 0):.0%}）"
+                        )
+                    else:
+                        st.markdown(
+                            f"**必須キーワード:** `{'`, `'.join(map(str, qa.get('scoring_keywords', [])))}`"
+                        )
                 st.markdown(f"**解説:** {qa.get('explanation')}")
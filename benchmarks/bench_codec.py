@@ -0,0 +1,109 @@
+# benchmarks/bench_codec.py
+# list_qas の大きなレスポンスで、resource経由（Decimal + DecimalEncoder）と
+# qa_common.codec（int/float + C実装のエンコーダー）の変換コストを比べる
+#
+#   python benchmarks/bench_codec.py [--items 100] [--questions 20] [--repeat 20]
+import argparse
+import json
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeDeserializer
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "lambda_common", "python")
+)
+
+from qa_common.codec import deserialize_response, dumps, serialize_item  # noqa: E402
+
+
+class DecimalEncoder(json.JSONEncoder):
+    """従来の各Lambdaにあったエンコーダー"""
+
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            if obj % 1 == 0:
+                return int(obj)
+            else:
+                return float(obj)
+        return super(DecimalEncoder, self).default(obj)
+
+
+def build_page(items, questions):
+    """低レベルクライアントが返すQueryの応答（AttributeValue形式）を作る"""
+    page = []
+    for i in range(items):
+        qa_set = [
+            {
+                "question_id": q,
+                "difficulty": "中",
+                "type": "記述式" if q % 2 else "一択選択式",
+                "question": f"講義{i}の問題{q}について説明しなさい。" * 3,
+                "options": [f"選択肢{c}" for c in "ABCD"],
+                "correct_answer": "正解の文章" * 5,
+                "explanation": "解説の文章" * 10,
+                "scoring_keywords": ["キーワード1", "キーワード2", "キーワード3"],
+                "weight": 1.5,
+            }
+            for q in range(1, questions + 1)
+        ]
+        page.append(
+            serialize_item(
+                {
+                    "qa_set_id": f"id-{i}",
+                    "theme": "クラウド",
+                    "lecture_number": i,
+                    "question_count": questions,
+                    "version": 1,
+                    "qa_data": {"qa_set": qa_set},
+                }
+            )
+        )
+    return {"Items": page, "Count": items}
+
+
+def resource_path(response):
+    deserializer = TypeDeserializer()
+    items = [
+        {k: deserializer.deserialize(v) for k, v in item.items()}
+        for item in response["Items"]
+    ]
+    body = {"items": items, "count": len(items), "next_token": None}
+    return json.dumps(body, ensure_ascii=False, cls=DecimalEncoder)
+
+
+def codec_path(response):
+    items = deserialize_response(dict(response))["Items"]
+    return dumps({"items": items, "count": len(items), "next_token": None})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    response = build_page(args.items, args.questions)
+    assert json.loads(resource_path(response)) == json.loads(codec_path(response))
+    payload_kb = len(codec_path(response).encode("utf-8")) / 1024
+    print(
+        f"{args.items} items x {args.questions} questions ({payload_kb:.0f} KiB body)"
+    )
+
+    results = {}
+    for name, func in (("resource", resource_path), ("codec", codec_path)):
+        best = min(
+            timeit.repeat(
+                lambda func=func: func(response), number=1, repeat=args.repeat
+            )
+        )
+        results[name] = best
+        print(f"  {name:<9}{best * 1000:8.2f} ms")
+    print(f"  speedup  {results['resource'] / results['codec']:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,756 @@
+# benchmarks/bench_pipeline.py
+# アップロード → Textract → SNS → 生成 → 保存 のパイプラインを、各Lambdaの実際のハンドラーを
+# プロセス内で呼び出して計測する。S3・DynamoDB・SNS・SQSはmoto、TextractとBedrockは
+# 遅延を指定できる決定的なスタブに置き換えるので、AWSに接続せずに手元で性能の後退を確認できる
+#
+#   pip install -r requirements-dev.txt
+#   python benchmarks/bench_pipeline.py [--documents 20] [--pages 12] [--scanned-ratio 0.25]
+#       [--questions 5] [--table-items 500] [--textract-latency 0] [--bedrock-latency 0]
+#       [--json results.json]
+#
+# 出力するもの
+#   - パイプライン全体のスループット（文書・ページ・問題/秒）と、読み込みAPIのリクエスト/秒
+#   - ハンドラーごとの処理時間のp50/p99と、1回の呼び出しで確保したメモリの最大値（tracemalloc）
+#   - qa_common.metrics が出力するEMFを集計した、外部呼び出し（段階）ごとのp50/p99と推定コスト
+# メモリはmotoのバックエンドがハンドラー内で確保した分も含む。tracemallocは処理時間を
+# 数割増やすので、処理時間だけを比べるときは --no-trace-memory を付ける
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import re
+import resource
+import sys
+import time
+import tracemalloc
+import uuid
+
+import boto3
+from moto import mock_aws
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "lambda_common", "python"))
+
+from qa_common.metrics import timed  # noqa: E402
+
+REGION = "us-east-1"
+BUCKET = "qa-bench-uploads"
+QA_TABLE = "qa-bench-qas"
+JOBS_TABLE = "qa-bench-jobs"
+PIPELINE_STATE_TABLE = "qa-bench-pipeline-state"
+THEMES = [f"theme-{i:02d}" for i in range(10)]
+WORDS = (
+    "lambda function event queue bucket object table index partition key value "
+    "stream shard latency throughput request response cache region replica "
+    "retry backoff timeout memory concurrency scaling trigger notification"
+).split()
+
+
+# --- 合成データ ---
+
+
+def _text_line(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_pdf(pages, scanned_ratio, seed, lines_per_page=20):
+    """テキストレイヤーのあるページと、画像だけの（OCRが必要な）ページを混ぜたPDFを作る"""
+    rng = random.Random(seed)
+    writer = PdfWriter()
+    font = DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/Helvetica"),
+        }
+    )
+    for index in range(pages):
+        page = writer.add_blank_page(612, 792)
+        content = DecodedStreamObject()
+        # scanned_ratioの割合で、ページ全体に均等に散らばるようにスキャンページを置く
+        if int((index + 1) * scanned_ratio) > int(index * scanned_ratio):
+            # 実際のスキャンと同じく文書ごとに内容が異なるようにし、内容ハッシュを分ける
+            content.set_data(
+                f"% scan {seed}-{index}\n0.5 g 72 72 468 648 re f".encode()
+            )
+        else:
+            page[NameObject("/Resources")] = DictionaryObject(
+                {NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})}
+            )
+            lines = [f"Seed {seed} slide {index + 1}"]
+            lines += [_text_line(rng) for _ in range(lines_per_page)]
+            shown = " T* ".join(f"({line}) Tj" for line in lines)
+            content.set_data(f"BT /F1 10 Tf 72 740 Td 14 TL {shown} ET".encode())
+        page.replace_contents(content)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def make_qa_item(index, questions):
+    theme = THEMES[index % len(THEMES)]
+    now = f"2026-01-01T00:00:{index % 60:02d}"
+    return {
+        "qa_set_id": str(uuid.UUID(int=index)),
+        "theme": theme,
+        "lecture_number": index // len(THEMES) + 1,
+        "question_count": questions,
+        "version": 1,
+        "source_file": f"uploads/seed-{index}.pdf",
+        "created_at": now,
+        "updated_at": now,
+        "qa_data": {
+            "qa_set": [
+                {
+                    "question_id": q,
+                    "difficulty": "中",
+                    "type": "記述式",
+                    "question": f"{theme}の第{q}問: " + "説明しなさい。" * 5,
+                    "correct_answer": "正解の文章" * 8,
+                    "explanation": "解説の文章" * 15,
+                }
+                for q in range(1, questions + 1)
+            ]
+        },
+    }
+
+
+# --- TextractとBedrockのスタブ ---
+
+
+class FakeTextract:
+    """非同期のテキスト検出だけを持つTextractのスタブ。開始したジョブは
+    complete_pending() で完了扱いにし、実際のTextractと同じ形の通知をSNSに送る。
+    botocoreを通らないので、計測フックの代わりに同じ段階名で処理時間を記録する"""
+
+    def __init__(self, s3, sns, latency, lines_per_page=20):
+        self.s3 = s3
+        self.sns = sns
+        self.latency = latency
+        self.lines_per_page = lines_per_page
+        self.jobs = {}
+        self.pending = []
+        self.pages = 0
+
+    def start_document_text_detection(
+        self, DocumentLocation, NotificationChannel, JobTag=None, **kwargs
+    ):
+        with timed("textract.StartDocumentTextDetection"):
+            time.sleep(self.latency)
+        location = DocumentLocation["S3Object"]
+        body = self.s3.get_object(Bucket=location["Bucket"], Key=location["Name"])
+        pages = len(PdfReader(io.BytesIO(body["Body"].read())).pages)
+        job_id = f"job-{len(self.jobs):06d}"
+        self.jobs[job_id] = {
+            "location": location,
+            "topic": NotificationChannel["SNSTopicArn"],
+            "tag": JobTag,
+            "pages": pages,
+        }
+        self.pending.append(job_id)
+        self.pages += pages
+        return {"JobId": job_id}
+
+    def complete_pending(self):
+        completed, self.pending = self.pending, []
+        for job_id in completed:
+            job = self.jobs[job_id]
+            message = {
+                "JobId": job_id,
+                "Status": "SUCCEEDED",
+                "API": "StartDocumentTextDetection",
+                "JobTag": job["tag"],
+                "Timestamp": int(time.time() * 1000),
+                "DocumentLocation": {
+                    "S3ObjectName": job["location"]["Name"],
+                    "S3Bucket": job["location"]["Bucket"],
+                },
+            }
+            self.sns.publish(TopicArn=job["topic"], Message=json.dumps(message))
+        return len(completed)
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+        with timed("textract.GetDocumentTextDetection"):
+            time.sleep(self.latency)
+        job = self.jobs[JobId]
+        total = job["pages"] * self.lines_per_page
+        start = int(NextToken or 0)
+        end = min(total, start + MaxResults)
+        blocks = [
+            {
+                "BlockType": "LINE",
+                "Page": line // self.lines_per_page + 1,
+                "Text": f"{JobId} scanned line {line}: "
+                + _text_line(random.Random(f"{JobId}-{line}")),
+            }
+            for line in range(start, end)
+        ]
+        response = {
+            "JobStatus": "SUCCEEDED",
+            "DocumentMetadata": {"Pages": job["pages"]},
+            "Blocks": blocks,
+        }
+        if end < total:
+            response["NextToken"] = str(end)
+        return response
+
+
+class FakeBedrock:
+    """InvokeModelのスタブ。プロンプトで指定された数の問題を、Amazon Novaと同じ形の
+    応答と使用量で返す。問題文はリクエストのハッシュを含むので、チャンク間で重複しない"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def invoke_model(self, body, modelId, **kwargs):
+        with timed("bedrock-runtime.InvokeModel"):
+            time.sleep(self.latency)
+        self.calls += 1
+        request = json.loads(body)
+        system = request["system"][0]["text"]
+        prompt = system + request["messages"][0]["content"][0]["text"]
+        count = int(re.search(r"(\d+)個の問題", system).group(1))
+        seed = hashlib.sha256(body.encode("utf-8")).hexdigest()[:12]
+        text = json.dumps(
+            {
+                "qa_set": [
+                    {
+                        "question_id": i,
+                        "difficulty": "中",
+                        "type": "記述式" if i % 2 else "一択選択式",
+                        "question": f"[{seed}] 講義内容の要点{i}を説明しなさい。",
+                        "options": ["A", "B", "C", "D"],
+                        "correct_answer": f"要点{i}の説明",
+                        "explanation": "講義内容に基づく解説。" * 4,
+                    }
+                    for i in range(1, count + 1)
+                ]
+            },
+            ensure_ascii=False,
+        )
+        payload = {
+            "output": {"message": {"content": [{"text": text}]}},
+            "usage": {"inputTokens": len(prompt), "outputTokens": len(text) // 2},
+        }
+        return {
+            "body": io.BytesIO(json.dumps(payload).encode("utf-8")),
+            "contentType": "application/json",
+        }
+
+
+# --- ハンドラーの読み込みと計測 ---
+
+
+def load_handler(directory):
+    """lambda_xxx/main.py をモジュール名が衝突しないように読み込む"""
+    path = os.path.join(ROOT, directory)
+    spec = importlib.util.spec_from_file_location(
+        f"bench_{directory}", os.path.join(path, "main.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, path)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(path)
+    return module
+
+
+class LambdaContext:
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+
+
+def percentile(values, p):
+    """最近接順位法によるパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Recorder:
+    """ハンドラーを呼び出し、処理時間とメモリの最大値を記録する。ハンドラーの標準出力は
+    取り込み、EMFの行だけを段階ごとの集計に使う"""
+
+    def __init__(self, trace_memory, verbose):
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.latencies = {}
+        self.memory_peaks = {}
+        self.stages = {}
+        self.totals = {}
+
+    def call(self, name, module, event):
+        output = io.StringIO()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            response = module.handler(event, LambdaContext(name))
+        elapsed = (time.perf_counter() - started) * 1000
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            self.memory_peaks[name] = max(self.memory_peaks.get(name, 0), peak)
+        self.latencies.setdefault(name, []).append(elapsed)
+        self._collect_emf(output.getvalue())
+        return response
+
+    def _collect_emf(self, output):
+        for line in output.splitlines():
+            if not line.startswith('{"_aws"'):
+                if self.verbose:
+                    print(line)
+                continue
+            document = json.loads(line)
+            names = [
+                m["Name"] for m in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+            ]
+            if "Stage" in document:
+                stage = self.stages.setdefault(document["Stage"], {})
+                for name in names:
+                    stage.setdefault(name, []).extend(document[name])
+            else:
+                for name in names:
+                    self.totals[name] = self.totals.get(name, 0) + document[name]
+
+
+# --- 環境の準備 ---
+
+
+def configure_environment(args):
+    os.environ.update(
+        {
+            "AWS_DEFAULT_REGION": REGION,
+            "AWS_REGION": REGION,
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "UPLOAD_BUCKET_NAME": BUCKET,
+            "TABLE_NAME": QA_TABLE,
+            "JOBS_TABLE_NAME": JOBS_TABLE,
+            "PIPELINE_STATE_TABLE": PIPELINE_STATE_TABLE,
+            "MAX_TEXTRACT_JOBS": str(args.max_textract_jobs),
+            "OCR_SLICE_PAGES": str(args.ocr_slice_pages),
+            "TEXTRACT_ROLE_ARN": "arn:aws:iam::123456789012:role/textract",
+            "GENERATION_MODE": "invoke",
+        }
+    )
+    for name in ("GENERATION_CACHE_TABLE", "DEFERRED_QUEUE_URL", "INTAKE_QUEUE_URL"):
+        os.environ.pop(name, None)
+
+
+def create_backends(questions, table_items):
+    """motoにバケット・テーブル・トピックを作る。ハンドラーの計測フックが付かないよう、
+    既定とは別のセッションのクライアントを使う"""
+    session = boto3.session.Session(region_name=REGION)
+    s3 = session.client("s3")
+    s3.create_bucket(Bucket=BUCKET)
+    dynamodb = session.resource("dynamodb")
+    qa_table = dynamodb.create_table(
+        TableName=QA_TABLE,
+        KeySchema=[{"AttributeName": "qa_set_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[
+            {"AttributeName": "qa_set_id", "AttributeType": "S"},
+            {"AttributeName": "theme", "AttributeType": "S"},
+            {"AttributeName": "lecture_number", "AttributeType": "N"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "ThemeLectureIndex",
+                "KeySchema": [
+                    {"AttributeName": "theme", "KeyType": "HASH"},
+                    {"AttributeName": "lecture_number", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            }
+        ],
+    )
+    for name, key in ((JOBS_TABLE, "job_id"), (PIPELINE_STATE_TABLE, "pk")):
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+    with qa_table.batch_writer() as batch:
+        for index in range(table_items):
+            batch.put_item(Item=make_qa_item(index, questions))
+
+    sns = session.client("sns")
+    topic_arn = sns.create_topic(Name="qa-bench-textract")["TopicArn"]
+    sqs = session.client("sqs")
+    queue_url = sqs.create_queue(QueueName="qa-bench-notifications")["QueueUrl"]
+    queue_arn = sqs.get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=["QueueArn"]
+    )["Attributes"]["QueueArn"]
+    # 結果処理Lambdaの代わりにキューで通知を受け、ハンドラーにSNSのイベントとして渡す
+    sns.subscribe(
+        TopicArn=topic_arn,
+        Protocol="sqs",
+        Endpoint=queue_arn,
+        Attributes={"RawMessageDelivery": "true"},
+    )
+    os.environ["SNS_TOPIC_ARN"] = topic_arn
+    return {"s3": s3, "sns": sns, "sqs": sqs, "queue_url": queue_url}
+
+
+def s3_event_record(key, index):
+    event = {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+                "s3": {"bucket": {"name": BUCKET}, "object": {"key": key}},
+            }
+        ]
+    }
+    return {
+        "messageId": f"intake-{index}",
+        "receiptHandle": f"receipt-{index}",
+        "body": json.dumps(event),
+    }
+
+
+# --- シナリオ ---
+
+
+def run_pipeline(args, recorder, handlers, backends, textract):
+    """PDFをまとめてアップロードし、全ての文書のQAが保存されるまでパイプラインを回す"""
+    pdfs = [
+        make_pdf(args.pages, args.scanned_ratio, seed=index)
+        for index in range(args.documents)
+    ]
+    started = time.perf_counter()
+    response = recorder.call(
+        "GetUploadUrlFunction",
+        handlers["get_upload_url"],
+        {
+            "body": json.dumps(
+                {
+                    "action": "batch",
+                    "theme": "benchmark",
+                    "num_questions": args.questions,
+                    "difficulty": "中",
+                    "files": [
+                        {"file_name": f"lecture-{i:03d}.pdf", "lecture_number": i + 1}
+                        for i in range(args.documents)
+                    ],
+                }
+            )
+        },
+    )
+    uploads = json.loads(response["body"])["uploads"]
+
+    # ブラウザからの事前署名付きPOSTの代わりに、発行されたキーとメタデータで直接置く。
+    # POSTで送った非ASCIIのメタデータはS3がRFC 2047形式で保存するので、同じ形にする
+    encode = handlers["get_upload_url"].encode_metadata_value
+    intake = []
+    for index, (upload, pdf) in enumerate(zip(uploads, pdfs)):
+        fields = upload["fields"]
+        backends["s3"].put_object(
+            Bucket=BUCKET,
+            Key=fields["key"],
+            Body=pdf,
+            Metadata={
+                name[len("x-amz-meta-") :]: encode(value)
+                for name, value in fields.items()
+                if name.startswith("x-amz-meta-")
+            },
+        )
+        intake.append(s3_event_record(fields["key"], index))
+
+    sqs, queue_url = backends["sqs"], backends["queue_url"]
+    while True:
+        progressed = False
+        # 開始Lambda: SQSのバッチ単位で受け取り、失敗したメッセージは後で再配信する
+        batch, intake = intake[: args.batch_size], intake[args.batch_size :]
+        if batch:
+            result = recorder.call(
+                "StartPdfProcessingFunction",
+                handlers["start"],
+                {"Records": batch},
+            )
+            failed = {f["itemIdentifier"] for f in result["batchItemFailures"]}
+            intake += [r for r in batch if r["messageId"] in failed]
+            progressed = len(failed) < len(batch)
+
+        progressed |= textract.complete_pending() > 0
+
+        # 結果処理Lambda: Textractの完了通知と、テキストレイヤーだけで済んだ文書の通知
+        while True:
+            messages = sqs.receive_message(
+                QueueUrl=queue_url, MaxNumberOfMessages=10
+            ).get("Messages", [])
+            if not messages:
+                break
+            progressed = True
+            for message in messages:
+                recorder.call(
+                    "HandleTextractResultFunction",
+                    handlers["handle"],
+                    {
+                        "Records": [
+                            {
+                                "EventSource": "aws:sns",
+                                "Sns": {"Message": message["Body"]},
+                            }
+                        ]
+                    },
+                )
+                sqs.delete_message(
+                    QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"]
+                )
+
+        if not intake and not textract.pending:
+            break
+        if not progressed:
+            raise RuntimeError(
+                "パイプラインが進まなくなりました（スロットが返却されていない）"
+            )
+    elapsed = time.perf_counter() - started
+
+    states = {}
+    for upload in uploads:
+        job = json.loads(
+            recorder.call(
+                "GetJobFunction",
+                handlers["get_job"],
+                {"pathParameters": {"id": upload["job_id"]}},
+            )["body"]
+        )
+        states[job["state"]] = states.get(job["state"], 0) + 1
+    return elapsed, states
+
+
+def run_reads(args, recorder, handlers):
+    """一覧を最後のページまで読み、先頭の項目を詳細APIで2回（2回目は条件付きで）読む"""
+    started = time.perf_counter()
+    requests = 0
+    ids = []
+    for theme in (None, THEMES[0]):
+        next_token = None
+        while True:
+            params = {"view": "summary", "limit": str(args.page_size)}
+            if theme:
+                params["theme"] = theme
+            if next_token:
+                params["next_token"] = next_token
+            body = json.loads(
+                recorder.call(
+                    "ListQasFunction",
+                    handlers["list_qas"],
+                    {"queryStringParameters": params},
+                )["body"]
+            )
+            requests += 1
+            ids += [item["qa_set_id"] for item in body["items"]]
+            next_token = body.get("next_token")
+            if not next_token:
+                break
+
+    for qa_set_id in ids[: args.detail_reads]:
+        event = {"pathParameters": {"id": qa_set_id}, "headers": {}}
+        response = recorder.call("GetQaFunction", handlers["get_qa"], event)
+        event["headers"]["If-None-Match"] = response["headers"]["ETag"]
+        recorder.call("GetQaFunction", handlers["get_qa"], event)
+        requests += 2
+    return time.perf_counter() - started, requests
+
+
+# --- 出力 ---
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def build_report(args, recorder, pipeline, reads, textract, bedrock):
+    pipeline_seconds, states = pipeline
+    read_seconds, read_requests = reads
+    questions = recorder.totals.get("QuestionsGenerated", 0)
+    report = {
+        "parameters": vars(args),
+        "pipeline": {
+            "seconds": pipeline_seconds,
+            "documents_per_second": args.documents / pipeline_seconds,
+            "pages_per_second": args.documents * args.pages / pipeline_seconds,
+            "questions_per_second": questions / pipeline_seconds,
+            "job_states": states,
+            "textract_jobs": len(textract.jobs),
+            "ocr_pages": textract.pages,
+            "bedrock_calls": bedrock.calls,
+        },
+        "reads": {
+            "seconds": read_seconds,
+            "requests": read_requests,
+            "requests_per_second": read_requests / read_seconds if read_seconds else 0,
+        },
+        "handlers": {
+            name: {
+                **summarize(values),
+                "peak_memory_kib": (
+                    recorder.memory_peaks[name] / 1024
+                    if name in recorder.memory_peaks
+                    else None
+                ),
+            }
+            for name, values in recorder.latencies.items()
+        },
+        "stages": {
+            stage: {
+                **summarize(metrics["Latency"]),
+                "consumed_capacity": sum(metrics.get("ConsumedCapacity", [])),
+            }
+            for stage, metrics in sorted(recorder.stages.items())
+            # ハンドラー全体の処理時間は関数ごとの表に出す
+            if stage != "handler" and metrics.get("Latency")
+        },
+        "cost": {
+            name: recorder.totals[name]
+            for name in (
+                "InputTokens",
+                "OutputTokens",
+                "TextractPages",
+                "QuestionsGenerated",
+                "EstimatedCost",
+            )
+            if name in recorder.totals
+        },
+        # ru_maxrssはLinuxではKiB単位
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if questions and "EstimatedCost" in recorder.totals:
+        report["cost"]["CostPerQuestion"] = recorder.totals["EstimatedCost"] / questions
+    return report
+
+
+def print_report(report):
+    pipeline, reads = report["pipeline"], report["reads"]
+    print(
+        f"pipeline: {pipeline['seconds']:.2f}s  "
+        f"{pipeline['documents_per_second']:.2f} docs/s  "
+        f"{pipeline['pages_per_second']:.1f} pages/s  "
+        f"{pipeline['questions_per_second']:.1f} questions/s  "
+        f"jobs={pipeline['job_states']}  textract_jobs={pipeline['textract_jobs']} "
+        f"ocr_pages={pipeline['ocr_pages']}  bedrock_calls={pipeline['bedrock_calls']}"
+    )
+    print(
+        f"reads:    {reads['seconds']:.2f}s  {reads['requests']} requests  "
+        f"{reads['requests_per_second']:.1f} req/s"
+    )
+    print()
+    print(
+        f"{'handler':<30}{'calls':>7}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+        f"{'peak KiB':>11}"
+    )
+    for name, row in report["handlers"].items():
+        peak = row["peak_memory_kib"]
+        peak = "-" if peak is None else f"{peak:.0f}"
+        print(
+            f"{name:<30}{row['count']:>7}{row['p50']:>10.1f}{row['p99']:>10.1f}"
+            f"{row['max']:>10.1f}{peak:>11}"
+        )
+    print()
+    print(
+        f"{'stage':<42}{'calls':>7}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+        f"{'RCU/WCU':>9}"
+    )
+    for stage, row in report["stages"].items():
+        print(
+            f"{stage:<42}{row['count']:>7}{row['p50']:>10.2f}{row['p99']:>10.2f}"
+            f"{row['max']:>10.2f}{row['consumed_capacity']:>9.1f}"
+        )
+    print()
+    print("cost:", json.dumps(report["cost"]))
+    print(f"max RSS: {report['max_rss_kib'] / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=12)
+    parser.add_argument(
+        "--scanned-ratio",
+        type=float,
+        default=0.25,
+        help="テキストレイヤーの無い（OCRが必要な）ページの割合",
+    )
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument(
+        "--table-items", type=int, default=500, help="事前に入れておくQAセットの件数"
+    )
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--detail-reads", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--max-textract-jobs", type=int, default=10)
+    parser.add_argument("--ocr-slice-pages", type=int, default=50)
+    parser.add_argument(
+        "--textract-latency",
+        type=float,
+        default=0.0,
+        help="Textract APIごとの遅延（秒）",
+    )
+    parser.add_argument(
+        "--bedrock-latency",
+        type=float,
+        default=0.0,
+        help="Bedrock呼び出しごとの遅延（秒）",
+    )
+    parser.add_argument("--no-trace-memory", action="store_true")
+    parser.add_argument(
+        "--verbose", action="store_true", help="ハンドラーのログも表示する"
+    )
+    parser.add_argument("--json", help="結果をJSONで保存するパス（回帰の比較用）")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    recorder = Recorder(not args.no_trace_memory, args.verbose)
+    with mock_aws():
+        backends = create_backends(args.questions, args.table_items)
+        handlers = {
+            "get_upload_url": load_handler("lambda_get_upload_url"),
+            "start": load_handler("lambda_start_pdf_processing"),
+            "handle": load_handler("lambda_handle_textract_result"),
+            "get_job": load_handler("lambda_get_job"),
+            "list_qas": load_handler("lambda_list_qas"),
+            "get_qa": load_handler("lambda_get_qa"),
+        }
+        textract = FakeTextract(backends["s3"], backends["sns"], args.textract_latency)
+        bedrock = FakeBedrock(args.bedrock_latency)
+        handlers["start"].textract_client = textract
+        handlers["handle"].textract_client = textract
+        # スロットリング対策や使用量の記録はそのまま動かし、呼び出し先だけを差し替える
+        handlers["handle"].bedrock_runtime.client = bedrock
+
+        if recorder.trace_memory:
+            tracemalloc.start()
+        pipeline = run_pipeline(args, recorder, handlers, backends, textract)
+        reads = run_reads(args, recorder, handlers)
+        if recorder.trace_memory:
+            tracemalloc.stop()
+
+    report = build_report(args, recorder, pipeline, reads, textract, bedrock)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
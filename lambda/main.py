@@ -1,38 +1,56 @@
 import json
+import math
 import os
 import boto3
 import traceback
 import uuid
-import decimal
+from datetime import datetime
+
+from botocore.config import Config
+
+from qa_common.bedrock_client import BedrockUnavailable, ThrottleAwareBedrock
+from qa_common.codec import DynamoTable, dumps
+from qa_common.generation_cache import CACHE_MODES, GenerationCache
+from qa_common.json_salvage import collect_questions
+from qa_common.metrics import add_metric, instrument_boto3, instrument_handler
+from qa_common.qa_stream import stream_model_text
+
+instrument_boto3()
 
 # --- 初期設定 ---
 MODEL_ID = os.environ.get("MODEL_ID", "amazon.titan-text-express-v1")
 AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
-bedrock_runtime = boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION)
+# スロットリング時の再試行・同時実行数の調整はThrottleAwareBedrockが行う
+bedrock_runtime = ThrottleAwareBedrock(
+    boto3.client(
+        service_name="bedrock-runtime",
+        region_name=AWS_REGION,
+        config=Config(retries={"mode": "standard", "total_max_attempts": 1}),
+    ),
+    max_concurrency=int(os.environ.get("BEDROCK_MAX_CONCURRENCY", "4")),
+    tokens_per_minute=int(os.environ.get("BEDROCK_TOKENS_PER_MINUTE", "0")),
+)
 TABLE_NAME = os.environ.get("TABLE_NAME")
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(TABLE_NAME) if TABLE_NAME else None
+table = DynamoTable(TABLE_NAME) if TABLE_NAME else None
+# Bedrock生成結果のキャッシュ（テーブル未設定ならキャッシュしない）
+GENERATION_CACHE_TABLE = os.environ.get("GENERATION_CACHE_TABLE")
+GENERATION_CACHE_MODE = os.environ.get("GENERATION_CACHE_MODE", "use")
+# invoke: 一括で生成 / stream: ストリーミングで受信し、必要数が揃った時点で打ち切る
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "invoke")
+# 問題数が不足した場合に不足分だけを再生成する回数
+SALVAGE_RETRY_LIMIT = int(os.environ.get("SALVAGE_RETRY_LIMIT", "1"))
+generation_cache = (
+    GenerationCache(
+        GENERATION_CACHE_TABLE,
+        bucket_name=os.environ.get("GENERATION_CACHE_BUCKET"),
+        ttl_seconds=int(os.environ.get("GENERATION_CACHE_TTL_DAYS", "30")) * 86400,
+    )
+    if GENERATION_CACHE_TABLE
+    else None
+)
 
 
 # --- ヘルパー関数 ---
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            return float(o)
-        return super(DecimalEncoder, self).default(o)
-
-
-def replace_floats_with_decimals(obj):
-    if isinstance(obj, list):
-        return [replace_floats_with_decimals(i) for i in obj]
-    elif isinstance(obj, dict):
-        return {k: replace_floats_with_decimals(v) for k, v in obj.items()}
-    elif isinstance(obj, float):
-        return decimal.Decimal(str(obj))
-    else:
-        return obj
-
-
 def create_success_response(body):
     return {
         "statusCode": 200,
@@ -40,7 +58,7 @@ def create_success_response(body):
             "Content-Type": "application/json",
             "Access-Control-Allow-Origin": "*",
         },
-        "body": json.dumps(body, ensure_ascii=False, cls=DecimalEncoder),
+        "body": dumps(body),
     }
 
 
@@ -55,18 +73,11 @@ def create_error_response(status_code, error_message):
     }
 
 
-# --- メインの処理関数 ---
-def handler(event, context):
-    try:
-        body = json.loads(event["body"])
-        lecture_text = body["lecture_text"]
-        num_questions = body.get("num_questions", 5)
-        difficulty = body.get("difficulty", "中")
-        theme = body.get("theme", "未分類")  # テーマがなければ「未分類」に
-        lecture_number = body.get("lecture_number")  # lecture_numberはオプション
-    except Exception as e:
-        return create_error_response(400, f"リクエストの解析に失敗しました: {str(e)}")
-
+def build_request_body(lecture_text, num_questions, difficulty, exclude_questions=()):
+    exclude_rule = ""
+    if exclude_questions:
+        listed = "\n".join(f"  - {q}" for q in exclude_questions)
+        exclude_rule = f"- 次の問題とは異なる内容の問題にすること。\n{listed}\n"
     system_prompt = f"""
 あなたは、講義内容から学習者の理解度を測るための問題を作成する専門家です。
 以下のルールに従って、与えられた講義内容から質の高いQAセットを作成してください。
@@ -77,7 +88,7 @@ def handler(event, context):
 - 回答には、なぜそれが正解なのかの短い解説を必ず含めること。
 - 「記述式」問題の場合、採点に使うための最も重要な「キーワード」を3〜5個、`scoring_keywords`のリストとして必ず生成すること。
 - 「記述式」問題の`correct_answer`は、要点を押さえた50字程度の簡潔な文章にすること。
-- 出力は必ず指定されたJSON形式のみとし、前後に余計な文章は含めないこと。
+{exclude_rule}- 出力は必ず指定されたJSON形式のみとし、前後に余計な文章は含めないこと。
 
 # JSON形式の例
 {{
@@ -107,7 +118,7 @@ def handler(event, context):
 """
 
     user_prompt = f"--- 講義内容 ---\n{lecture_text}"
-    request_body = {
+    return {
         "schemaVersion": "messages-v1",
         "system": [{"text": system_prompt}],
         "messages": [{"role": "user", "content": [{"text": user_prompt}]}],
@@ -119,39 +130,62 @@ def handler(event, context):
         },
     }
 
-    try:
-        response = bedrock_runtime.invoke_model(
-            body=json.dumps(request_body), modelId=MODEL_ID
-        )
-        response_body = json.loads(response.get("body").read())
-        qa_result_text = (
-            response_body.get("output", {})
-            .get("message", {})
-            .get("content", [{}])[0]
-            .get("text")
-        )
 
-        if not qa_result_text:
-            raise Exception("モデルの応答からテキストを抽出できませんでした。")
+def invoke_model_text(request_body, num_questions):
+    if GENERATION_MODE == "stream":
+        return stream_model_text(bedrock_runtime, MODEL_ID, request_body, num_questions)
+    response = bedrock_runtime.invoke_model(
+        body=json.dumps(request_body), modelId=MODEL_ID
+    )
+    response_body = json.loads(response.get("body").read())
+    qa_result_text = (
+        response_body.get("output", {})
+        .get("message", {})
+        .get("content", [{}])[0]
+        .get("text")
+    )
 
-        start_index = qa_result_text.find("{")
-        end_index = qa_result_text.rfind("}")
-        if start_index == -1 or end_index == -1 or end_index < start_index:
-            raise ValueError(
-                "モデルの応答から有効なJSONブロックを見つけられませんでした。"
-            )
+    if not qa_result_text:
+        raise Exception("モデルの応答からテキストを抽出できませんでした。")
+    return qa_result_text
 
-        json_string = qa_result_text[start_index : end_index + 1]
 
-        try:
-            qa_result_json = json.loads(json_string)
-        except json.JSONDecodeError as e:
-            if "Extra data" in str(e):
-                array_json_string = f"[{json_string}]"
-                parsed_list = json.loads(array_json_string)
-                qa_result_json = {"qa_set": parsed_list}
-            else:
-                raise e
+# --- メインの処理関数 ---
+@instrument_handler
+def handler(event, context):
+    try:
+        body = json.loads(event["body"])
+        lecture_text = body["lecture_text"]
+        num_questions = body.get("num_questions", 5)
+        difficulty = body.get("difficulty", "中")
+        theme = body.get("theme", "未分類")  # テーマがなければ「未分類」に
+        lecture_number = body.get("lecture_number")  # lecture_numberはオプション
+        # キャッシュ制御: use（既定）/ refresh（再生成して上書き）/ bypass（使わない）
+        cache_mode = body.get("cache", GENERATION_CACHE_MODE)
+        if cache_mode not in CACHE_MODES:
+            raise ValueError(f"cacheには{CACHE_MODES}のいずれかを指定してください")
+    except Exception as e:
+        return create_error_response(400, f"リクエストの解析に失敗しました: {str(e)}")
+
+    def generate_text(count, exclude_questions):
+        request_body = build_request_body(
+            lecture_text, count, difficulty, exclude_questions
+        )
+        if generation_cache is None:
+            return invoke_model_text(request_body, count)
+        return generation_cache.get_or_generate(
+            MODEL_ID,
+            request_body,
+            lambda: invoke_model_text(request_body, count),
+            mode=cache_mode,
+        )
+
+    try:
+        # 壊れた出力や途中で途切れた出力からも問題を回収し、不足分だけを再生成する
+        qa_result_json = collect_questions(
+            generate_text, num_questions, max_retries=SALVAGE_RETRY_LIMIT
+        )
+        add_metric("QuestionsGenerated", len(qa_result_json.get("qa_set", [])))
 
         if table:
             try:
@@ -162,13 +196,18 @@ def handler(event, context):
                     "lecture_text_head": lecture_text[:200],
                     "created_at": context.aws_request_id,
                     "theme": theme,
+                    # 一覧のサマリー表示用にqa_dataを読まずに済むよう問題数を保持
+                    "question_count": len(qa_result_json.get("qa_set", [])),
+                    # 採点キーのキャッシュ検証とETagに使う版数・更新日時
+                    "version": 1,
+                    "updated_at": datetime.utcnow().isoformat(),
                 }
                 # lecture_numberが指定されている場合のみ項目を追加
                 if lecture_number is not None:
                     item_to_save["lecture_number"] = lecture_number
 
-                item_to_save_decimal = replace_floats_with_decimals(item_to_save)
-                table.put_item(Item=item_to_save_decimal)
+                # floatはそのまま書き込めるので、Decimalに変換したコピーは作らない
+                table.put_item(Item=item_to_save)
                 print(f"Successfully saved QA set to DynamoDB with id: {qa_set_id}")
             except Exception as e:
                 print(f"ERROR: Failed to save to DynamoDB. {traceback.format_exc()}")
@@ -176,6 +215,18 @@ def handler(event, context):
 
         return create_success_response(qa_result_json)
 
+    except BedrockUnavailable as e:
+        # 同期APIのためキューには回さず、時間をおいて再試行するようクライアントに返す
+        response = create_error_response(
+            503, "生成モデルが混雑しています。しばらくしてから再試行してください。"
+        )
+        response["headers"]["Retry-After"] = str(math.ceil(e.retry_after))
+        return response
+
     except Exception as e:
         print(f"ERROR: An unexpected error occurred. {traceback.format_exc()}")
         return create_error_response(500, f"予期せぬエラーが発生しました: {str(e)}")
+
+    finally:
+        if generation_cache is not None:
+            generation_cache.emit_metrics(context.function_name)
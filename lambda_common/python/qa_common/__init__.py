@@ -0,0 +1 @@
+# Lambda Layer (lambda_common) として各Lambdaから共有されるモジュール群
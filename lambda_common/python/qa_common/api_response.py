@@ -0,0 +1,122 @@
+# qa_common/api_response.py
+# API GatewayのLambdaプロキシ統合向けに、ETagによる条件付きGETと
+# gzip圧縮したレスポンスを作る
+import base64
+import gzip
+import hashlib
+import json
+import os
+
+from qa_common.codec import dumps
+
+# この長さ（バイト）以上の本文をLambda側でgzip圧縮する
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+# API Gatewayのbinary_media_typesと合わせる。クライアントのAcceptの先頭がこれに
+# 一致する場合だけ、API Gatewayがbase64を復号してバイナリとして返す
+BINARY_MEDIA_TYPES = ("application/json",)
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Expose-Headers": "ETag",
+}
+
+
+def get_header(event, name):
+    """ヘッダーを大文字小文字を区別せずに取得する"""
+    name = name.lower()
+    for key, value in (event.get("headers") or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def json_body(event):
+    """リクエストボディをJSONとして読む。binary_media_typesに一致したボディは
+    base64で届くので復号してから読む"""
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    return json.loads(body)
+
+
+def compute_etag(*parts):
+    """版数や更新日時などから弱いETagを作る。圧縮の有無で本文のバイト列は変わるため、
+    強いETagではなく弱いETagとする"""
+    digest = hashlib.sha256(
+        json.dumps(parts, separators=(",", ":"), default=str).encode("utf-8")
+    ).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def item_version(item):
+    """ETagの材料にする版数と更新日時（updated_at導入前の項目はcreated_at）"""
+    return (
+        item.get("qa_set_id"),
+        item.get("version"),
+        item.get("updated_at") or item.get("created_at"),
+    )
+
+
+def _opaque_tag(tag):
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def is_not_modified(event, etag):
+    """If-None-MatchがETagに一致するか（弱い比較）を判定する"""
+    header = get_header(event, "If-None-Match")
+    if not header or not etag:
+        return False
+    if header.strip() == "*":
+        return True
+    return _opaque_tag(etag) in {_opaque_tag(tag) for tag in header.split(",")}
+
+
+def _accepts_gzip(event):
+    encodings = get_header(event, "Accept-Encoding") or ""
+    for encoding in encodings.split(","):
+        name, _, params = encoding.strip().partition(";")
+        if name.strip().lower() == "gzip":
+            return params.replace(" ", "") != "q=0"
+    return False
+
+
+def _accepts_binary(event):
+    accept = (get_header(event, "Accept") or "").split(",")[0]
+    return accept.split(";")[0].strip().lower() in BINARY_MEDIA_TYPES
+
+
+def not_modified_response(etag):
+    return {
+        "statusCode": 304,
+        "headers": {**CORS_HEADERS, "ETag": etag},
+        "body": "",
+    }
+
+
+def json_response(event, body, status_code=200, etag=None):
+    """本文をJSONにし、クライアントが対応していれば大きな本文をgzip圧縮して返す"""
+    payload = dumps(body)
+    headers = {
+        "Content-Type": "application/json",
+        "Vary": "Accept, Accept-Encoding",
+        **CORS_HEADERS,
+    }
+    if etag:
+        headers["ETag"] = etag
+    response = {"statusCode": status_code, "headers": headers}
+
+    encoded = payload.encode("utf-8")
+    if (
+        len(encoded) >= COMPRESSION_MIN_BYTES
+        and _accepts_gzip(event)
+        and _accepts_binary(event)
+    ):
+        headers["Content-Encoding"] = "gzip"
+        response["body"] = base64.b64encode(
+            gzip.compress(encoded, compresslevel=6)
+        ).decode("ascii")
+        response["isBase64Encoded"] = True
+    else:
+        response["body"] = payload
+    return response
@@ -0,0 +1,369 @@
+# qa_common/bedrock_client.py
+# Bedrock呼び出しのスロットリング対策
+#   - AIMD方式で同時実行数を自動調整する
+#   - スロットリング時はジッター付きの指数バックオフで再試行する
+#   - 1分あたりのトークン数（TPM）の予算内に収まるよう呼び出しを待たせる
+#   - 再試行しても通らない状態が続いたらサーキットブレーカーを開き、処理を後回しにさせる
+# boto3クライアントと同じ invoke_model / invoke_model_with_response_stream を提供するので、
+# 呼び出し側のコードはそのまま差し替えて使える。状態はLambdaコンテナ内で共有される
+import json
+import random
+import threading
+import time
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+from qa_common.metrics import recorder, record_bedrock_usage
+
+# ストリーム中のエラーは先頭が小文字のコードで届くため、小文字で比較する
+THROTTLING_ERROR_CODES = {
+    "throttlingexception",
+    "toomanyrequestsexception",
+    "servicequotaexceededexception",
+    "serviceunavailableexception",
+    "modelnotreadyexception",
+}
+
+
+def is_throttling_error(error):
+    return (
+        isinstance(error, ClientError)
+        and error.response.get("Error", {}).get("Code", "").lower()
+        in THROTTLING_ERROR_CODES
+    )
+
+
+class BedrockUnavailable(Exception):
+    """ブレーカーが開いている、またはトークン予算が空かない。呼び出し側は
+    retry_after 秒以上経ってから処理をやり直す"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdaptiveConcurrency:
+    """成功するたびに上限を少しずつ増やし（加算増加）、スロットリングされたら半分にする
+    （乗算減少）。同時に起きた複数のスロットリングで何度も下げないよう、減少には間隔を置く"""
+
+    def __init__(self, max_limit, min_limit=1, decrease_ratio=0.5, cooldown=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_ratio = decrease_ratio
+        self.cooldown = cooldown
+        self.limit = float(max_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= max(self.min_limit, int(self.limit)):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_ratio)
+                    self._last_decrease = now
+            else:
+                # 上限分の呼び出しが成功するごとに、おおよそ1ずつ増える
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class TokenBudget:
+    """直近60秒間に使ったトークン数を記録し、1分あたりの上限を超えないよう待たせる。
+    呼び出し前に見積もりで予約し、応答の使用量で精算する"""
+
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self._entries = deque()  # [予約時刻, トークン数]
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._entries and now - self._entries[0][0] >= self.WINDOW_SECONDS:
+            self._used -= self._entries.popleft()[1]
+
+    def reserve(self, tokens, max_wait):
+        """予約できたら予約を返す。max_wait秒以内に空かなければBedrockUnavailable"""
+        if not self.tokens_per_minute:
+            return None
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._expire(now)
+                # 1件で予算を超える見積もりでも、窓が空なら通す
+                if self._used + tokens <= self.tokens_per_minute or not self._entries:
+                    entry = [now, tokens]
+                    self._entries.append(entry)
+                    self._used += tokens
+                    return entry
+                wait = self._entries[0][0] + self.WINDOW_SECONDS - now
+            if now + wait > deadline:
+                raise BedrockUnavailable("Token budget is exhausted.", wait)
+            time.sleep(min(wait, 1.0))
+
+    def settle(self, entry, actual_tokens):
+        if entry is None or actual_tokens is None:
+            return
+        with self._lock:
+            if entry in self._entries:
+                self._used += actual_tokens - entry[1]
+            entry[1] = actual_tokens
+
+
+class CircuitBreaker:
+    """再試行を使い切った呼び出しが続いたら開き、reset_seconds後に1件だけ試す"""
+
+    def __init__(self, failure_threshold=3, reset_seconds=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._probe_owner = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing:
+                return False
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._probing = True
+                self._probe_owner = threading.get_ident()
+                return True
+            return False
+
+    def abandon_probe(self):
+        """成否を記録せずに終わった試行（スロットリング以外のエラーなど）を取り消し、
+        次の呼び出しが改めて試せるようにする。試行中のスレッド以外からは何もしない"""
+        with self._lock:
+            if self._probing and self._probe_owner == threading.get_ident():
+                self._probing = False
+                self._probe_owner = None
+
+    def retry_after(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            elapsed = time.monotonic() - self._opened_at
+            return max(1.0, self.reset_seconds - elapsed)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+            self._probe_owner = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self._probe_owner = None
+
+
+def estimate_request_tokens(request_body, chars_per_token=1.0):
+    """プロンプトの文字数と最大出力トークン数から、消費トークン数を多めに見積もる"""
+    chars = sum(len(part.get("text", "")) for part in request_body.get("system", []))
+    for message in request_body.get("messages", []):
+        chars += sum(len(part.get("text", "")) for part in message.get("content", []))
+    max_tokens = request_body.get("inferenceConfig", {}).get("maxTokens", 0)
+    return int(chars / chars_per_token) + max_tokens
+
+
+def _usage_tokens(usage):
+    if not usage:
+        return None
+    return sum(
+        int(usage.get(k, 0))
+        for k in ("inputTokens", "outputTokens", "inputTokenCount", "outputTokenCount")
+    )
+
+
+class _BufferedBody:
+    """読み終えた応答本文を、StreamingBodyと同じread()で返す"""
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def read(self, *args):
+        payload, self._payload = self._payload, b""
+        return payload
+
+
+class _ManagedStream:
+    """ストリームを読み終えるか閉じた時点で同時実行枠を返し、トークン使用量を精算する。
+    受信の途中でスロットリングされた場合は、途中まで渡した出力をやり直せないので
+    再試行せず、on_throttled が返すBedrockUnavailableを送出する"""
+
+    def __init__(self, stream, on_done, on_throttled):
+        self._stream = stream
+        self._on_done = on_done
+        self._on_throttled = on_throttled
+        self._usage = None
+        self._throttled = False
+        self._done = False
+        self._started = time.perf_counter()
+
+    def __iter__(self):
+        try:
+            for event in self._stream:
+                payload = event.get("chunk", {}).get("bytes", b"")
+                if b"usage" in payload or b"invocationMetrics" in payload:
+                    body = json.loads(payload)
+                    self._usage = body.get("metadata", {}).get("usage") or body.get(
+                        "amazon-bedrock-invocationMetrics"
+                    )
+                yield event
+        except ClientError as e:
+            # ストリーム中のエラーはEventStreamError（ClientErrorの派生）として届く
+            if not is_throttling_error(e):
+                raise
+            self._throttled = True
+            self._finish()
+            raise self._on_throttled() from e
+        finally:
+            self._finish()
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            # after-callのフックが計るのは応答ヘッダーまでなので、本文の受信を別に記録する
+            recorder.observe(
+                "bedrock-runtime.ResponseStream",
+                "Latency",
+                (time.perf_counter() - self._started) * 1000,
+            )
+            record_bedrock_usage(self._usage)
+            self._on_done(_usage_tokens(self._usage), self._throttled)
+
+
+class ThrottleAwareBedrock:
+    def __init__(
+        self,
+        client,
+        max_concurrency=4,
+        tokens_per_minute=0,
+        max_retries=5,
+        base_delay=0.5,
+        max_delay=20.0,
+        max_budget_wait=30.0,
+        chars_per_token=1.0,
+        breaker=None,
+    ):
+        self.client = client
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.budget = TokenBudget(tokens_per_minute)
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_budget_wait = max_budget_wait
+        self.chars_per_token = chars_per_token
+
+    def _backoff(self, attempt):
+        # フルジッター: 0〜上限の一様乱数だけ待ち、再試行のタイミングを分散させる
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _call(self, body, call):
+        """同時実行枠を確保して呼び出す。成功時は枠を確保したまま結果と予約を返す"""
+        if not self.breaker.allow():
+            raise BedrockUnavailable(
+                "Bedrock circuit breaker is open.", self.breaker.retry_after()
+            )
+        recorded = False
+        try:
+            estimate = estimate_request_tokens(json.loads(body), self.chars_per_token)
+            reservation = self.budget.reserve(estimate, self.max_budget_wait)
+
+            for attempt in range(self.max_retries + 1):
+                self.concurrency.acquire()
+                try:
+                    result = call()
+                except Exception as e:
+                    throttled = is_throttling_error(e)
+                    self.concurrency.release(throttled=throttled)
+                    if not throttled:
+                        raise
+                    if attempt < self.max_retries:
+                        delay = self._backoff(attempt)
+                        print(
+                            f"Bedrock throttled (attempt {attempt + 1}). Retry in {delay:.2f}s"
+                        )
+                        time.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                recorded = True
+                return result, reservation
+
+            self.breaker.record_failure()
+            recorded = True
+            raise BedrockUnavailable(
+                "Bedrock kept throttling after retries.",
+                max(self.breaker.retry_after(), self.max_delay),
+            )
+        finally:
+            # 半開状態の試行が成否を記録せずに終わると、ブレーカーが開いたまま戻らなくなる
+            if not recorded:
+                self.breaker.abandon_probe()
+
+    def invoke_model(self, body, modelId, **kwargs):
+        def call():
+            response = self.client.invoke_model(body=body, modelId=modelId, **kwargs)
+            return response, response["body"].read()
+
+        (response, payload), reservation = self._call(body, call)
+        self.concurrency.release()
+        try:
+            usage = json.loads(payload).get("usage")
+        except ValueError:
+            usage = None
+        record_bedrock_usage(usage)
+        self.budget.settle(reservation, _usage_tokens(usage))
+        return {**response, "body": _BufferedBody(payload)}
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        def call():
+            return self.client.invoke_model_with_response_stream(
+                body=body, modelId=modelId, **kwargs
+            )
+
+        response, reservation = self._call(body, call)
+
+        def on_done(usage_tokens, throttled):
+            self.concurrency.release(throttled=throttled)
+            self.budget.settle(reservation, usage_tokens)
+            if throttled:
+                self.breaker.record_failure()
+
+        def on_throttled():
+            return BedrockUnavailable(
+                "Bedrock throttled the response stream.",
+                max(self.breaker.retry_after(), self.max_delay),
+            )
+
+        return {
+            **response,
+            "body": _ManagedStream(response["body"], on_done, on_throttled),
+        }
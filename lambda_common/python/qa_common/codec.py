@@ -0,0 +1,181 @@
+# qa_common/codec.py
+# DynamoDBの項目とJSONレスポンスの変換を1か所にまとめる
+# boto3のresourceは数値を全てDecimalに変換するため、各Lambdaが独自のDecimalEncoderと
+# float→Decimalの再帰変換を持ち、書き込みとレスポンスのたびに項目全体を作り直していた。
+# ここでは低レベルクライアントの応答を直接 int / float に変換し、floatもそのまま書き込む
+import json
+import math
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+# ExpressionAttributeValues以外で項目（属性名→値）を渡すリクエストパラメータ
+_ITEM_PARAMS = ("Key", "Item", "ExclusiveStartKey")
+_CONDITION_PARAMS = (
+    "KeyConditionExpression",
+    "FilterExpression",
+    "ConditionExpression",
+)
+# 応答のうち項目として変換するフィールド
+_ITEM_FIELDS = ("Item", "Attributes", "LastEvaluatedKey")
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class NumberDeserializer(TypeDeserializer):
+    """数値をDecimalではなくint/floatに変換する。型ごとの処理は辞書で引き、
+    Map/Listは再帰呼び出しを減らすためループ内で展開する"""
+
+    def __init__(self):
+        self._dispatch = {
+            "S": str,
+            "N": _number,
+            "BOOL": bool,
+            "NULL": lambda value: None,
+            "M": self._deserialize_m,
+            "L": self._deserialize_l,
+            "SS": set,
+            "NS": lambda value: set(map(_number, value)),
+            "B": self._deserialize_b,
+            "BS": self._deserialize_bs,
+        }
+
+    def deserialize(self, value):
+        for dynamodb_type, data in value.items():
+            return self._dispatch[dynamodb_type](data)
+        raise TypeError("Value must be a nonempty dictionary")
+
+    def _deserialize_m(self, value):
+        dispatch = self._dispatch
+        result = {}
+        for key, attribute in value.items():
+            for dynamodb_type, data in attribute.items():
+                result[key] = dispatch[dynamodb_type](data)
+        return result
+
+    def _deserialize_l(self, value):
+        dispatch = self._dispatch
+        return [
+            dispatch[dynamodb_type](data)
+            for attribute in value
+            for dynamodb_type, data in attribute.items()
+        ]
+
+
+class FloatSerializer(TypeSerializer):
+    """floatをDecimalに変換せずにそのまま数値として書き込めるようにする"""
+
+    def _is_number(self, value):
+        if isinstance(value, float):
+            return True
+        return super()._is_number(value)
+
+    def _serialize_n(self, value):
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                raise TypeError(f"Cannot store non-finite number: {value}")
+            # reprは元のfloatに戻せる最短の表記になる
+            return repr(value)
+        return super()._serialize_n(value)
+
+
+_deserializer = NumberDeserializer()
+_serializer = FloatSerializer()
+
+
+def deserialize_item(item):
+    return _deserializer._deserialize_m(item)
+
+
+def serialize_item(item):
+    return {key: _serializer.serialize(value) for key, value in item.items()}
+
+
+def serialize_request(params):
+    """resourceと同じ形式のパラメータ（Python値・条件オブジェクト）を
+    低レベルクライアントの形式に変換する"""
+    params = dict(params)
+    names = dict(params.pop("ExpressionAttributeNames", None) or {})
+    values = dict(params.pop("ExpressionAttributeValues", None) or {})
+    builder = ConditionExpressionBuilder()
+    for name in _CONDITION_PARAMS:
+        condition = params.get(name)
+        if isinstance(condition, ConditionBase):
+            built = builder.build_expression(
+                condition, is_key_condition=name == "KeyConditionExpression"
+            )
+            params[name] = built.condition_expression
+            names.update(built.attribute_name_placeholders)
+            values.update(built.attribute_value_placeholders)
+    if names:
+        params["ExpressionAttributeNames"] = names
+    if values:
+        params["ExpressionAttributeValues"] = serialize_item(values)
+    for name in _ITEM_PARAMS:
+        if name in params:
+            params[name] = serialize_item(params[name])
+    return params
+
+
+def deserialize_response(response):
+    for name in _ITEM_FIELDS:
+        if name in response:
+            response[name] = deserialize_item(response[name])
+    if "Items" in response:
+        response["Items"] = [deserialize_item(item) for item in response["Items"]]
+    return response
+
+
+class DynamoTable:
+    """低レベルクライアントで1つのテーブルを扱う。引数と戻り値の形はresourceの
+    Tableと同じだが、数値はint/floatで返し、floatもそのまま書き込める"""
+
+    def __init__(self, table_name, client=None):
+        self.name = table_name
+        self.client = client or boto3.client("dynamodb")
+
+    def _call(self, operation, params):
+        response = getattr(self.client, operation)(
+            TableName=self.name, **serialize_request(params)
+        )
+        return deserialize_response(response)
+
+    def get_item(self, **params):
+        return self._call("get_item", params)
+
+    def put_item(self, **params):
+        return self._call("put_item", params)
+
+    def update_item(self, **params):
+        return self._call("update_item", params)
+
+    def delete_item(self, **params):
+        return self._call("delete_item", params)
+
+    def query(self, **params):
+        return self._call("query", params)
+
+    def scan(self, **params):
+        return self._call("scan", params)
+
+
+def _default(obj):
+    # resource経由で読んだ値や集合型が混ざっていても変換できるようにする
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+def dumps(body):
+    """レスポンス本文のJSONを作る。int/floatだけの項目ではdefaultが呼ばれず、
+    C実装のエンコーダーだけで変換が完結する"""
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":"), default=_default)
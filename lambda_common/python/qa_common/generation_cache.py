@@ -0,0 +1,146 @@
+# qa_common/generation_cache.py
+# Bedrockの生成結果を、リクエスト内容のハッシュ（フィンガープリント）をキーに永続化する
+import hashlib
+import json
+import threading
+import time
+
+import boto3
+
+from qa_common.metrics import put_emf
+
+# キャッシュの動作モード
+#   use:     ヒットすればキャッシュを返し、ミスなら生成して保存する
+#   refresh: キャッシュを読まずに生成し、結果で上書きする
+#   bypass:  キャッシュを読みも書きもしない
+CACHE_MODES = ("use", "refresh", "bypass")
+
+# DynamoDBの項目サイズ上限(400KB)に余裕を持たせ、これを超える出力はS3に置く
+INLINE_LIMIT_BYTES = 350_000
+
+
+def fingerprint(model_id, request_body):
+    """モデルID・システムプロンプト・ユーザープロンプト・推論設定からキーを作る"""
+    canonical = json.dumps(
+        {
+            "model_id": model_id,
+            "system": request_body.get("system"),
+            "messages": request_body.get("messages"),
+            "inference_config": request_body.get("inferenceConfig"),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    def __init__(
+        self,
+        table_name,
+        bucket_name=None,
+        prefix="generation-cache/",
+        ttl_seconds=30 * 24 * 3600,
+    ):
+        self.table = boto3.resource("dynamodb").Table(table_name)
+        self.s3_client = boto3.client("s3") if bucket_name else None
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "bypass": 0}
+
+    def _count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def get(self, cache_key):
+        item = self.table.get_item(Key={"cache_key": cache_key}).get("Item")
+        if not item or int(item.get("expires_at", 0)) < time.time():
+            return None
+        if "output_text" in item:
+            return item["output_text"]
+        if item.get("s3_key") and self.s3_client:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=item["s3_key"]
+            )
+            return response["Body"].read().decode("utf-8")
+        return None
+
+    def put(self, cache_key, model_id, output_text):
+        encoded = output_text.encode("utf-8")
+        item = {
+            "cache_key": cache_key,
+            "model_id": model_id,
+            "size_bytes": len(encoded),
+            "created_at": int(time.time()),
+            "expires_at": int(time.time()) + self.ttl_seconds,
+        }
+        if len(encoded) <= INLINE_LIMIT_BYTES:
+            item["output_text"] = output_text
+        elif self.s3_client:
+            item["s3_key"] = f"{self.prefix}{cache_key}.txt"
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=item["s3_key"],
+                Body=encoded,
+                ContentType="text/plain; charset=utf-8",
+            )
+        else:
+            print(f"Generation output too large to cache inline: {len(encoded)} bytes")
+            return
+        self.table.put_item(Item=item)
+
+    def get_or_generate(
+        self, model_id, request_body, generate, mode="use", is_usable=None
+    ):
+        """キャッシュを確認し、必要な場合のみgenerate()を呼んでモデル出力テキストを返す。
+        is_usableを指定した場合は、is_usable(出力)が真の出力だけをキャッシュに保存する"""
+        if mode not in CACHE_MODES:
+            raise ValueError(f"cache mode must be one of {CACHE_MODES}: {mode}")
+        if mode == "bypass":
+            self._count("bypass")
+            return generate()
+
+        cache_key = fingerprint(model_id, request_body)
+        if mode == "use":
+            try:
+                cached = self.get(cache_key)
+            except Exception as e:
+                # キャッシュ障害で生成自体を失敗させない
+                print(f"WARNING: generation cache read failed: {e}")
+                cached = None
+            if cached is not None:
+                self._count("hit")
+                return cached
+
+        self._count("miss")
+        output_text = generate()
+        if is_usable is not None and not is_usable(output_text):
+            # 使えない出力を保存すると、同じリクエストで毎回それを返してしまう
+            print("Generation output is not usable. Skipping cache write.")
+            return output_text
+        try:
+            self.put(cache_key, model_id, output_text)
+        except Exception as e:
+            print(f"WARNING: generation cache write failed: {e}")
+        return output_text
+
+    def emit_metrics(self, function_name):
+        """ヒット率をCloudWatch Embedded Metric Format (EMF) のログ行として出力する"""
+        with self._lock:
+            stats = dict(self.stats)
+            self.stats = {"hit": 0, "miss": 0, "bypass": 0}
+        lookups = stats["hit"] + stats["miss"]
+        values = {
+            "GenerationCacheHit": stats["hit"],
+            "GenerationCacheMiss": stats["miss"],
+            "GenerationCacheBypass": stats["bypass"],
+        }
+        units = {name: "Count" for name in values}
+        # 参照が無かった呼び出しではヒット率を記録しない
+        if lookups:
+            values["GenerationCacheHitRate"] = stats["hit"] / lookups * 100
+            units["GenerationCacheHitRate"] = "Percent"
+        put_emf({"FunctionName": function_name}, values, units)
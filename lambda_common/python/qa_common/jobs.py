@@ -0,0 +1,181 @@
+# qa_common/jobs.py
+# アップロードされたPDFごとの処理状況（ジョブ）を記録する
+# ジョブIDはアップロード先のキー uploads/<ジョブID>-<ファイル名> に含まれるので、
+# S3イベントやTextractの通知しか受け取らない後段のLambdaでもキーから特定できる
+import re
+import time
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+from qa_common.codec import DynamoTable
+
+UPLOAD_PREFIX = "uploads/"
+_JOB_KEY = re.compile(
+    re.escape(UPLOAD_PREFIX)
+    + r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})-"
+)
+
+# ジョブの状態
+WAITING_FOR_UPLOAD = "waiting_for_upload"
+UPLOADED = "uploaded"
+OCR_RUNNING = "ocr_running"
+GENERATING = "generating"
+DEFERRED = "deferred"
+COMPLETED = "completed"
+FAILED = "failed"
+TERMINAL_STATES = (COMPLETED, FAILED)
+# 状態は後戻りさせない。同じ順位の状態どうし（生成中・待機中・失敗）は行き来できるので、
+# 失敗したメッセージが再試行されれば生成中に戻る。完了からはどこにも移らない
+_STATE_RANK = {
+    WAITING_FOR_UPLOAD: 0,
+    UPLOADED: 1,
+    OCR_RUNNING: 2,
+    GENERATING: 3,
+    DEFERRED: 3,
+    FAILED: 3,
+    COMPLETED: 4,
+}
+
+# 段階ごとの時刻の項目（この順に進む）
+STAGE_TIMESTAMPS = (
+    "created_at",
+    "uploaded_at",
+    "ocr_started_at",
+    "ocr_completed_at",
+    "llm_started_at",
+    "llm_completed_at",
+    "persisted_at",
+)
+# 所要時間として返す区間: 名前 -> (開始, 終了)
+STAGE_DURATIONS = {
+    "upload": ("created_at", "uploaded_at"),
+    "ocr": ("ocr_started_at", "ocr_completed_at"),
+    "llm": ("llm_started_at", "llm_completed_at"),
+    "persist": ("llm_completed_at", "persisted_at"),
+    "total": ("uploaded_at", "persisted_at"),
+}
+
+
+def job_id_from_key(key):
+    """アップロード先のキーからジョブIDを取り出す。ジョブの無いキーならNone"""
+    match = _JOB_KEY.match(key or "")
+    return match.group(1) if match else None
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def stage_durations(job):
+    """記録された時刻から段階ごとの所要時間（秒）を計算する"""
+    durations = {}
+    for name, (start, end) in STAGE_DURATIONS.items():
+        if job.get(start) and job.get(end):
+            delta = datetime.fromisoformat(job[end]) - datetime.fromisoformat(
+                job[start]
+            )
+            durations[name] = round(delta.total_seconds(), 3)
+    return durations
+
+
+class JobTracker:
+    """ジョブ項目の作成と状態の更新を行う。各段階の時刻は最初に記録した値を残すので、
+    通知の重複や再試行で同じ段階を何度通っても開始時刻は変わらない。
+    遅れて届いた通知で状態を後戻りさせることはなく、その場合も時刻だけは記録する"""
+
+    def __init__(self, table_name, ttl_days=14):
+        self.table = DynamoTable(table_name)
+        self.ttl_seconds = ttl_days * 24 * 3600
+
+    def create(self, job_id, **attributes):
+        now = utc_now()
+        self.table.put_item(
+            Item={
+                "job_id": job_id,
+                "state": WAITING_FOR_UPLOAD,
+                "created_at": now,
+                "updated_at": now,
+                "expires_at": int(time.time()) + self.ttl_seconds,
+                **attributes,
+            }
+        )
+
+    def mark(self, job_id, state, stamps=(), at=None, **attributes):
+        """状態を更新し、stampsに挙げた段階の時刻をまだ無ければ記録する。
+        ジョブが無い（このAPIを経由しないアップロード）か、状態を進められなければFalseを返す"""
+        if not job_id:
+            return False
+        now = utc_now()
+        names = {"#state": "state", "#updated_at": "updated_at"}
+        values = {":now": now}
+        stamp_assignments = []
+        for i, stamp in enumerate(stamps):
+            names[f"#t{i}"] = stamp
+            values[f":t{i}"] = at or now
+            stamp_assignments.append(f"#t{i} = if_not_exists(#t{i}, :t{i})")
+
+        # 移る前の状態として許すもの（順位が同じか低い状態。完了からはどこにも移らない）
+        sources = [
+            s
+            for s, rank in _STATE_RANK.items()
+            if rank <= _STATE_RANK[state] and s != COMPLETED
+        ]
+        state_values = {f":s{i}": s for i, s in enumerate(sources)}
+        assignments = ["#state = :state", "#updated_at = :now", *stamp_assignments]
+        attribute_names = {}
+        attribute_values = {}
+        for i, (name, value) in enumerate(attributes.items()):
+            attribute_names[f"#a{i}"] = name
+            attribute_values[f":a{i}"] = value
+            assignments.append(f"#a{i} = :a{i}")
+        try:
+            self.table.update_item(
+                Key={"job_id": job_id},
+                UpdateExpression="SET " + ", ".join(assignments),
+                ConditionExpression="attribute_exists(job_id) AND #state IN ("
+                + ", ".join(state_values)
+                + ")",
+                ExpressionAttributeNames={**names, **attribute_names},
+                ExpressionAttributeValues={
+                    **values,
+                    ":state": state,
+                    **state_values,
+                    **attribute_values,
+                },
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        # 後続の段階が先に記録されていた（通知の到着順が前後した）場合も、時刻は残す
+        if stamp_assignments:
+            try:
+                self.table.update_item(
+                    Key={"job_id": job_id},
+                    UpdateExpression="SET " + ", ".join(stamp_assignments),
+                    ConditionExpression="attribute_exists(job_id)",
+                    ExpressionAttributeNames={
+                        k: v for k, v in names.items() if k.startswith("#t")
+                    },
+                    ExpressionAttributeValues={
+                        k: v for k, v in values.items() if k.startswith(":t")
+                    },
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        return False
+
+    def safe_mark(self, job_id, state, stamps=(), at=None, **attributes):
+        """ジョブの記録に失敗しても、本来の処理は止めない"""
+        try:
+            return self.mark(job_id, state, stamps, at, **attributes)
+        except Exception as e:
+            print(f"WARNING: failed to record job {job_id} as {state}: {e}")
+            return False
+
+    def get(self, job_id, consistent=True):
+        return self.table.get_item(
+            Key={"job_id": job_id}, ConsistentRead=consistent
+        ).get("Item")
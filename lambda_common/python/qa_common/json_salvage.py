@@ -0,0 +1,107 @@
+# qa_common/json_salvage.py
+# モデル出力から整形式の問題オブジェクトを可能な限り回収する
+import json
+import unicodedata
+
+# 問題として扱うために最低限必要な項目
+REQUIRED_QUESTION_KEYS = ("question", "type", "correct_answer")
+
+_decoder = json.JSONDecoder()
+
+
+def is_valid_question(obj):
+    return isinstance(obj, dict) and all(obj.get(k) for k in REQUIRED_QUESTION_KEYS)
+
+
+def question_fingerprint(qa):
+    """重複判定用に問題文を正規化する"""
+    text = unicodedata.normalize("NFKC", str(qa.get("question", ""))).casefold()
+    return "".join(text.split())
+
+
+def salvage_qa_set(text, num_questions=None):
+    """raw_decodeで"{"の位置から順にデコードを試み、1パスで問題を回収する。
+
+    全体が {"qa_set": [...]} として読めればそれを使い、前後の余計な文章や
+    途中で途切れた末尾があっても、閉じている問題オブジェクトは全て拾う。
+    戻り値は {"qa_set": [...], "missing": 不足数, "diagnostics": {...}}
+    """
+    questions = []
+    seen = set()
+    diagnostics = {
+        "decoded_objects": 0,
+        "decode_errors": 0,
+        "invalid_objects": 0,
+        "duplicates": 0,
+        "complete_document": False,
+    }
+
+    def collect(obj):
+        if isinstance(obj, dict) and isinstance(obj.get("qa_set"), list):
+            diagnostics["complete_document"] = True
+            for item in obj["qa_set"]:
+                collect(item)
+            return
+        if isinstance(obj, list):
+            for item in obj:
+                collect(item)
+            return
+        if not is_valid_question(obj):
+            diagnostics["invalid_objects"] += 1
+            return
+        fingerprint = question_fingerprint(obj)
+        if fingerprint in seen:
+            diagnostics["duplicates"] += 1
+            return
+        seen.add(fingerprint)
+        questions.append(obj)
+
+    text = text or ""
+    pos = text.find("{")
+    while pos != -1:
+        try:
+            obj, end = _decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            # 外側のオブジェクトが壊れていても、内側の問題オブジェクトから再開する
+            diagnostics["decode_errors"] += 1
+            pos = text.find("{", pos + 1)
+            continue
+        diagnostics["decoded_objects"] += 1
+        collect(obj)
+        pos = text.find("{", end)
+
+    if num_questions is not None:
+        questions = questions[:num_questions]
+        missing = max(0, num_questions - len(questions))
+    else:
+        missing = 0
+    return {"qa_set": questions, "missing": missing, "diagnostics": diagnostics}
+
+
+def collect_questions(generate_text, num_questions, max_retries=1):
+    """generate_text(count, exclude_questions) でモデル出力を得て問題を回収する。
+    不足した場合は不足数だけを、既出の問題を除外するよう指示して再生成させる"""
+    result = salvage_qa_set(generate_text(num_questions, []), num_questions)
+    print(f"Salvaged {len(result['qa_set'])} questions: {result['diagnostics']}")
+    questions = result["qa_set"]
+    seen = {question_fingerprint(qa) for qa in questions}
+
+    for _ in range(max_retries):
+        missing = num_questions - len(questions)
+        if missing <= 0:
+            break
+        print(f"Requesting {missing} missing questions.")
+        exclude = [qa["question"] for qa in questions]
+        # 既出の問題が混ざることがあるので、件数で切らずに全て回収してから重複を除く
+        retry = salvage_qa_set(generate_text(missing, exclude))
+        for qa in retry["qa_set"]:
+            fingerprint = question_fingerprint(qa)
+            if fingerprint not in seen and len(questions) < num_questions:
+                seen.add(fingerprint)
+                questions.append(qa)
+
+    if not questions:
+        raise ValueError("モデルの応答から有効な問題を抽出できませんでした。")
+    for i, qa in enumerate(questions, start=1):
+        qa["question_id"] = i
+    return {"qa_set": questions}
@@ -0,0 +1,296 @@
+# qa_common/metrics.py
+# 処理時間・ペイロードサイズ・DynamoDBの消費キャパシティ・Bedrockのトークン数を集計し、
+# CloudWatch Embedded Metric Format (EMF) のログ行として出力する。
+# CloudWatch Logsが取り込み時にメトリクスへ変換するので、送信のための通信は発生しない
+#   - 外部呼び出しはboto3のイベントフックで計測するので、呼び出し側のコードは変えなくてよい
+#   - 段階（Stage）ごとの処理時間は値の配列で出力し、CloudWatchでp50/p99を見られるようにする
+#   - 問題1問あたりのコストは、トークン数・Textractのページ数と単価から計算する
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import boto3
+
+METRICS_NAMESPACE = "QaSystem"
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() != "false"
+# EMFで1つのメトリクスに含められる値の数の上限
+MAX_VALUES_PER_METRIC = 100
+# 単価（USD）。既定値はus-east-1のAmazon Nova LiteとTextractのテキスト検出
+BEDROCK_INPUT_PRICE_PER_1K = float(
+    os.environ.get("BEDROCK_INPUT_PRICE_PER_1K", "0.00006")
+)
+BEDROCK_OUTPUT_PRICE_PER_1K = float(
+    os.environ.get("BEDROCK_OUTPUT_PRICE_PER_1K", "0.00024")
+)
+TEXTRACT_PRICE_PER_PAGE = float(os.environ.get("TEXTRACT_PRICE_PER_PAGE", "0.0015"))
+
+# ReturnConsumedCapacityを指定できるDynamoDBの操作
+CAPACITY_OPERATIONS = {
+    "GetItem",
+    "PutItem",
+    "UpdateItem",
+    "DeleteItem",
+    "Query",
+    "Scan",
+    "BatchGetItem",
+    "BatchWriteItem",
+    "TransactGetItems",
+    "TransactWriteItems",
+}
+
+_HOOK_ID = "qa-common-metrics"
+_cold_start = True
+
+
+def put_emf(dimensions, values, units, properties=None):
+    """1件のEMFログ行を出力する。dimensionsは {名前: 値}、valuesは {メトリクス名: 値か値のリスト}"""
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [list(dimensions)],
+                            "Metrics": [
+                                {"Name": name, "Unit": units[name]} for name in values
+                            ],
+                        }
+                    ],
+                },
+                **(properties or {}),
+                **dimensions,
+                **values,
+            },
+            ensure_ascii=False,
+        )
+    )
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
+
+
+class MetricsRecorder:
+    """1回の呼び出しの間に記録した値を保持する。並列に生成するスレッドからも記録できる"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}  # 段階 -> {メトリクス名: [値]}
+        self._totals = {}  # メトリクス名 -> 合計
+        self._units = {}
+
+    def observe(self, stage, name, value, unit="Milliseconds"):
+        """段階ごとの分布として値を記録する（p50/p99を見るもの）"""
+        with self._lock:
+            self._stages.setdefault(stage, {}).setdefault(name, []).append(value)
+            self._units[name] = unit
+
+    def add(self, name, value, unit="Count"):
+        """呼び出し全体の合計として値を加算する"""
+        with self._lock:
+            self._totals[name] = self._totals.get(name, 0) + value
+            self._units[name] = unit
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, "Latency", (time.perf_counter() - started) * 1000)
+
+    def _take(self):
+        with self._lock:
+            stages, totals, units = self._stages, self._totals, self._units
+            self._stages, self._totals, self._units = {}, {}, {}
+        return stages, totals, units
+
+    def flush(self, function_name, properties=None):
+        """記録した値をEMFとして出力し、次の呼び出しのために空にする"""
+        stages, totals, units = self._take()
+        if not METRICS_ENABLED:
+            return
+        properties = {k: v for k, v in (properties or {}).items() if v is not None}
+        for stage, metrics in stages.items():
+            # 値が上限を超えるメトリクスは複数の行に分けて出力する
+            chunks = {
+                name: list(_chunks(values, MAX_VALUES_PER_METRIC))
+                for name, values in metrics.items()
+            }
+            for i in range(max(len(c) for c in chunks.values())):
+                put_emf(
+                    {"FunctionName": function_name, "Stage": stage},
+                    {name: c[i] for name, c in chunks.items() if i < len(c)},
+                    units,
+                    properties,
+                )
+
+        cost = estimate_cost(totals)
+        totals.update(cost)
+        units.update(dict.fromkeys(cost, "None"))
+        if totals:
+            put_emf({"FunctionName": function_name}, totals, units, properties)
+
+
+def estimate_cost(totals):
+    """トークン数とページ数から推定コスト（USD）を計算する。問題を保存した呼び出しでは
+    1問あたりのコストも返す"""
+    cost = {}
+    if totals.get("InputTokens") or totals.get("OutputTokens"):
+        cost["BedrockCost"] = (
+            totals.get("InputTokens", 0) / 1000 * BEDROCK_INPUT_PRICE_PER_1K
+            + totals.get("OutputTokens", 0) / 1000 * BEDROCK_OUTPUT_PRICE_PER_1K
+        )
+    if totals.get("TextractPages"):
+        cost["TextractCost"] = totals["TextractPages"] * TEXTRACT_PRICE_PER_PAGE
+    if cost:
+        cost["EstimatedCost"] = sum(cost.values())
+        if totals.get("QuestionsGenerated"):
+            cost["CostPerQuestion"] = (
+                cost["EstimatedCost"] / totals["QuestionsGenerated"]
+            )
+    return cost
+
+
+recorder = MetricsRecorder()
+
+
+def add_metric(name, value, unit="Count"):
+    recorder.add(name, value, unit)
+
+
+def timed(stage):
+    """boto3以外の処理を段階として計測する: with timed("pdf.split"): ..."""
+    return recorder.span(stage)
+
+
+def record_bedrock_usage(usage):
+    """Bedrockの応答に含まれる使用量（usage または invocationMetrics）を記録する"""
+    if not usage:
+        return
+    recorder.add(
+        "InputTokens", int(usage.get("inputTokens", usage.get("inputTokenCount", 0)))
+    )
+    recorder.add(
+        "OutputTokens",
+        int(usage.get("outputTokens", usage.get("outputTokenCount", 0))),
+    )
+
+
+def payload_size(payload):
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode("utf-8"))
+    return len(json.dumps(payload, default=str).encode("utf-8"))
+
+
+# --- boto3のイベントフック ---
+
+
+def _stage(event_name):
+    # "after-call.dynamodb.GetItem" -> "dynamodb.GetItem"
+    return event_name.split(".", 1)[1]
+
+
+def _request_capacity(params, model, **kwargs):
+    if model.name in CAPACITY_OPERATIONS:
+        params.setdefault("ReturnConsumedCapacity", "TOTAL")
+
+
+def _before_call(params, context, **kwargs):
+    context["metrics_started"] = time.perf_counter()
+    body = params.get("body")
+    if body and isinstance(body, (bytes, bytearray, str)):
+        context["metrics_request_bytes"] = payload_size(body)
+
+
+def _consumed_capacity(parsed):
+    consumed = parsed.get("ConsumedCapacity")
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return sum(entry.get("CapacityUnits", 0) for entry in consumed or [])
+
+
+def _after_call(http_response, parsed, context, event_name, **kwargs):
+    started = context.get("metrics_started")
+    if started is None:
+        return
+    stage = _stage(event_name)
+    recorder.observe(stage, "Latency", (time.perf_counter() - started) * 1000)
+    if "metrics_request_bytes" in context:
+        recorder.observe(
+            stage, "RequestBytes", context["metrics_request_bytes"], "Bytes"
+        )
+    # ストリーミングの本文は読まずに、ヘッダーの長さだけを使う
+    length = http_response.headers.get("content-length")
+    if length is not None:
+        recorder.observe(stage, "ResponseBytes", int(length), "Bytes")
+    if "ConsumedCapacity" in parsed:
+        recorder.observe(stage, "ConsumedCapacity", _consumed_capacity(parsed), "Count")
+
+
+def _after_call_error(context, event_name, **kwargs):
+    started = context.get("metrics_started")
+    if started is None:
+        return
+    stage = _stage(event_name)
+    recorder.observe(stage, "Latency", (time.perf_counter() - started) * 1000)
+    recorder.observe(stage, "Errors", 1, "Count")
+
+
+def instrument_boto3():
+    """既定セッションにフックを登録する。登録後に作ったクライアント・リソースだけが
+    計測されるので、各ハンドラーのモジュールでクライアントを作る前に呼ぶ"""
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    events = boto3.DEFAULT_SESSION.events
+    events.register(
+        "provide-client-params.dynamodb",
+        _request_capacity,
+        unique_id=f"{_HOOK_ID}-capacity",
+    )
+    events.register("before-call", _before_call, unique_id=f"{_HOOK_ID}-before")
+    events.register("after-call", _after_call, unique_id=f"{_HOOK_ID}-after")
+    events.register(
+        "after-call-error", _after_call_error, unique_id=f"{_HOOK_ID}-error"
+    )
+
+
+def instrument_handler(handler):
+    """Lambdaハンドラーの処理時間・コールドスタート・イベントと応答の大きさを記録し、
+    終了時にその呼び出しで記録した値をまとめて出力する"""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _cold_start
+        cold_start, _cold_start = _cold_start, False
+        started = time.perf_counter()
+        response = None
+        try:
+            response = handler(event, context)
+            return response
+        finally:
+            recorder.observe(
+                "handler", "Latency", (time.perf_counter() - started) * 1000
+            )
+            recorder.add("Invocations", 1)
+            recorder.add("ColdStart", 1 if cold_start else 0)
+            recorder.add("EventBytes", payload_size(event), "Bytes")
+            if isinstance(response, dict) and "body" in response:
+                recorder.add("ResponseBytes", payload_size(response["body"]), "Bytes")
+            recorder.flush(
+                getattr(context, "function_name", None)
+                or os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local"),
+                {"RequestId": getattr(context, "aws_request_id", None)},
+            )
+
+    return wrapper
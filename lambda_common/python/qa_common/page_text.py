@@ -0,0 +1,29 @@
+# qa_common/page_text.py
+# ページ単位のテキストと、(本文, ページ開始位置) 形式の相互変換
+# 形式はTextract結果の取得処理と同じで、各行の末尾に改行を付けて連結する
+
+
+def join_pages(pages):
+    """(ページ番号, テキスト) の並びを本文と各ページの開始位置に変換する。
+    空のページは本文にもページ開始位置にも含めない"""
+    parts = []
+    page_offsets = []
+    offset = 0
+    for page, text in pages:
+        lines = [line for line in text.splitlines() if line.strip()]
+        if not lines:
+            continue
+        page_text = "\n".join(lines) + "\n"
+        page_offsets.append({"page": page, "offset": offset})
+        parts.append(page_text)
+        offset += len(page_text)
+    return "".join(parts), page_offsets
+
+
+def split_pages(text, page_offsets):
+    """join_pages の逆変換。(ページ番号, テキスト) のリストを返す"""
+    pages = []
+    for i, entry in enumerate(page_offsets):
+        end = page_offsets[i + 1]["offset"] if i + 1 < len(page_offsets) else len(text)
+        pages.append((entry["page"], text[entry["offset"] : end]))
+    return pages
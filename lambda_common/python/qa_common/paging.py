@@ -0,0 +1,40 @@
+# qa_common/paging.py
+# 一覧APIのページング。DynamoDBのLastEvaluatedKeyを不透明なnext_tokenとして
+# クライアントに渡し、次のリクエストでExclusiveStartKeyに戻す
+import base64
+import json
+
+
+def encode_next_token(last_evaluated_key):
+    """LastEvaluatedKeyをクライアントに渡す不透明なカーソル文字列に変換する"""
+    if not last_evaluated_key:
+        return None
+    raw = json.dumps(last_evaluated_key, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_next_token(next_token, partition_key="qa_set_id", partition=None):
+    """next_tokenをExclusiveStartKeyに戻す。不正な値はValueErrorにする。
+    partitionを渡すと、パーティションキーが一致しない（別の一覧の）トークンも拒否する"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(next_token.encode("ascii")))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"next_tokenが不正です: {e}") from e
+    if not isinstance(key, dict) or partition_key not in key:
+        raise ValueError("next_tokenが不正です。")
+    if partition is not None and key[partition_key] != partition:
+        raise ValueError("next_tokenが不正です。")
+    return key
+
+
+def parse_limit(value, default, maximum):
+    """クエリ文字列のlimitを1〜maximumの件数にする。未指定ならdefault"""
+    if value in (None, ""):
+        return default
+    try:
+        limit = int(value)
+    except (ValueError, TypeError):
+        raise ValueError(f"limitが不正です: {value}")
+    if limit < 1:
+        raise ValueError(f"limitは1以上を指定してください: {value}")
+    return min(limit, maximum)
@@ -0,0 +1,100 @@
+# qa_common/qa_stream.py
+# invoke_model_with_response_stream の出力を逐次解析し、閉じた問題オブジェクトから順に取り出す
+import json
+import time
+
+from qa_common.json_salvage import is_valid_question
+
+
+class QaSetStreamParser:
+    """JSONテキストを断片ごとに受け取り、配列の要素として閉じたオブジェクトを返す。
+    文字列リテラルとエスケープを考慮して括弧の対応だけを追跡するので、全体が
+    閉じていない（途中で打ち切られた）出力からも完成済みの問題を取り出せる"""
+
+    def __init__(self):
+        self._buffer = []
+        self._length = 0
+        self._stack = []  # 開いているコンテナ ("{" または "[")
+        self._starts = {}  # 配列要素として開いたオブジェクトの深さ -> 開始位置
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, fragment):
+        """テキスト断片を追加し、この断片で閉じた問題オブジェクトのリストを返す"""
+        completed = []
+        base = self._length
+        self._buffer.append(fragment)
+        self._length += len(fragment)
+        for offset, ch in enumerate(fragment):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if ch == "{" and self._stack and self._stack[-1] == "[":
+                    self._starts[len(self._stack)] = base + offset
+                self._stack.append(ch)
+            elif ch in "}]" and self._stack:
+                self._stack.pop()
+                start = self._starts.pop(len(self._stack), None)
+                if ch == "}" and start is not None:
+                    obj = self._decode(start, base + offset + 1)
+                    if is_valid_question(obj):
+                        completed.append(obj)
+        return completed
+
+    @property
+    def text(self):
+        if len(self._buffer) > 1:
+            self._buffer = ["".join(self._buffer)]
+        return self._buffer[0] if self._buffer else ""
+
+    def _decode(self, start, end):
+        try:
+            return json.loads(self.text[start:end])
+        except json.JSONDecodeError:
+            return None
+
+
+def stream_model_text(
+    bedrock_runtime, model_id, request_body, num_questions, on_question=None
+):
+    """ストリーミングで生成し、num_questions個の問題が揃った時点で受信を打ち切る。
+    受信したモデル出力テキスト（打ち切った場合はそこまで）を返す"""
+    started = time.monotonic()
+    response = bedrock_runtime.invoke_model_with_response_stream(
+        body=json.dumps(request_body), modelId=model_id
+    )
+    stream = response["body"]
+    parser = QaSetStreamParser()
+    count = 0
+    try:
+        for event in stream:
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            payload = json.loads(chunk["bytes"])
+            delta = payload.get("contentBlockDelta", {}).get("delta", {}).get("text")
+            if not delta:
+                continue
+            for question in parser.feed(delta):
+                count += 1
+                if count == 1:
+                    print(
+                        f"First question streamed after {time.monotonic() - started:.2f}s"
+                    )
+                if on_question is not None:
+                    on_question(question)
+                if count >= num_questions:
+                    print(f"Received {count} questions. Stopping stream early.")
+                    return parser.text
+    finally:
+        stream.close()
+    return parser.text
@@ -0,0 +1,200 @@
+# qa_common/textract_slots.py
+# 実行中のTextractジョブ数をDynamoDBのカウンターで管理し、同時実行数の上限を守る
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+COUNTER_KEY = "textract#in_flight"
+LEASE_PREFIX = "textract#lease#"
+
+
+class TextractSlots:
+    """カウンター項目と、文書ごとのリース項目をトランザクションで更新する。
+
+    acquire は空きがある場合だけ、ページ範囲の数（slots）だけカウンターを増やしてリースを作る。
+    release はページ範囲（part）ごとに1つずつ返却する。返却済みのpartはリースに記録するので、
+    完了通知が重複して届いても二重に減算されない。全てのpartを返却したらリースを削除する。
+    reconcile は期限切れのリースを消し、残ったリースの未返却partの合計でカウンターを直す。
+    完了通知が届かずに返却されなかったスロットは、これで取り戻せる。
+    """
+
+    def __init__(self, table_name, max_in_flight, lease_ttl_seconds=24 * 3600):
+        self.table_name = table_name
+        self.max_in_flight = max_in_flight
+        self.lease_ttl_seconds = lease_ttl_seconds
+        self.client = boto3.resource("dynamodb").meta.client
+
+    def acquire(self, lease_id, detail=None, slots=1):
+        """スロットを確保できればTrue、空きが足りない（または同じリースが
+        既に実行中の）場合はFalseを返す"""
+        now = int(time.time())
+        try:
+            self.client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": self.table_name,
+                            "Key": {"pk": COUNTER_KEY},
+                            "UpdateExpression": "ADD in_flight :slots, version :one",
+                            "ConditionExpression": "attribute_not_exists(in_flight) OR in_flight <= :limit",
+                            "ExpressionAttributeValues": {
+                                ":slots": slots,
+                                ":limit": self.max_in_flight - slots,
+                                ":one": 1,
+                            },
+                        }
+                    },
+                    {
+                        "Put": {
+                            "TableName": self.table_name,
+                            "Item": {
+                                "pk": LEASE_PREFIX + lease_id,
+                                "slots": slots,
+                                "acquired_at": now,
+                                "expires_at": now + self.lease_ttl_seconds,
+                                **(detail or {}),
+                            },
+                            "ConditionExpression": "attribute_not_exists(pk)",
+                        }
+                    },
+                ]
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "TransactionCanceledException":
+                return False
+            raise
+
+    def release(self, lease_id, part="0", run_id=None):
+        """リースのうち1つのpartを返却する。既に返却済みならFalseを返す。
+        run_idを指定した場合は、同じrun_idで確保したリースからだけ返却する"""
+        key = {"pk": LEASE_PREFIX + lease_id}
+        condition = "attribute_exists(pk) AND NOT contains(released, :part_name)"
+        values = {":part": {part}, ":part_name": part}
+        if run_id is not None:
+            condition += " AND run_id = :run_id"
+            values[":run_id"] = run_id
+        try:
+            self.client.transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": self.table_name,
+                            "Key": key,
+                            "UpdateExpression": "ADD released :part",
+                            "ConditionExpression": condition,
+                            "ExpressionAttributeValues": values,
+                        }
+                    },
+                    {
+                        "Update": {
+                            "TableName": self.table_name,
+                            "Key": {"pk": COUNTER_KEY},
+                            "UpdateExpression": "ADD in_flight :minus_one, version :one",
+                            "ConditionExpression": "in_flight > :zero",
+                            "ExpressionAttributeValues": {
+                                ":minus_one": -1,
+                                ":zero": 0,
+                                ":one": 1,
+                            },
+                        }
+                    },
+                ]
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "TransactionCanceledException":
+                return False
+            raise
+
+        # 全てのpartを返却したら、同じ文書を再び処理できるようリースを消す
+        try:
+            self.client.delete_item(
+                TableName=self.table_name,
+                Key=key,
+                ConditionExpression="size(released) >= slots",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        return True
+
+    def _leases(self):
+        # 状態テーブルにはカウンターと実行中の文書ごとの項目しか無いので、Scanで足りる
+        params = {
+            "TableName": self.table_name,
+            "FilterExpression": "begins_with(pk, :prefix)",
+            "ExpressionAttributeValues": {":prefix": LEASE_PREFIX},
+            "ConsistentRead": True,
+        }
+        while True:
+            response = self.client.scan(**params)
+            yield from response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def reconcile(self):
+        """期限切れのリースを削除し、カウンターを残ったリースの未返却partの合計に合わせる。
+        取り戻したスロット数を返す。途中でacquire/releaseが走った場合は何もしない"""
+        counter = (
+            self.client.get_item(
+                TableName=self.table_name,
+                Key={"pk": COUNTER_KEY},
+                ConsistentRead=True,
+            ).get("Item")
+            or {}
+        )
+        now = int(time.time())
+        expected = 0
+        for lease in self._leases():
+            if int(lease.get("expires_at", now)) < now:
+                # TTLで消える前の期限切れのリース。同じ文書を再び処理できるよう消す
+                try:
+                    self.client.delete_item(
+                        TableName=self.table_name,
+                        Key={"pk": lease["pk"]},
+                        ConditionExpression="acquired_at = :acquired_at",
+                        ExpressionAttributeValues={
+                            ":acquired_at": lease["acquired_at"]
+                        },
+                    )
+                except ClientError as e:
+                    if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                        raise
+                print(f"Dropped expired Textract lease: {lease['pk']}")
+                continue
+            expected += max(0, int(lease["slots"]) - len(lease.get("released", ())))
+
+        in_flight = int(counter.get("in_flight", 0))
+        if in_flight == expected:
+            return 0
+        # カウンターを読んでから変更が無かった場合だけ書き換える
+        if "version" in counter:
+            condition = "version = :version"
+            values = {":version": counter["version"]}
+        else:
+            condition = "attribute_not_exists(version)"
+            values = {}
+        try:
+            self.client.update_item(
+                TableName=self.table_name,
+                Key={"pk": COUNTER_KEY},
+                UpdateExpression="SET in_flight = :expected ADD version :one",
+                ConditionExpression=condition,
+                ExpressionAttributeValues={":expected": expected, ":one": 1, **values},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return 0
+            raise
+        print(f"Reconciled Textract slots: in_flight {in_flight} -> {expected}")
+        return in_flight - expected
+
+    def in_flight(self):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={"pk": COUNTER_KEY},
+            ConsistentRead=True,
+        ).get("Item")
+        return int(item.get("in_flight", 0)) if item else 0
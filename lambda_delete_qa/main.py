@@ -2,13 +2,40 @@ import json
 import os
 import boto3
 import traceback
+from boto3.dynamodb.conditions import Key
+
+from qa_common.metrics import instrument_boto3, instrument_handler
+
+instrument_boto3()
 
 # 環境変数からテーブル名を取得
 TABLE_NAME = os.environ.get("TABLE_NAME")
+SUBMISSIONS_TABLE_NAME = os.environ.get("SUBMISSIONS_TABLE_NAME")
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table(TABLE_NAME)
+submissions_table = dynamodb.Table(SUBMISSIONS_TABLE_NAME)
+
+
+def delete_submissions(qa_set_id):
+    """QAセットに紐づく提出データをキーだけ読みながらページ単位で削除する"""
+    deleted = 0
+    query_kwargs = {
+        "KeyConditionExpression": Key("qa_set_id").eq(qa_set_id),
+        "ProjectionExpression": "qa_set_id, submission_id",
+    }
+    with submissions_table.batch_writer() as batch:
+        while True:
+            response = submissions_table.query(**query_kwargs)
+            for key in response.get("Items", []):
+                batch.delete_item(Key=key)
+                deleted += 1
+            if "LastEvaluatedKey" not in response:
+                break
+            query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return deleted
 
 
+@instrument_handler
 def handler(event, context):
     print(f"Received event: {json.dumps(event)}")
     try:
@@ -17,6 +44,8 @@ def handler(event, context):
 
         print(f"Attempting to delete item with id: {qa_set_id}")
         table.delete_item(Key={"qa_set_id": qa_set_id})
+        deleted = delete_submissions(qa_set_id)
+        print(f"Deleted {deleted} submissions for id: {qa_set_id}")
 
         print(f"Successfully deleted item with id: {qa_set_id}")
         # 成功時はボディなし、ステータスコード204を返すのが一般的
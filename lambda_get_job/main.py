@@ -0,0 +1,92 @@
+# lambda_get_job/main.py
+# GET /jobs/{id}: アップロードしたPDFの処理状況を返す
+# wait（秒）を指定すると、If-None-Matchで渡したETagから状態が変わるまで最大その時間だけ待つ
+import json
+import os
+import time
+import traceback
+
+from qa_common.api_response import (
+    compute_etag,
+    is_not_modified,
+    json_response,
+    not_modified_response,
+)
+from qa_common.jobs import TERMINAL_STATES, JobTracker, stage_durations
+from qa_common.metrics import instrument_boto3, instrument_handler
+
+instrument_boto3()
+
+JOBS_TABLE_NAME = os.environ.get("JOBS_TABLE_NAME")
+job_tracker = JobTracker(JOBS_TABLE_NAME)
+# API Gatewayの統合タイムアウト（29秒）に収まるよう、待ち時間の上限を決める
+MAX_WAIT_SECONDS = int(os.environ.get("MAX_WAIT_SECONDS", "20"))
+POLL_INTERVAL_SECONDS = float(os.environ.get("POLL_INTERVAL_SECONDS", "1"))
+
+
+def parse_wait(value):
+    if value in (None, ""):
+        return 0
+    try:
+        wait = int(value)
+    except (ValueError, TypeError):
+        raise ValueError(f"waitが不正です: {value}")
+    return max(0, min(wait, MAX_WAIT_SECONDS))
+
+
+def job_etag(job):
+    return compute_etag(job["job_id"], job.get("state"), job.get("updated_at"))
+
+
+@instrument_handler
+def handler(event, context):
+    print(f"Received event: {json.dumps(event)}")
+    try:
+        job_id = event["pathParameters"]["id"]
+        params = event.get("queryStringParameters") or {}
+        try:
+            wait = parse_wait(params.get("wait"))
+        except ValueError as e:
+            return create_error_response(400, str(e))
+
+        deadline = time.monotonic() + wait
+        while True:
+            job = job_tracker.get(job_id)
+            if not job:
+                return create_error_response(404, "指定されたジョブが見つかりません。")
+            etag = job_etag(job)
+            # 状態が変わった、完了・失敗した、または待ち時間が尽きたら返す
+            if (
+                not is_not_modified(event, etag)
+                or job.get("state") in TERMINAL_STATES
+                or time.monotonic() + POLL_INTERVAL_SECONDS > deadline
+            ):
+                break
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+        if is_not_modified(event, etag):
+            return not_modified_response(etag)
+        job.pop("expires_at", None)
+        job["durations"] = stage_durations(job)
+        return create_success_response(job, event, etag)
+
+    except Exception as e:
+        print(f"ERROR: An unexpected error occurred. {traceback.format_exc()}")
+        return create_error_response(
+            500, f"ジョブの取得中に予期せぬエラーが発生しました: {str(e)}"
+        )
+
+
+def create_success_response(body, event, etag=None):
+    return json_response(event, body, etag=etag)
+
+
+def create_error_response(status_code, error_message):
+    return {
+        "statusCode": status_code,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+        },
+        "body": json.dumps({"error": error_message}, ensure_ascii=False),
+    }
@@ -0,0 +1,59 @@
+import json
+import os
+import traceback
+
+from qa_common.api_response import (
+    compute_etag,
+    is_not_modified,
+    item_version,
+    json_response,
+    not_modified_response,
+)
+from qa_common.codec import DynamoTable
+from qa_common.metrics import instrument_boto3, instrument_handler
+
+instrument_boto3()
+
+TABLE_NAME = os.environ.get("TABLE_NAME")
+# 数値をDecimalを経由せずにint/floatで読む
+table = DynamoTable(TABLE_NAME)
+
+
+@instrument_handler
+def handler(event, context):
+    print(f"Received event: {json.dumps(event)}")
+    try:
+        # URLのパスから取得対象のIDを取得 (例: /qas/xxxxxxxx-xxxx-xxxx)
+        qa_set_id = event["pathParameters"]["id"]
+
+        response = table.get_item(Key={"qa_set_id": qa_set_id})
+        item = response.get("Item")
+        if not item:
+            return create_error_response(404, "指定されたQAセットが見つかりません。")
+
+        # 版数と更新日時が変わらなければ、本文を作らずに304を返す
+        etag = compute_etag(*item_version(item))
+        if is_not_modified(event, etag):
+            return not_modified_response(etag)
+        return create_success_response(item, event, etag)
+
+    except Exception as e:
+        print(f"ERROR: An unexpected error occurred. {traceback.format_exc()}")
+        return create_error_response(
+            500, f"QAの取得中に予期せぬエラーが発生しました: {str(e)}"
+        )
+
+
+def create_success_response(body, event, etag=None):
+    return json_response(event, body, etag=etag)
+
+
+def create_error_response(status_code, error_message):
+    return {
+        "statusCode": status_code,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+        },
+        "body": json.dumps({"error": error_message}, ensure_ascii=False),
+    }
@@ -1,60 +1,268 @@
 # lambda_get_upload_url/main.py
 
+import base64
 import json
+import math
 import os
 import boto3
 from botocore.exceptions import ClientError
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from qa_common.api_response import json_body
+from qa_common.jobs import UPLOAD_PREFIX, JobTracker
+from qa_common.metrics import instrument_boto3, instrument_handler
+
+instrument_boto3()
 
 s3_client = boto3.client("s3")
 BUCKET_NAME = os.environ.get("UPLOAD_BUCKET_NAME")
+# アップロードごとの処理状況を記録するテーブル（未設定なら記録しない）
+JOBS_TABLE_NAME = os.environ.get("JOBS_TABLE_NAME")
+job_tracker = JobTracker(JOBS_TABLE_NAME) if JOBS_TABLE_NAME else None
+# マルチパートアップロードの1パートの大きさ（S3の下限は最後のパートを除き5MiB）
+MULTIPART_PART_SIZE = max(
+    5 * 1024 * 1024, int(os.environ.get("MULTIPART_PART_SIZE", str(8 * 1024 * 1024)))
+)
+MAX_PARTS = 10000  # S3の1アップロードあたりのパート数の上限
+PRESIGN_EXPIRES = 3600  # 1 hour
+# 一括モードで1回に発行できるファイル数と、マルチパート開始を並列に行う数
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "50"))
+BATCH_CONCURRENCY = 8
 
 
+@instrument_handler
 def handler(event, context):
     try:
         # フロントエンドからリクエストボディを受け取る
-        body = json.loads(event["body"])
-        file_name = body.get("file_name", "default.pptx")
-        theme = body.get("theme", "untitled")
-        lecture_number = body.get("lecture_number", "1")
-        num_questions = body.get("num_questions", "5")
-        difficulty = body.get("difficulty", "中")
+        # application/jsonはbinary_media_typesに含まれるため、base64で届くことがある
+        body = json_body(event)
+        action = body.get("action", "create")
+        if action == "complete":
+            return complete_multipart_upload(body)
+        if action == "abort":
+            return abort_multipart_upload(body)
+        if action == "batch":
+            return create_success_response(create_batch_uploads(body))
+        if action != "create":
+            return create_error_response(400, f"actionが不正です: {action}")
+
+        # フロントエンドが必要とするURLとフォームフィールドを返す
+        return create_success_response(create_upload(body))
+
+    except ValueError as e:
+        return create_error_response(400, str(e))
+    except ClientError as e:
+        print(f"ERROR: {e}")
+        return create_error_response(500, str(e))
+    except Exception as e:
+        print(f"ERROR: {e}")
+        return create_error_response(500, str(e))
+
+
+def encode_metadata_value(value):
+    """S3 APIのメタデータはASCIIのみなので、非ASCIIはRFC 2047形式にする。
+    事前署名付きPOSTで非ASCIIを送った場合もS3は同じ形式で返す"""
+    value = str(value)
+    if value.isascii():
+        return value
+    return f"=?UTF-8?B?{base64.b64encode(value.encode('utf-8')).decode('ascii')}?="
+
 
-        # S3内でユニークなキーを生成
-        object_key = f"uploads/{uuid.uuid4()}-{file_name}"
+def plan_part_size(file_size):
+    """パート数が上限に収まるパートの大きさ（1MiB単位に切り上げ）を返す"""
+    part_size = MULTIPART_PART_SIZE
+    if file_size > part_size * MAX_PARTS:
+        mib = 1024 * 1024
+        part_size = math.ceil(file_size / MAX_PARTS / mib) * mib
+    return part_size
+
+
+def create_upload(options):
+    """1ファイル分のアップロード先を発行する。通常は事前署名付きPOST、
+    upload_typeがmultipartならマルチパートアップロードを開始する"""
+    file_name = options.get("file_name", "default.pptx")
+    theme = options.get("theme", "untitled")
+    lecture_number = options.get("lecture_number", "1")
+    num_questions = options.get("num_questions", "5")
+    difficulty = options.get("difficulty", "中")
+    # 生成キャッシュの制御（use / refresh / bypass）。省略時はサーバー側の既定値
+    cache_mode = options.get("cache_mode")
+
+    # S3内でユニークなキーを生成。キーに含めたIDを処理状況（ジョブ）のIDとして使う
+    job_id = str(uuid.uuid4())
+    object_key = f"{UPLOAD_PREFIX}{job_id}-{file_name}"
+
+    metadata = {
+        "theme": theme,
+        "lecture_number": str(lecture_number),
+        "num_questions": str(num_questions),
+        "difficulty": difficulty,
+    }
+    if cache_mode:
+        metadata["cache_mode"] = cache_mode
+
+    if options.get("upload_type") == "multipart":
+        upload = create_multipart_upload(object_key, metadata, options.get("file_size"))
+    else:
+        fields = {f"x-amz-meta-{name}": value for name, value in metadata.items()}
 
         # 事前署名付きPOSTを生成
-        presigned_post = s3_client.generate_presigned_post(
+        upload = s3_client.generate_presigned_post(
             Bucket=BUCKET_NAME,
             Key=object_key,
-            Fields={
-                "x-amz-meta-theme": theme,
-                "x-amz-meta-lecture_number": str(lecture_number),
-                "x-amz-meta-num_questions": str(num_questions),
-                "x-amz-meta-difficulty": difficulty,
-            },
-            Conditions=[
-                {"x-amz-meta-theme": theme},
-                {"x-amz-meta-lecture_number": str(lecture_number)},
-                {"x-amz-meta-num_questions": str(num_questions)},
-                {"x-amz-meta-difficulty": difficulty},
-            ],
-            ExpiresIn=3600,  # 1 hour
+            Fields=fields,
+            Conditions=[{name: value} for name, value in fields.items()],
+            ExpiresIn=PRESIGN_EXPIRES,
+        )
+
+    if job_tracker is not None:
+        job_tracker.create(
+            job_id,
+            key=object_key,
+            file_name=file_name,
+            theme=str(theme),
+            lecture_number=str(lecture_number),
+        )
+    return {"job_id": job_id, **upload}
+
+
+def create_batch_uploads(body):
+    """複数ファイルのアップロード先を1回のリクエストでまとめて発行する。
+    テーマや問題数などは共通、files の各要素で file_name や lecture_number を上書きする"""
+    files = body.get("files")
+    if not isinstance(files, list) or not files:
+        raise ValueError("filesにファイルを1件以上指定してください。")
+    if len(files) > MAX_BATCH_FILES:
+        raise ValueError(
+            f"一度にアップロードできるファイルは{MAX_BATCH_FILES}件までです。"
         )
+    common = {k: v for k, v in body.items() if k not in ("action", "files")}
+    entries = [{**common, **entry} for entry in files]
 
-        return {
-            "statusCode": 200,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-            },
-            # フロントエンドが必要とするURLとフォームフィールドを返す
-            "body": json.dumps(presigned_post),
+    # 事前署名自体はローカルの計算だが、マルチパートの開始はS3の呼び出しになるため並列に行う
+    with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY) as executor:
+        uploads = list(executor.map(create_upload, entries))
+    print(f"Issued {len(uploads)} uploads in batch mode.")
+    return {
+        "uploads": [
+            {
+                "file_name": entry.get("file_name"),
+                "lecture_number": entry.get("lecture_number"),
+                **upload,
+            }
+            for entry, upload in zip(entries, uploads)
+        ]
+    }
+
+
+def create_multipart_upload(object_key, metadata, file_size):
+    """マルチパートアップロードを開始し、パートごとの事前署名付きPUT URLを返す。
+    メタデータはアップロード開始時に設定するので、クライアントは本文だけを送ればよい"""
+    try:
+        file_size = int(file_size)
+    except (TypeError, ValueError):
+        raise ValueError("file_sizeを指定してください。")
+    if file_size <= 0:
+        raise ValueError("file_sizeは1以上を指定してください。")
+
+    part_size = plan_part_size(file_size)
+    part_count = math.ceil(file_size / part_size)
+    upload = s3_client.create_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=object_key,
+        Metadata={name: encode_metadata_value(v) for name, v in metadata.items()},
+        ContentType="application/pdf",
+    )
+    upload_id = upload["UploadId"]
+    parts = [
+        {
+            "part_number": part_number,
+            "url": s3_client.generate_presigned_url(
+                "upload_part",
+                Params={
+                    "Bucket": BUCKET_NAME,
+                    "Key": object_key,
+                    "UploadId": upload_id,
+                    "PartNumber": part_number,
+                },
+                ExpiresIn=PRESIGN_EXPIRES,
+            ),
         }
+        for part_number in range(1, part_count + 1)
+    ]
+    print(f"Created multipart upload for {object_key}: {part_count} parts")
+    return {
+        "upload_type": "multipart",
+        "key": object_key,
+        "upload_id": upload_id,
+        "part_size": part_size,
+        "parts": parts,
+    }
 
-    except ClientError as e:
-        print(f"ERROR: {e}")
-        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
-    except Exception as e:
-        print(f"ERROR: {e}")
-        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+
+def _multipart_target(body):
+    key = body.get("key") or ""
+    upload_id = body.get("upload_id")
+    # このAPIで作成したアップロード以外は完了・中止させない
+    if not key.startswith(UPLOAD_PREFIX) or not upload_id:
+        raise ValueError("keyとupload_idを指定してください。")
+    return key, upload_id
+
+
+def complete_multipart_upload(body):
+    """アップロード済みのパートを結合する。完了するとS3イベントでPDF処理が始まる"""
+    try:
+        key, upload_id = _multipart_target(body)
+        parts = sorted(
+            (
+                {"PartNumber": int(part["part_number"]), "ETag": part["etag"]}
+                for part in body.get("parts") or []
+            ),
+            key=lambda part: part["PartNumber"],
+        )
+    except (ValueError, TypeError, KeyError) as e:
+        return create_error_response(400, f"リクエストが不正です: {e}")
+    if not parts:
+        return create_error_response(400, "partsを指定してください。")
+
+    s3_client.complete_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": parts},
+    )
+    print(f"Completed multipart upload for {key} ({len(parts)} parts)")
+    return create_success_response({"key": key})
+
+
+def abort_multipart_upload(body):
+    try:
+        key, upload_id = _multipart_target(body)
+    except ValueError as e:
+        return create_error_response(400, str(e))
+    s3_client.abort_multipart_upload(Bucket=BUCKET_NAME, Key=key, UploadId=upload_id)
+    print(f"Aborted multipart upload for {key}")
+    return create_success_response({"key": key})
+
+
+def create_success_response(body):
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+        },
+        "body": json.dumps(body),
+    }
+
+
+def create_error_response(status_code, error_message):
+    return {
+        "statusCode": status_code,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+        },
+        "body": json.dumps({"error": error_message}, ensure_ascii=False),
+    }
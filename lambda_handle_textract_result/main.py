@@ -1,52 +1,481 @@
 # lambda_handle_textract_result/main.py の全コード
 import json
+import math
 import os
+import random
 import boto3
-import re
 import traceback
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.header import decode_header, make_header
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from qa_common.bedrock_client import BedrockUnavailable, ThrottleAwareBedrock
+from qa_common.codec import DynamoTable
+from qa_common.generation_cache import GenerationCache
+from qa_common.jobs import (
+    COMPLETED,
+    DEFERRED,
+    FAILED,
+    GENERATING,
+    JobTracker,
+    job_id_from_key,
+    utc_now,
+)
+from qa_common.json_salvage import (
+    collect_questions,
+    question_fingerprint,
+    salvage_qa_set,
+)
+from qa_common.metrics import (
+    add_metric,
+    instrument_boto3,
+    instrument_handler,
+    timed,
+)
+from qa_common.page_text import join_pages, split_pages
+from qa_common.qa_stream import stream_model_text
+from qa_common.textract_slots import TextractSlots
+
+instrument_boto3()
 
 # --- AWSクライアントの初期化 ---
 MODEL_ID = os.environ.get("MODEL_ID", "us.amazon.nova-lite-v1:0")
 AWS_REGION = os.environ.get("AWS_REGION", "us-east-1")
 TABLE_NAME = os.environ.get("TABLE_NAME")
+# 抽出済みテキストをPDFの内容ハッシュごとに保存するS3プレフィックス
+TEXT_CACHE_PREFIX = os.environ.get("TEXT_CACHE_PREFIX", "text-cache/")
+# 開始側がテキストの無いページだけを切り出した部分PDFと、結合用マニフェストの保存先
+OCR_PAGES_PREFIX = os.environ.get("OCR_PAGES_PREFIX", "ocr-pages/")
+NATIVE_TEXT_PREFIX = os.environ.get("NATIVE_TEXT_PREFIX", "native-text/")
+# ページ範囲ごとのOCR結果の一時保存先
+OCR_PARTS_PREFIX = os.environ.get("OCR_PARTS_PREFIX", "ocr-parts/")
+# 長い講義資料を分割して並列生成する際の設定
+MAX_CHUNK_TOKENS = int(os.environ.get("MAX_CHUNK_TOKENS", "8000"))
+CHARS_PER_TOKEN = float(os.environ.get("CHARS_PER_TOKEN", "1.0"))
+GENERATION_CONCURRENCY = int(os.environ.get("GENERATION_CONCURRENCY", "4"))
+OVERGENERATE_RATIO = 1.25
+# Bedrock生成結果のキャッシュ設定（テーブル未設定ならキャッシュしない）
+GENERATION_CACHE_TABLE = os.environ.get("GENERATION_CACHE_TABLE")
+GENERATION_CACHE_BUCKET = os.environ.get("GENERATION_CACHE_BUCKET")
+GENERATION_CACHE_MODE = os.environ.get("GENERATION_CACHE_MODE", "use")
+GENERATION_CACHE_TTL_DAYS = int(os.environ.get("GENERATION_CACHE_TTL_DAYS", "30"))
+# invoke: 一括で生成 / stream: ストリーミングで受信し、必要数が揃った時点で打ち切る
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "invoke")
+# 問題が不足した場合に不足数だけを再生成する回数
+SALVAGE_RETRY_LIMIT = int(os.environ.get("SALVAGE_RETRY_LIMIT", "1"))
+# Textractの同時実行数を管理するテーブル（開始側が確保したスロットを返却する）
+PIPELINE_STATE_TABLE = os.environ.get("PIPELINE_STATE_TABLE")
+MAX_TEXTRACT_JOBS = int(os.environ.get("MAX_TEXTRACT_JOBS", "10"))
+# Bedrockのスロットリング対策（TPMはこのコンテナが使ってよい1分あたりのトークン数、0で無制限）
+BEDROCK_MAX_CONCURRENCY = int(
+    os.environ.get("BEDROCK_MAX_CONCURRENCY", str(GENERATION_CONCURRENCY))
+)
+BEDROCK_TOKENS_PER_MINUTE = int(os.environ.get("BEDROCK_TOKENS_PER_MINUTE", "0"))
+# Bedrockが混雑している間、生成処理を後回しにするキュー
+DEFERRED_QUEUE_URL = os.environ.get("DEFERRED_QUEUE_URL")
+# 後回しにできる回数。超えたらジョブを失敗にしてデッドレターキューへ送る
+MAX_GENERATION_DEFERRALS = int(os.environ.get("MAX_GENERATION_DEFERRALS", "8"))
+DEFERRED_DLQ_URL = os.environ.get("DEFERRED_DLQ_URL")
 
-bedrock_runtime = boto3.client(service_name="bedrock-runtime", region_name=AWS_REGION)
+# 再試行はThrottleAwareBedrockが行うので、botocore側では再試行しない
+bedrock_runtime = ThrottleAwareBedrock(
+    boto3.client(
+        service_name="bedrock-runtime",
+        region_name=AWS_REGION,
+        config=Config(retries={"mode": "standard", "total_max_attempts": 1}),
+    ),
+    max_concurrency=BEDROCK_MAX_CONCURRENCY,
+    tokens_per_minute=BEDROCK_TOKENS_PER_MINUTE,
+    chars_per_token=CHARS_PER_TOKEN,
+)
+sqs_client = boto3.client("sqs")
 textract_client = boto3.client("textract")
+s3_client = boto3.client("s3")
 dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(TABLE_NAME)
+# モデルの出力にfloatが含まれていてもそのまま書き込めるようにする
+table = DynamoTable(TABLE_NAME)
+generation_cache = (
+    GenerationCache(
+        GENERATION_CACHE_TABLE,
+        bucket_name=GENERATION_CACHE_BUCKET,
+        ttl_seconds=GENERATION_CACHE_TTL_DAYS * 24 * 3600,
+    )
+    if GENERATION_CACHE_TABLE
+    else None
+)
+textract_slots = (
+    TextractSlots(PIPELINE_STATE_TABLE, MAX_TEXTRACT_JOBS)
+    if PIPELINE_STATE_TABLE
+    else None
+)
+pipeline_state_table = (
+    dynamodb.Table(PIPELINE_STATE_TABLE) if PIPELINE_STATE_TABLE else None
+)
+# アップロードごとの処理状況を記録するテーブル（未設定なら記録しない）
+JOBS_TABLE_NAME = os.environ.get("JOBS_TABLE_NAME")
+job_tracker = JobTracker(JOBS_TABLE_NAME) if JOBS_TABLE_NAME else None
+
+
+def iter_textract_lines(job_id):
+    """Textractの結果をページネーションしながら取得し、LINEブロックを
+    (ページ番号, テキスト) の順に返す。取得済みのレスポンスは次のページを読む前に手放す"""
+    request_kwargs = {"JobId": job_id, "MaxResults": 1000}
+    while True:
+        response = textract_client.get_document_text_detection(**request_kwargs)
+        if "NextToken" not in request_kwargs:
+            # Textractの料金はページ数で決まるので、ジョブごとに1回だけ数える
+            add_metric(
+                "TextractPages", response.get("DocumentMetadata", {}).get("Pages", 0)
+            )
+        next_token = response.get("NextToken")
+        blocks = response.pop("Blocks", [])
+        del response
+        for block in blocks:
+            if block["BlockType"] == "LINE":
+                yield block.get("Page", 1), block["Text"]
+        del blocks
+        if not next_token:
+            return
+        request_kwargs["NextToken"] = next_token
 
 
 def get_textract_results(job_id):
-    """Textractジョブの結果をページネーションを考慮して全て取得する"""
-    full_text = ""
-    pages = []
+    """Textractジョブの結果を全て取得し、本文と各ページの開始位置（文字数）を返す"""
+    lines = []
+    page_offsets = []
+    offset = 0
+    current_page = None
+    for page, text in iter_textract_lines(job_id):
+        if page != current_page:
+            page_offsets.append({"page": page, "offset": offset})
+            current_page = page
+        lines.append(text)
+        offset += len(text) + 1
+
+    full_text = "\n".join(lines) + "\n" if lines else ""
+    return full_text, page_offsets
+
+
+def text_cache_key(content_hash):
+    return f"{TEXT_CACHE_PREFIX}{content_hash}.json"
+
+
+def load_cached_text(bucket, content_hash):
+    response = s3_client.get_object(Bucket=bucket, Key=text_cache_key(content_hash))
+    cached = json.loads(response["Body"].read())
+    return cached["text"], cached.get("page_offsets", [])
+
+
+def save_cached_text(bucket, content_hash, text, page_offsets):
+    """同じPDFが再アップロードされた時にOCRを省略できるよう抽出結果を保存する"""
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=text_cache_key(content_hash),
+        Body=json.dumps(
+            {"text": text, "page_offsets": page_offsets}, ensure_ascii=False
+        ).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def load_native_manifest(bucket, content_hash, run_id):
+    response = s3_client.get_object(
+        Bucket=bucket, Key=f"{NATIVE_TEXT_PREFIX}{content_hash}/{run_id}.json"
+    )
+    return json.loads(response["Body"].read())
+
+
+def parse_slice_key(key):
+    """部分PDFのキー ocr-pages/<内容ハッシュ>/<実行ID>/<番号>.pdf から
+    (実行ID, ページ範囲の番号) を取り出す"""
+    run_id, name = key.rsplit("/", 2)[1:]
+    return run_id, int(name.split(".")[0])
+
+
+def map_slice_pages(manifest, slice_index, ocr_text, ocr_page_offsets):
+    """部分PDFのOCR結果を、元のPDFのページ番号の (ページ番号, テキスト) に戻す"""
+    original_pages = manifest["slices"][slice_index]
+    return [
+        (original_pages[sub_page - 1], text)
+        for sub_page, text in split_pages(ocr_text, ocr_page_offsets)
+    ]
+
 
-    response = textract_client.get_document_text_detection(JobId=job_id)
-    pages.append(response)
+def gather_ocr_slices(bucket, content_hash, run_id, slice_index, slice_pages, total):
+    """ページ範囲ごとのOCR結果を保存し、完了した範囲を状態テーブルに記録する。
+    全ての範囲が揃った場合だけ、全範囲の (ページ番号, テキスト) を返す"""
+    parts_prefix = f"{OCR_PARTS_PREFIX}{content_hash}/{run_id}/"
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f"{parts_prefix}{slice_index}.json",
+        Body=json.dumps(slice_pages, ensure_ascii=False).encode("utf-8"),
+        ContentType="application/json",
+    )
+    # 完了した範囲の番号を集合に追加する。重複した通知では集合は変わらない。
+    # 記録は開始側が実行ごとに作り直すので、別の実行の通知では更新しない
+    key = {"pk": f"ocr#{content_hash}"}
+    try:
+        response = pipeline_state_table.update_item(
+            Key=key,
+            UpdateExpression="ADD completed :index",
+            ConditionExpression="run_id = :run_id",
+            ExpressionAttributeValues={
+                ":index": {str(slice_index)},
+                ":run_id": run_id,
+            },
+            ReturnValues="ALL_NEW",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        print(f"Ignoring OCR slice {slice_index} of a stale run {run_id}.")
+        return None
+    completed = len(response["Attributes"]["completed"])
+    print(f"OCR slice {slice_index} done ({completed}/{total}) for {content_hash}")
+    if completed < total:
+        return None
 
-    next_token = response.get("NextToken")
-    while next_token:
-        response = textract_client.get_document_text_detection(
-            JobId=job_id, NextToken=next_token
+    # 全ての範囲が揃った後の重複した通知で、二度生成しないようにする
+    try:
+        pipeline_state_table.update_item(
+            Key=key,
+            UpdateExpression="SET merged = :true",
+            ConditionExpression="run_id = :run_id AND attribute_not_exists(merged)",
+            ExpressionAttributeValues={":true": True, ":run_id": run_id},
         )
-        pages.append(response)
-        next_token = response.get("NextToken")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        print(f"OCR slices of run {run_id} were already merged.")
+        return None
+
+    def load_part(index):
+        part = s3_client.get_object(Bucket=bucket, Key=f"{parts_prefix}{index}.json")
+        return json.loads(part["Body"].read())
+
+    with ThreadPoolExecutor(max_workers=min(8, total)) as executor:
+        parts = executor.map(load_part, range(total))
+    return [(page, text) for part in parts for page, text in part]
+
+
+def reopen_ocr_slices(content_hash, run_id):
+    """結合後の処理が失敗した場合に結合済みの印を外し、再配信された通知で
+    もう一度結合して生成できるようにする"""
+    pipeline_state_table.update_item(
+        Key={"pk": f"ocr#{content_hash}"},
+        UpdateExpression="REMOVE merged",
+        ConditionExpression="run_id = :run_id",
+        ExpressionAttributeValues={":run_id": run_id},
+    )
+
+
+def track_job(job_id, state, stamps=(), **attributes):
+    if job_tracker is not None:
+        job_tracker.safe_mark(job_id, state, stamps, **attributes)
+
+
+def decode_metadata_value(value):
+    """S3は非ASCIIのユーザーメタデータをRFC 2047形式（=?UTF-8?B?...?=）で返すので元に戻す"""
+    if "=?" not in value:
+        return value
+    return str(make_header(decode_header(value)))
+
+
+def merge_native_pages(manifest, ocr_pages):
+    """OCR結果とテキストレイヤーのページを、ページ順に結合する"""
+    pages = {entry["page"]: entry["text"] for entry in manifest["pages"]}
+    pages.update(ocr_pages)
+    return join_pages(sorted(pages.items()))
+
+
+def parse_document_location(message):
+    """Textractの通知 (S3Bucket/S3ObjectName) と旧形式 (S3Object) の両方に対応する"""
+    location = message["DocumentLocation"]
+    if "S3Object" in location:
+        return location["S3Object"]["Bucket"], location["S3Object"]["Name"]
+    return location["S3Bucket"], location["S3ObjectName"]
+
+
+def estimate_tokens(text):
+    """日本語を含むテキストのトークン数を文字数から保守的に見積もる"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _split_oversized(text, max_chars):
+    """1ページだけで上限を超える場合は行単位（それでも長ければ文字数）で分割する"""
+    pieces = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        while len(line) > max_chars:
+            if current:
+                pieces.append("".join(current))
+                current, size = [], 0
+            pieces.append(line[:max_chars])
+            line = line[max_chars:]
+        if size + len(line) > max_chars and current:
+            pieces.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
 
+def split_text_into_chunks(text, page_offsets, max_tokens=None):
+    """ページ境界に揃えて、見積もりトークン数が上限以下になるようにテキストを分割する"""
+    max_chars = max(1, int((max_tokens or MAX_CHUNK_TOKENS) * CHARS_PER_TOKEN))
+    starts = [p["offset"] for p in page_offsets] or [0]
+    if starts[0] != 0:
+        starts.insert(0, 0)
+    pages = [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)])]
+
+    chunks = []
+    current = []
+    size = 0
     for page in pages:
-        for item in page["Blocks"]:
-            if item["BlockType"] == "LINE":
-                full_text += item["Text"] + "\n"
+        if len(page) > max_chars:
+            if current:
+                chunks.append("".join(current))
+                current, size = [], 0
+            chunks.extend(_split_oversized(page, max_chars))
+            continue
+        if size + len(page) > max_chars and current:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(page)
+        size += len(page)
+    if current:
+        chunks.append("".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
 
-    return full_text
 
+def spread_evenly(items, count):
+    """itemsから、先頭に偏らないよう等間隔にcount個を選ぶ（順序は保つ）"""
+    if len(items) <= count:
+        return list(items)
+    return [items[int((i + 0.5) * len(items) / count)] for i in range(count)]
 
-def generate_qa_from_text(lecture_text, num_questions, difficulty):
-    # この関数は generate-from-text のものと全く同じでOK
-    print(
-        f"Generating {num_questions} QAs with difficulty '{difficulty}' from extracted text."
+
+def merge_qa_sets(qa_sets, num_questions):
+    """各チャンクの生成結果を順番に1問ずつ取り出して統合し、重複を除いて問題数を揃える。
+    残りの問題数よりチャンクが多い周回では、文書全体から等間隔にチャンクを選ぶ"""
+    merged = []
+    seen = set()
+    queues = [list(qa_set) for qa_set in qa_sets]
+    while len(merged) < num_questions and any(queues):
+        active = [queue for queue in queues if queue]
+        for queue in spread_evenly(active, num_questions - len(merged)):
+            if len(merged) >= num_questions:
+                break
+            qa = queue.pop(0)
+            fingerprint = question_fingerprint(qa)
+            if not fingerprint or fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            merged.append(qa)
+    for i, qa in enumerate(merged, start=1):
+        qa["question_id"] = i
+    return {"qa_set": merged}
+
+
+def generate_qa_from_text(
+    lecture_text,
+    num_questions,
+    difficulty,
+    page_offsets=None,
+    cache_mode=GENERATION_CACHE_MODE,
+):
+    """テキストが長い場合はページ単位のチャンクに分け、並列に生成して統合する"""
+    if estimate_tokens(lecture_text) <= MAX_CHUNK_TOKENS:
+        return generate_qa_from_chunk(
+            lecture_text, num_questions, difficulty, cache_mode
+        )
+
+    chunks = split_text_into_chunks(lecture_text, page_offsets or [])
+    if len(chunks) > num_questions:
+        # 問題数よりチャンクが多い場合は、文書全体から等間隔に選んだチャンクだけで生成し、
+        # 呼び出し回数を問題数程度に抑える
+        print(f"Using {num_questions} of {len(chunks)} chunks spread across the text.")
+        chunks = spread_evenly(chunks, num_questions)
+    total_chars = sum(len(chunk) for chunk in chunks)
+    # 重複除去で減る分を見込んで、各チャンクの分量に応じて少し多めに作らせる
+    counts = [
+        min(
+            num_questions,
+            math.ceil(num_questions * len(chunk) / total_chars * OVERGENERATE_RATIO),
+        )
+        for chunk in chunks
+    ]
+    print(f"Splitting {len(lecture_text)} chars into {len(chunks)} chunks: {counts}")
+
+    def generate_chunk(args):
+        chunk, count = args
+        try:
+            return generate_qa_from_chunk(chunk, count, difficulty, cache_mode).get(
+                "qa_set", []
+            )
+        except BedrockUnavailable:
+            # 混雑時は文書全体を後回しにするため、失敗したチャンクとして扱わない
+            raise
+        except Exception:
+            print(f"WARNING: chunk generation failed. {traceback.format_exc()}")
+            return None
+
+    workers = max(1, min(GENERATION_CONCURRENCY, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(generate_chunk, zip(chunks, counts)))
+
+    qa_sets = [qa_set for qa_set in results if qa_set]
+    if not qa_sets:
+        raise Exception("全てのチャンクでQAの生成に失敗しました。")
+    return merge_qa_sets(qa_sets, num_questions)
+
+
+def invoke_model_text(request_body, num_questions, cache_mode=GENERATION_CACHE_MODE):
+    """Bedrockを呼び出してモデルの出力テキストを返す。同一リクエストはキャッシュから返す"""
+
+    def generate():
+        if GENERATION_MODE == "stream":
+            return stream_model_text(
+                bedrock_runtime, MODEL_ID, request_body, num_questions
+            )
+        response = bedrock_runtime.invoke_model(
+            body=json.dumps(request_body), modelId=MODEL_ID
+        )
+        response_body = json.loads(response.get("body").read())
+        qa_result_text = (
+            response_body.get("output", {})
+            .get("message", {})
+            .get("content", [{}])[0]
+            .get("text")
+        )
+        if not qa_result_text:
+            raise Exception("モデルの応答からテキストを抽出できませんでした。")
+        return qa_result_text
+
+    if generation_cache is None:
+        return generate()
+    return generation_cache.get_or_generate(
+        MODEL_ID,
+        request_body,
+        generate,
+        mode=cache_mode,
+        # 問題を1つも回収できない出力はキャッシュしない
+        is_usable=lambda text: bool(salvage_qa_set(text)["qa_set"]),
     )
+
+
+def build_request_body(lecture_text, num_questions, difficulty, exclude_questions=()):
+    exclude_rule = ""
+    if exclude_questions:
+        listed = "\n".join(f"  - {q}" for q in exclude_questions)
+        exclude_rule = f"- 次の問題とは異なる内容の問題にすること。\n{listed}\n"
     system_prompt = f"""
 あなたは、講義内容から学習者の理解度を測るための問題を作成する専門家です。
 以下のルールに従って、与えられた講義内容から質の高いQAセットを作成してください。
@@ -54,7 +483,7 @@ def generate_qa_from_text(lecture_text, num_questions, difficulty):
 - 質問形式は「一択選択式」「記述式」をバランス良く含めること。
 - {num_questions}個の問題を、難易度「{difficulty}」で作成すること。
 - 回答には、なぜそれが正解なのかの短い解説を必ず含めること。
-- 出力は必ず指定されたJSON形式のみとし、前後に余計な文章は含めないこと。
+{exclude_rule}- 出力は必ず指定されたJSON形式のみとし、前後に余計な文章は含めないこと。
 # JSON形式
 {{
   "qa_set": [
@@ -71,81 +500,232 @@ def generate_qa_from_text(lecture_text, num_questions, difficulty):
 }}
 """
     user_prompt = f"--- 講義内容 ---\n{lecture_text}"
-    request_body = {
+    return {
         "schemaVersion": "messages-v1",
         "system": [{"text": system_prompt}],
         "messages": [{"role": "user", "content": [{"text": user_prompt}]}],
         "inferenceConfig": {"maxTokens": 4096, "temperature": 0.7, "topP": 0.9},
     }
-    response = bedrock_runtime.invoke_model(
-        body=json.dumps(request_body), modelId=MODEL_ID
+
+
+def generate_qa_from_chunk(
+    lecture_text, num_questions, difficulty, cache_mode=GENERATION_CACHE_MODE
+):
+    print(
+        f"Generating {num_questions} QAs with difficulty '{difficulty}' from extracted text."
+    )
+
+    def generate_text(count, exclude_questions):
+        request_body = build_request_body(
+            lecture_text, count, difficulty, exclude_questions
+        )
+        # 不足分の再生成は前回の出力に依存するので、キャッシュを使わない
+        return invoke_model_text(
+            request_body, count, "bypass" if exclude_questions else cache_mode
+        )
+
+    # 壊れた出力や途中で途切れた出力からも問題を回収し、不足分だけを再生成する
+    return collect_questions(
+        generate_text, num_questions, max_retries=SALVAGE_RETRY_LIMIT
+    )
+
+
+class GenerationDeferralsExhausted(Exception):
+    """後回しにできる回数を使い切った"""
+
+
+def defer_generation(message, retry_after):
+    """Bedrockが混雑している間は、メッセージを遅延付きでキューに戻して後で処理する"""
+    content_hash = message.get("JobTag")
+    if content_hash and message.get("API") != "TextCache":
+        # 抽出テキストは保存済みなので、再処理ではTextractを呼ばずにキャッシュを使う
+        message = {**message, "JobId": None, "API": "TextCache"}
+    message = {**message, "DeferCount": int(message.get("DeferCount", 0)) + 1}
+    delay = min(900, int(retry_after) + random.randint(0, 30))
+    sqs_client.send_message(
+        QueueUrl=DEFERRED_QUEUE_URL,
+        MessageBody=json.dumps(message),
+        DelaySeconds=delay,
     )
-    response_body = json.loads(response.get("body").read())
-    qa_result_text = (
-        response_body.get("output", {})
-        .get("message", {})
-        .get("content", [{}])[0]
-        .get("text")
+    print(
+        f"Bedrock is unavailable. Deferred generation by {delay}s "
+        f"({message['DeferCount']}/{MAX_GENERATION_DEFERRALS})."
     )
 
-    if not qa_result_text:
-        raise Exception("モデルの応答からテキストを抽出できませんでした。")
 
-    json_match = re.search(r"\{.*\}", qa_result_text, re.DOTALL)
-    if json_match:
-        return json.loads(json_match.group(0))
-    else:
-        raise Exception("モデルの応答から有効なJSONを抽出できませんでした。")
+def dead_letter(message):
+    """再処理しても生成できないメッセージを、受信回数を待たずにデッドレターキューへ送る"""
+    sqs_client.send_message(QueueUrl=DEFERRED_DLQ_URL, MessageBody=json.dumps(message))
+    add_metric("GenerationDeferralsExhausted", 1)
+    print(f"Gave up generation after {message.get('DeferCount')} deferrals.")
 
 
+@instrument_handler
 def handler(event, context):
-    print(f"Received SNS event: {json.dumps(event)}")
+    print(f"Received event: {json.dumps(event)}")
+
+    failures = []
+    try:
+        for record in event.get("Records", []):
+            # Textractの完了通知（SNS）と、後回しにした生成処理（SQS）の両方を受け付ける
+            from_queue = record.get("eventSource") == "aws:sqs"
+            if from_queue:
+                message = json.loads(record["body"])
+            else:
+                message = json.loads(record["Sns"]["Message"])
+            try:
+                process_textract_message(message)
+            except BedrockUnavailable as e:
+                if not DEFERRED_QUEUE_URL:
+                    raise
+                defer_generation(message, e.retry_after)
+            except GenerationDeferralsExhausted:
+                if DEFERRED_DLQ_URL:
+                    dead_letter(message)
+                elif not from_queue:
+                    raise
+                else:
+                    failures.append({"itemIdentifier": record["messageId"]})
+            except Exception:
+                if not from_queue:
+                    raise
+                failures.append({"itemIdentifier": record["messageId"]})
+    finally:
+        if generation_cache is not None:
+            generation_cache.emit_metrics(context.function_name)
+    return {"batchItemFailures": failures}
 
-    # SNSメッセージからTextractのジョブ情報を取得
-    message = json.loads(event["Records"][0]["Sns"]["Message"])
+
+def process_textract_message(message):
+    # Textractのジョブ情報を取得
     job_id = message["JobId"]
     status = message["Status"]
-    s3_object_info = message["DocumentLocation"]["S3Object"]
-    bucket = s3_object_info["Bucket"]
-    key = s3_object_info["Name"]
+    # 開始側で計算したPDFの内容ハッシュ（JobTag経由で受け取る）
+    content_hash = message.get("JobTag")
+    bucket, key = parse_document_location(message)
+
+    # テキストの無いページだけを読み取った部分PDFなら、ページ範囲の番号を取り出す
+    is_slice = key.startswith(OCR_PAGES_PREFIX) and bool(content_hash)
+    run_id, slice_index = parse_slice_key(key) if is_slice else (None, 0)
+
+    # Textractのジョブは終了しているので、成否に関わらず次のPDFのためにスロットを返す
+    if (
+        textract_slots is not None
+        and message.get("API") != "TextCache"
+        and content_hash
+    ):
+        if textract_slots.release(content_hash, str(slice_index), run_id):
+            print(f"Released Textract slot for content hash: {content_hash}")
 
+    # 部分PDFの場合は、元のPDFとテキストレイヤーの結果をマニフェストから参照する
+    manifest = None
+    if is_slice:
+        manifest = load_native_manifest(bucket, content_hash, run_id)
+        key = manifest["source_key"]
+
+    job = job_id_from_key(key)
+    merged_slices = False
     if status != "SUCCEEDED":
         print(f"Textract job failed for s3://{bucket}/{key} with status: {status}")
+        track_job(job, FAILED, ("failed_at",), error=f"Textract job {status}")
         return
 
     try:
-        # Textractから文字抽出結果を取得
-        extracted_text = get_textract_results(job_id)
-        if not extracted_text.strip():
-            raise ValueError("Textract did not return any text.")
+        if message.get("API") == "TextCache":
+            # 同じ内容のPDFを処理済み: 保存済みのテキストを使う
+            extracted_text, page_offsets = load_cached_text(bucket, content_hash)
+            print(f"Using cached text for content hash: {content_hash}")
+        else:
+            # Textractから文字抽出結果を取得
+            extracted_text, page_offsets = get_textract_results(job_id)
+            if manifest is not None:
+                ocr_pages = map_slice_pages(
+                    manifest, slice_index, extracted_text, page_offsets
+                )
+                total = len(manifest["slices"])
+                if total > 1:
+                    # ページ範囲に分けてOCRした場合は、最後に終わった範囲の処理で結合する
+                    ocr_pages = gather_ocr_slices(
+                        bucket, content_hash, run_id, slice_index, ocr_pages, total
+                    )
+                    if ocr_pages is None:
+                        return {"status": "waiting_for_slices"}
+                    merged_slices = True
+                extracted_text, page_offsets = merge_native_pages(manifest, ocr_pages)
+            if not extracted_text.strip():
+                raise ValueError("Textract did not return any text.")
+            if content_hash:
+                save_cached_text(bucket, content_hash, extracted_text, page_offsets)
+        print(f"Extracted {len(extracted_text)} chars from {len(page_offsets)} pages.")
+        if message.get("API") == "TextCache":
+            track_job(job, GENERATING, ("llm_started_at",))
+        else:
+            track_job(job, GENERATING, ("ocr_completed_at", "llm_started_at"))
 
         # S3オブジェクトのメタデータを取得（Streamlitアプリから渡された情報）
-        s3_object_meta = boto3.client("s3").head_object(Bucket=bucket, Key=key)
-        metadata = s3_object_meta.get("Metadata", {})
+        s3_object_meta = s3_client.head_object(Bucket=bucket, Key=key)
+        metadata = {
+            name: decode_metadata_value(value)
+            for name, value in s3_object_meta.get("Metadata", {}).items()
+        }
         theme = metadata.get("theme", "untitled")
         lecture_number = int(metadata.get("lecture_number", 1))
         num_questions = int(metadata.get("num_questions", 5))
         difficulty = metadata.get("difficulty", "中")
+        cache_mode = metadata.get("cache_mode", GENERATION_CACHE_MODE)
 
         # BedrockでQAを生成
-        qa_json = generate_qa_from_text(extracted_text, num_questions, difficulty)
+        with timed("llm.generate_qa"):
+            qa_json = generate_qa_from_text(
+                extracted_text, num_questions, difficulty, page_offsets, cache_mode
+            )
+        llm_completed_at = utc_now()
 
         # DynamoDBに保存
         qa_set_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
         item_to_save = {
             "qa_set_id": qa_set_id,
             "qa_data": qa_json,
             "theme": theme,
             "lecture_number": lecture_number,
+            "question_count": len(qa_json.get("qa_set", [])),
+            "version": 1,
             "source_file": key,
-            "created_at": datetime.utcnow().isoformat(),
+            "created_at": now,
+            # 一覧・詳細APIのETagに使う
+            "updated_at": now,
         }
         table.put_item(Item=item_to_save)
+        add_metric("QuestionsGenerated", item_to_save["question_count"])
+
+        track_job(
+            job,
+            COMPLETED,
+            ("persisted_at",),
+            qa_set_id=qa_set_id,
+            llm_completed_at=llm_completed_at,
+        )
 
         print(f"Successfully processed and saved QA for s3://{bucket}/{key}")
         return {"status": "success"}
 
+    except BedrockUnavailable as e:
+        deferrals = int(message.get("DeferCount", 0))
+        if deferrals >= MAX_GENERATION_DEFERRALS:
+            error = f"Bedrock was unavailable after {deferrals} deferrals."
+            track_job(job, FAILED, ("failed_at",), error=error)
+            raise GenerationDeferralsExhausted(error) from e
+        track_job(job, DEFERRED, retry_after=int(e.retry_after))
+        raise
+
     except Exception as e:
         print(f"Error processing Textract result for s3://{bucket}/{key}")
         print(traceback.format_exc())
+        track_job(job, FAILED, ("failed_at",), error=str(e)[:1000])
+        if merged_slices:
+            try:
+                reopen_ocr_slices(content_hash, run_id)
+            except ClientError as reopen_error:
+                print(f"WARNING: could not reopen OCR slices: {reopen_error}")
         raise e
@@ -1,34 +1,89 @@
 import json
 import os
-import boto3
-from decimal import Decimal
 import traceback
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
+
+from qa_common.api_response import (
+    compute_etag,
+    is_not_modified,
+    item_version,
+    json_response,
+    not_modified_response,
+)
+from qa_common.codec import DynamoTable
+from qa_common.metrics import instrument_boto3, instrument_handler
+from qa_common.paging import decode_next_token, encode_next_token, parse_limit
+
+instrument_boto3()
 
 TABLE_NAME = os.environ.get("TABLE_NAME")
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(TABLE_NAME)
+# 数値をDecimalを経由せずにint/floatで読む
+table = DynamoTable(TABLE_NAME)
+
+# 1ページあたりの件数（limitパラメータ未指定時と上限）
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "20"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "100"))
+
+# view=summary の時に返すヘッダー項目（qa_dataやsubmissionsは読み込まない）
+SUMMARY_ATTRIBUTES = [
+    "qa_set_id",
+    "theme",
+    "lecture_number",
+    "created_at",
+    "source_file",
+    "question_count",
+    # ETagの計算に使う
+    "version",
+    "updated_at",
+]
+
+
+def parse_lecture_number(value):
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        raise ValueError(f"lecture_numberが不正です: {value}")
 
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            if obj % 1 == 0:
-                return int(obj)
-            else:
-                return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+def build_summary_projection():
+    """予約語と衝突しないようにプレースホルダ付きのProjectionExpressionを作る"""
+    names = {f"#a{i}": name for i, name in enumerate(SUMMARY_ATTRIBUTES)}
+    return {
+        "ProjectionExpression": ", ".join(names.keys()),
+        "ExpressionAttributeNames": names,
+    }
 
 
+@instrument_handler
 def handler(event, context):
     print(f"Received event: {json.dumps(event)}")
 
     # クエリパラメータを取得
-    params = event.get("queryStringParameters")
+    params = event.get("queryStringParameters") or {}
+
+    try:
+        request_kwargs = {
+            "Limit": parse_limit(params.get("limit"), DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        }
+        lecture_number = parse_lecture_number(params.get("lecture_number"))
+        if params.get("next_token"):
+            request_kwargs["ExclusiveStartKey"] = decode_next_token(
+                params["next_token"]
+            )
+    except ValueError as e:
+        return create_error_response(400, str(e))
+
+    view = params.get("view", "full")
+    if view not in ("full", "summary"):
+        return create_error_response(400, f"viewが不正です: {view}")
+    if view == "summary":
+        request_kwargs.update(build_summary_projection())
 
     try:
 
-        if params and "theme" in params:
+        if params.get("theme"):
             theme = params["theme"]
             print(f"Querying for theme: {theme}")
 
@@ -36,35 +91,53 @@ def handler(event, context):
             key_condition_expression = Key("theme").eq(theme)
 
             # もし'lecture_number'もあれば、検索条件に追加
-            if "lecture_number" in params and params["lecture_number"]:
-                try:
-                    lecture_num = int(params["lecture_number"])
-                    key_condition_expression = key_condition_expression & Key(
-                        "lecture_number"
-                    ).eq(lecture_num)
-                    print(f"Adding lecture_number filter: {lecture_num}")
-                except (ValueError, TypeError):
-                    # lecture_numberが不正な値の場合は無視する
-                    print(
-                        f"Invalid lecture_number parameter ignored: {params['lecture_number']}"
-                    )
-                    pass
+            if lecture_number is not None:
+                key_condition_expression = key_condition_expression & Key(
+                    "lecture_number"
+                ).eq(lecture_number)
+                print(f"Adding lecture_number filter: {lecture_number}")
 
             # インデックス(GSI)を使ってクエリを実行
+            # GSIは強い整合性の読み込みに対応していないため、結果整合性で読む
             response = table.query(
                 IndexName="ThemeLectureIndex",
                 KeyConditionExpression=key_condition_expression,
+                **request_kwargs,
             )
 
         else:
-            # パラメータがなければ、これまで通り全件取得
-            print("No theme parameter found. Scanning for all items.")
-
-        response = table.scan(ConsistentRead=True)
+            # パラメータがなければ、ページ単位でスキャンする
+            # 強い整合性はRCUが2倍になるため、明示的に指定された場合のみ使う
+            consistent_read = params.get("consistent_read", "").lower() == "true"
+            print(f"No theme parameter found. Scanning (consistent={consistent_read}).")
+            if lecture_number is not None:
+                # インデックスのパーティションキーはthemeなので、講義回数だけの絞り込みは
+                # スキャンのフィルターで行う（読み込み量は絞り込まない場合と変わらず、
+                # 1ページの件数がlimitより少なくなることがある）
+                request_kwargs["FilterExpression"] = Attr("lecture_number").eq(
+                    lecture_number
+                )
+            response = table.scan(ConsistentRead=consistent_read, **request_kwargs)
 
         items = response.get("Items", [])
-        print(f"Found {len(items)} items with strong consistency.")
-        return create_success_response(items)
+        next_token = encode_next_token(response.get("LastEvaluatedKey"))
+        print(f"Found {len(items)} items (has_more={next_token is not None}).")
+
+        # 一覧のETagは、検索条件と各項目の版数・更新日時から作る
+        etag = compute_etag(
+            view,
+            sorted(params.items()),
+            [item_version(item) for item in items],
+            next_token,
+        )
+        if is_not_modified(event, etag):
+            print("Listing not modified. Returning 304.")
+            return not_modified_response(etag)
+        return create_success_response(
+            {"items": items, "count": len(items), "next_token": next_token},
+            event,
+            etag,
+        )
 
     except Exception as e:
         print(f"ERROR: An unexpected error occurred. {traceback.format_exc()}")
@@ -73,15 +146,8 @@ def handler(event, context):
         )
 
 
-def create_success_response(body):
-    return {
-        "statusCode": 200,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*",
-        },
-        "body": json.dumps(body, ensure_ascii=False, cls=DecimalEncoder),
-    }
+def create_success_response(body, event, etag=None):
+    return json_response(event, body, etag=etag)
 
 
 def create_error_response(status_code, error_message):
@@ -0,0 +1,76 @@
+import json
+import os
+import traceback
+from boto3.dynamodb.conditions import Key
+
+from qa_common.codec import DynamoTable, dumps
+from qa_common.metrics import instrument_boto3, instrument_handler
+from qa_common.paging import decode_next_token, encode_next_token, parse_limit
+
+instrument_boto3()
+
+SUBMISSIONS_TABLE_NAME = os.environ.get("SUBMISSIONS_TABLE_NAME")
+# 数値をDecimalを経由せずにint/floatで読む
+submissions_table = DynamoTable(SUBMISSIONS_TABLE_NAME)
+
+DEFAULT_PAGE_SIZE = int(os.environ.get("DEFAULT_PAGE_SIZE", "20"))
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "100"))
+
+
+@instrument_handler
+def handler(event, context):
+    print(f"Received event: {json.dumps(event)}")
+    qa_set_id = event["pathParameters"]["id"]
+    params = event.get("queryStringParameters") or {}
+
+    try:
+        request_kwargs = {
+            "Limit": parse_limit(params.get("limit"), DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        }
+        if params.get("next_token"):
+            request_kwargs["ExclusiveStartKey"] = decode_next_token(
+                params["next_token"], partition=qa_set_id
+            )
+    except ValueError as e:
+        return create_error_response(400, str(e))
+
+    try:
+        # submission_idは時刻順に並ぶので、新しい提出から順に返す
+        response = submissions_table.query(
+            KeyConditionExpression=Key("qa_set_id").eq(qa_set_id),
+            ScanIndexForward=False,
+            **request_kwargs,
+        )
+        items = response.get("Items", [])
+        next_token = encode_next_token(response.get("LastEvaluatedKey"))
+        return create_success_response(
+            {"items": items, "count": len(items), "next_token": next_token}
+        )
+
+    except Exception as e:
+        print(f"ERROR: An unexpected error occurred. {traceback.format_exc()}")
+        return create_error_response(
+            500, f"提出履歴の取得中に予期せぬエラーが発生しました: {str(e)}"
+        )
+
+
+def create_success_response(body):
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+        },
+        "body": dumps(body),
+    }
+
+
+def create_error_response(status_code, error_message):
+    return {
+        "statusCode": status_code,
+        "headers": {
+            "Content-Type": "application/json",
+            "Access-Control-Allow-Origin": "*",
+        },
+        "body": json.dumps({"error": error_message}, ensure_ascii=False),
+    }
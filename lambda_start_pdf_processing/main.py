@@ -1,40 +1,461 @@
 # lambda_start_pdf_processing/main.py
 import os
 import boto3
+import hashlib
+import io
+import math
+import random
+import tempfile
+import time
+import traceback
 import urllib.parse
+import uuid
 import json
+from botocore.exceptions import ClientError
+from pypdf import PdfReader, PdfWriter
+
+from qa_common.jobs import FAILED, OCR_RUNNING, UPLOADED, JobTracker, job_id_from_key
+from qa_common.metrics import add_metric, instrument_boto3, instrument_handler, timed
+from qa_common.page_text import join_pages
+from qa_common.textract_slots import TextractSlots
+
+instrument_boto3()
 
 textract_client = boto3.client("textract")
+s3_client = boto3.client("s3")
+sns_client = boto3.client("sns")
+sqs_client = boto3.client("sqs")
 SNS_TOPIC_ARN = os.environ.get("SNS_TOPIC_ARN")
 TEXTRACT_ROLE_ARN = os.environ.get("TEXTRACT_ROLE_ARN")
+# 抽出済みテキストをPDFの内容ハッシュごとに保存するS3プレフィックス
+TEXT_CACHE_PREFIX = os.environ.get("TEXT_CACHE_PREFIX", "text-cache/")
+# テキストレイヤーのあるページはTextractを使わずにPDFから直接読み取る
+NATIVE_EXTRACTION = os.environ.get("NATIVE_EXTRACTION", "true").lower() == "true"
+# この文字数（空白を除く）未満のページはスキャン画像とみなしてTextractに回す
+NATIVE_MIN_CHARS = int(os.environ.get("NATIVE_MIN_CHARS", "20"))
+# Textractに回すページだけの部分PDFと、結合用マニフェストの保存先
+OCR_PAGES_PREFIX = os.environ.get("OCR_PAGES_PREFIX", "ocr-pages/")
+NATIVE_TEXT_PREFIX = os.environ.get("NATIVE_TEXT_PREFIX", "native-text/")
+# OCRするページがこれより多い場合は、ページ範囲に分けて並列にTextractを実行する
+OCR_SLICE_PAGES = int(os.environ.get("OCR_SLICE_PAGES", "50"))
+# S3のアップロード通知を受けるSQSキュー（上限到達時の再試行間隔の調整に使う）
+INTAKE_QUEUE_URL = os.environ.get("INTAKE_QUEUE_URL")
+DEFER_SECONDS = int(os.environ.get("DEFER_SECONDS", "30"))
+# 上限待ちで入れ直せる回数。超えたらジョブを失敗にしてデッドレターキューへ送る
+MAX_CAPACITY_DEFERRALS = int(os.environ.get("MAX_CAPACITY_DEFERRALS", "20"))
+INTAKE_DLQ_URL = os.environ.get("INTAKE_DLQ_URL")
+# 実行中のTextractジョブ数の上限（テーブル未設定なら上限を管理しない）
+PIPELINE_STATE_TABLE = os.environ.get("PIPELINE_STATE_TABLE")
+MAX_TEXTRACT_JOBS = int(os.environ.get("MAX_TEXTRACT_JOBS", "10"))
+# 完了通知が届かなかったリースを期限切れとみなすまでの秒数
+TEXTRACT_LEASE_TTL_SECONDS = int(os.environ.get("TEXTRACT_LEASE_TTL_SECONDS", "21600"))
+# 上限に達した時にカウンターを照合する最短間隔（コンテナごと）
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get("RECONCILE_INTERVAL_SECONDS", "300"))
+textract_slots = (
+    TextractSlots(
+        PIPELINE_STATE_TABLE,
+        MAX_TEXTRACT_JOBS,
+        lease_ttl_seconds=TEXTRACT_LEASE_TTL_SECONDS,
+    )
+    if PIPELINE_STATE_TABLE
+    else None
+)
+pipeline_state_table = (
+    boto3.resource("dynamodb").Table(PIPELINE_STATE_TABLE)
+    if PIPELINE_STATE_TABLE
+    else None
+)
+_last_reconciled = 0.0
+# 開始APIのTPS上限などで拒否された場合は、その場で数回再試行し、それでも駄目ならメッセージごと後で再試行する
+START_RETRIES = int(os.environ.get("START_RETRIES", "4"))
+# アップロードごとの処理状況を記録するテーブル（未設定なら記録しない）
+JOBS_TABLE_NAME = os.environ.get("JOBS_TABLE_NAME")
+job_tracker = JobTracker(JOBS_TABLE_NAME) if JOBS_TABLE_NAME else None
+THROTTLING_ERROR_CODES = (
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+    "ThrottlingException",
+)
 
 
-def handler(event, context):
-    print(f"Received S3 event: {json.dumps(event)}")
+def download_and_hash(bucket, key, fileobj):
+    """S3オブジェクトをストリームで一時ファイルに書き出しながらSHA-256を計算する"""
+    digest = hashlib.sha256()
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    for chunk in body.iter_chunks(chunk_size=1024 * 1024):
+        digest.update(chunk)
+        fileobj.write(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def text_cache_exists(bucket, content_hash):
+    try:
+        s3_client.head_object(
+            Bucket=bucket, Key=f"{TEXT_CACHE_PREFIX}{content_hash}.json"
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def publish_cached_text_notification(bucket, key, content_hash):
+    """Textractの完了通知と同じ形式でSNSに通知し、OCRを飛ばしてQA生成に進める"""
+    message = {
+        "JobId": None,
+        "Status": "SUCCEEDED",
+        "API": "TextCache",
+        "JobTag": content_hash,
+        "DocumentLocation": {"S3ObjectName": key, "S3Bucket": bucket},
+    }
+    sns_client.publish(TopicArn=SNS_TOPIC_ARN, Message=json.dumps(message))
+
+
+class TextractCapacityExceeded(Exception):
+    """同時実行数の上限、またはTextractのスロットリングで開始できなかった"""
+
+
+def parse_s3_records(sqs_record):
+    """SQSメッセージ本文のS3イベント通知から(バケット, キー, アップロード時刻)を取り出す"""
+    body = json.loads(sqs_record["body"])
+    # 通知設定時にS3が送るテストイベントには処理対象がない
+    if body.get("Event") == "s3:TestEvent":
+        return []
+    return [
+        (
+            record["s3"]["bucket"]["name"],
+            urllib.parse.unquote_plus(record["s3"]["object"]["key"], encoding="utf-8"),
+            record.get("eventTime"),
+        )
+        for record in body.get("Records", [])
+    ]
+
 
-    # S3イベントからバケット名とオブジェクトキーを取得
-    bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    key = urllib.parse.unquote_plus(
-        event["Records"][0]["s3"]["object"]["key"], encoding="utf-8"
+def track_job(key, state, stamps=(), at=None, **attributes):
+    if job_tracker is not None:
+        job_tracker.safe_mark(job_id_from_key(key), state, stamps, at, **attributes)
+
+
+def is_throttling_error(error):
+    return (
+        isinstance(error, ClientError)
+        and error.response["Error"]["Code"] in THROTTLING_ERROR_CODES
     )
 
+
+def start_textract_job(bucket, key, content_hash):
+    """Textractの非同期処理を開始する。開始APIのTPS上限に当たった場合は少し待って再試行する"""
     # Textractに渡すS3オブジェクトの情報を設定
     document_location = {"S3Object": {"Bucket": bucket, "Name": key}}
 
-    # Textractの非同期処理を開始
     # 処理完了後、SNSトピックに通知を送信するように設定
+    # JobTagに内容ハッシュを渡し、結果処理側で抽出テキストのキャッシュとスロットの返却に使う
+    for attempt in range(START_RETRIES):
+        try:
+            response = textract_client.start_document_text_detection(
+                DocumentLocation=document_location,
+                NotificationChannel={
+                    "SNSTopicArn": SNS_TOPIC_ARN,
+                    "RoleArn": TEXTRACT_ROLE_ARN,
+                },
+                JobTag=content_hash,
+            )
+            break
+        except ClientError as e:
+            if not is_throttling_error(e) or attempt == START_RETRIES - 1:
+                raise
+            time.sleep(random.uniform(0, 2**attempt))
+    print(
+        f"Started Textract job with ID: {response['JobId']} for document: s3://{bucket}/{key}"
+    )
+
+
+def acquire_slots(content_hash, lease, slots):
+    """スロットを確保する。空きが無ければ、返却されずに残ったスロットが無いか
+    カウンターを照合し、取り戻せた場合だけもう一度試す"""
+    global _last_reconciled
+    if textract_slots.acquire(content_hash, lease, slots=slots):
+        return True
+    if time.monotonic() - _last_reconciled < RECONCILE_INTERVAL_SECONDS:
+        return False
+    _last_reconciled = time.monotonic()
+    if textract_slots.reconcile() <= 0:
+        return False
+    return textract_slots.acquire(content_hash, lease, slots=slots)
+
+
+def reserve_text_detection(bucket, keys, content_hash, run_id=None):
+    """ページ範囲の数だけスロットを確保する。空きが無ければTextractCapacityExceeded"""
+    lease = {"bucket": bucket, "key": keys[0]}
+    if run_id is not None:
+        lease["run_id"] = run_id
+    if textract_slots is not None and not acquire_slots(content_hash, lease, len(keys)):
+        raise TextractCapacityExceeded(
+            f"No room for {len(keys)} Textract jobs under the limit of {MAX_TEXTRACT_JOBS}."
+        )
+
+
+def release_text_detection(content_hash, parts, run_id=None):
+    if textract_slots is not None:
+        for part in parts:
+            textract_slots.release(content_hash, str(part), run_id)
+
+
+def start_text_detection(bucket, keys, content_hash, run_id=None, reserved=False):
+    """ページ範囲の数だけスロットを確保してから、各範囲のTextractの処理を並列に開始する"""
+    if not reserved:
+        reserve_text_detection(bucket, keys, content_hash, run_id)
+
+    for index, key in enumerate(keys):
+        try:
+            start_textract_job(bucket, key, content_hash)
+        except Exception as e:
+            # 開始できなかったページ範囲の分のスロットを返す
+            release_text_detection(content_hash, range(index, len(keys)), run_id)
+            if is_throttling_error(e):
+                raise TextractCapacityExceeded(str(e)) from e
+            raise
+
+
+def plan_ocr_slices(pages):
+    """OCRするページを連続したページ範囲に分ける。範囲の数は同時実行数の上限を超えない"""
+    if textract_slots is None:
+        # 完了の集約に状態テーブルを使うため、テーブルが無ければ分割しない
+        return [pages]
+    size = max(OCR_SLICE_PAGES, math.ceil(len(pages) / MAX_TEXTRACT_JOBS))
+    return [pages[i : i + size] for i in range(0, len(pages), size)]
+
+
+def save_cached_text(bucket, content_hash, text, page_offsets):
+    """結果処理側と同じ形式で、抽出テキストをテキストキャッシュに保存する"""
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=f"{TEXT_CACHE_PREFIX}{content_hash}.json",
+        Body=json.dumps(
+            {"text": text, "page_offsets": page_offsets}, ensure_ascii=False
+        ).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def extract_native_pages(reader):
+    """PDFのテキストレイヤーからページごとに文字を取り出す。
+    (テキストを取れたページのリスト, 取れなかったページ番号のリスト) を返す"""
+    pages = []
+    missing = []
+    for number, page in enumerate(reader.pages, start=1):
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:
+            print(f"WARNING: text extraction failed on page {number}: {e}")
+            text = ""
+        # スキャン画像のページでも、ページ番号などの短い文字だけは取れることがある
+        if len("".join(text.split())) >= NATIVE_MIN_CHARS:
+            pages.append((number, text))
+        else:
+            missing.append(number)
+    return pages, missing
+
+
+def reset_slice_fan_in(content_hash, run_id, total):
+    """結果処理側が範囲ごとの完了を集める記録を、この実行のrun_idで作り直す"""
+    pipeline_state_table.put_item(
+        Item={
+            "pk": f"ocr#{content_hash}",
+            "run_id": run_id,
+            "slice_count": total,
+            "expires_at": int(time.time()) + 24 * 3600,
+        }
+    )
+
+
+def ocr_slice_keys(content_hash, run_id, count):
+    """部分PDFのキー ocr-pages/<内容ハッシュ>/<実行ID>/<番号>.pdf。同じ内容のPDFが
+    続けてアップロードされても、前の実行の部分PDFとマニフェストを上書きしない"""
+    return [f"{OCR_PAGES_PREFIX}{content_hash}/{run_id}/{i}.pdf" for i in range(count)]
+
+
+def save_ocr_slices(
+    bucket, key, slice_keys, manifest_key, reader, native_pages, slices
+):
+    """ページ範囲ごとにOCRするページだけのPDFを作り、結合用のマニフェストと一緒に保存する"""
+    for slice_key, pages in zip(slice_keys, slices):
+        writer = PdfWriter()
+        for number in pages:
+            writer.add_page(reader.pages[number - 1])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        s3_client.put_object(Bucket=bucket, Key=slice_key, Body=buffer.getvalue())
+
+    manifest = {
+        "source_key": key,
+        # 部分PDF slices[n] の i ページ目が元のPDFの slices[n][i-1] ページ目にあたる
+        "slices": slices,
+        "pages": [{"page": number, "text": text} for number, text in native_pages],
+    }
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=manifest_key,
+        Body=json.dumps(manifest, ensure_ascii=False).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def process_document(bucket, key):
+    with tempfile.TemporaryFile() as pdf_file:
+        # 同じ内容のPDFが既に処理済みなら、抽出済みテキストを使ってOCRを省略する
+        content_hash = download_and_hash(bucket, key, pdf_file)
+        if text_cache_exists(bucket, content_hash):
+            track_job(key, UPLOADED, text_source="cache")
+            publish_cached_text_notification(bucket, key, content_hash)
+            print(f"Text cache hit ({content_hash}) for document: s3://{bucket}/{key}")
+            return
+
+        if NATIVE_EXTRACTION:
+            try:
+                reader = PdfReader(pdf_file)
+                with timed("pdf.extract_native_pages"):
+                    native_pages, missing = extract_native_pages(reader)
+            except Exception as e:
+                # 読めないPDFは全ページをTextractに任せる
+                print(f"WARNING: native extraction failed for s3://{bucket}/{key}: {e}")
+                native_pages, missing = [], []
+            print(
+                f"Native text layer: {len(native_pages)} pages with text, "
+                f"{len(missing)} pages without."
+            )
+
+            if native_pages and not missing:
+                # 全ページにテキストレイヤーがある: Textractを使わずにQA生成へ進める
+                text, page_offsets = join_pages(native_pages)
+                save_cached_text(bucket, content_hash, text, page_offsets)
+                track_job(key, UPLOADED, text_source="native")
+                publish_cached_text_notification(bucket, key, content_hash)
+                print(f"Extracted text layer of s3://{bucket}/{key} without Textract.")
+                return
+            # テキストの無いページだけをTextractで読み取り、結果処理側で結合する。
+            # 大きなPDFはページ範囲に分けて並列にOCRする
+            slices = plan_ocr_slices(missing)
+            if native_pages or len(slices) > 1:
+                run_id = uuid.uuid4().hex
+                slice_keys = ocr_slice_keys(content_hash, run_id, len(slices))
+                # スロットを確保できた実行だけが部分PDFとマニフェストを書き込む
+                reserve_text_detection(bucket, slice_keys, content_hash, run_id)
+                try:
+                    if len(slices) > 1:
+                        reset_slice_fan_in(content_hash, run_id, len(slices))
+                    save_ocr_slices(
+                        bucket,
+                        key,
+                        slice_keys,
+                        f"{NATIVE_TEXT_PREFIX}{content_hash}/{run_id}.json",
+                        reader,
+                        native_pages,
+                        slices,
+                    )
+                except Exception:
+                    release_text_detection(content_hash, range(len(slice_keys)), run_id)
+                    raise
+                print(f"Starting OCR for {len(missing)} pages in {len(slices)} slices.")
+                start_text_detection(
+                    bucket, slice_keys, content_hash, run_id, reserved=True
+                )
+                track_job(
+                    key,
+                    OCR_RUNNING,
+                    ("ocr_started_at",),
+                    text_source="ocr",
+                    ocr_pages=len(missing),
+                    ocr_jobs=len(slice_keys),
+                )
+                return
+
+    start_text_detection(bucket, [key], content_hash)
+    track_job(key, OCR_RUNNING, ("ocr_started_at",), text_source="ocr", ocr_jobs=1)
+
+
+def deferral_count(sqs_record):
+    attribute = sqs_record.get("messageAttributes", {}).get("Deferrals")
+    return int(attribute["stringValue"]) if attribute else 0
+
+
+def defer_message(sqs_record):
+    """上限に達したメッセージを、遅延付きでキューに入れ直す。失敗として返すと受信回数に
+    数えられ、上限待ちだけでデッドレターキューに送られてしまうため。
+    入れ直せた場合はTrue（元のメッセージは処理済みとして消してよい）を返す"""
+    if not INTAKE_QUEUE_URL:
+        return False
+    deferrals = deferral_count(sqs_record)
+    if deferrals >= MAX_CAPACITY_DEFERRALS:
+        return dead_letter(sqs_record, deferrals)
+    # 待つ回数が増えるほど間隔を空ける（SQSの遅延の上限は15分）
+    delay = min(900, DEFER_SECONDS * 2 ** min(deferrals, 5))
     try:
-        response = textract_client.start_document_text_detection(
-            DocumentLocation=document_location,
-            NotificationChannel={
-                "SNSTopicArn": SNS_TOPIC_ARN,
-                "RoleArn": TEXTRACT_ROLE_ARN,
+        sqs_client.send_message(
+            QueueUrl=INTAKE_QUEUE_URL,
+            MessageBody=sqs_record["body"],
+            DelaySeconds=random.randint(delay // 2, delay),
+            MessageAttributes={
+                "Deferrals": {"DataType": "Number", "StringValue": str(deferrals + 1)}
             },
         )
-        print(
-            f"Started Textract job with ID: {response['JobId']} for document: s3://{bucket}/{key}"
-        )
-        return {"statusCode": 200, "body": json.dumps("Textract job started.")}
-    except Exception as e:
-        print(f"Error starting Textract job: {e}")
-        raise e
+        return True
+    except ClientError as e:
+        # 入れ直せなければ失敗として返し、キューの可視性タイムアウト後に再配信させる
+        print(f"WARNING: could not re-enqueue deferred message: {e}")
+        return False
+
+
+def dead_letter(sqs_record, deferrals):
+    """上限待ちを繰り返しても開始できないメッセージのジョブを失敗にし、
+    受信回数を待たずにデッドレターキューへ送る。送れた場合はTrueを返す"""
+    error = f"Textract capacity was unavailable after {deferrals} deferrals."
+    for _, key, _ in parse_s3_records(sqs_record):
+        track_job(key, FAILED, ("failed_at",), error=error)
+    add_metric("CapacityDeferralsExhausted", 1)
+    print(f"Gave up message {sqs_record['messageId']}: {error}")
+    if not INTAKE_DLQ_URL:
+        return False
+    try:
+        sqs_client.send_message(QueueUrl=INTAKE_DLQ_URL, MessageBody=sqs_record["body"])
+        return True
+    except ClientError as e:
+        print(f"WARNING: could not send message to the dead-letter queue: {e}")
+        return False
+
+
+@instrument_handler
+def handler(event, context):
+    """SQSのバッチを処理し、処理できなかったメッセージだけを失敗として返す"""
+    records = event.get("Records", [])
+    print(f"Received {len(records)} SQS messages.")
+
+    failures = []
+    capacity_exhausted = False
+    for sqs_record in records:
+        message_id = sqs_record["messageId"]
+        # 上限に達した後のメッセージは試さずに再試行へ回す
+        if capacity_exhausted:
+            if not defer_message(sqs_record):
+                failures.append({"itemIdentifier": message_id})
+            continue
+        try:
+            for bucket, key, event_time in parse_s3_records(sqs_record):
+                # アップロードの完了時刻はS3イベントの時刻を使う（キューで待った時間を含めない）
+                track_job(key, UPLOADED, ("uploaded_at",), at=event_time)
+                process_document(bucket, key)
+        except TextractCapacityExceeded as e:
+            print(f"Deferring message {message_id}: {e}")
+            capacity_exhausted = True
+            if not defer_message(sqs_record):
+                failures.append({"itemIdentifier": message_id})
+        except Exception:
+            print(f"ERROR: failed to process message {message_id}.")
+            print(traceback.format_exc())
+            failures.append({"itemIdentifier": message_id})
+
+    if failures:
+        print(f"{len(failures)} of {len(records)} messages will be retried.")
+    return {"batchItemFailures": failures}
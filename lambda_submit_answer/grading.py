@@ -0,0 +1,118 @@
+# lambda_submit_answer/grading.py
+# 記述式問題のキーワード採点エンジン
+import unicodedata
+from collections import deque
+
+# 正規化時に取り除く文字カテゴリ（句読点・記号の区切り・空白類）
+_STRIP_CATEGORIES = ("P", "Z", "C")
+# カタカナ（ァ〜ヶ）をひらがなに寄せるためのオフセット
+_KATAKANA_START = 0x30A1
+_KATAKANA_END = 0x30F6
+_KANA_OFFSET = 0x60
+
+
+def normalize_text(text):
+    """NFKC正規化・小文字化・カタカナ→ひらがな・空白と句読点の除去を1パスで行う"""
+    normalized = unicodedata.normalize("NFKC", str(text or "")).casefold()
+    chars = []
+    for ch in normalized:
+        code = ord(ch)
+        if _KATAKANA_START <= code <= _KATAKANA_END:
+            chars.append(chr(code - _KANA_OFFSET))
+        elif unicodedata.category(ch)[0] not in _STRIP_CATEGORIES:
+            chars.append(ch)
+    return "".join(chars)
+
+
+def _keyword_variants(entry):
+    """scoring_keywordsの1要素から(見出し語, 同義語を含む表記のリスト)を取り出す
+
+    要素は次のいずれかの形式を受け付ける。
+    - "キーワード" または "キーワード|同義語"
+    - ["キーワード", "同義語", ...]
+    - {"keyword": "キーワード", "synonyms": ["同義語", ...]}
+    """
+    if isinstance(entry, dict):
+        label = entry.get("keyword", "")
+        variants = [label, *entry.get("synonyms", [])]
+    elif isinstance(entry, (list, tuple)):
+        variants = list(entry)
+        label = variants[0] if variants else ""
+    else:
+        variants = str(entry or "").split("|")
+        label = variants[0]
+    return str(label), [str(v) for v in variants]
+
+
+class KeywordMatcher:
+    """全キーワードと同義語を1つのAho-Corasickオートマトンにまとめた照合器。
+    回答の長さに対して線形時間で、どのキーワードが含まれるかを判定する"""
+
+    def __init__(self, scoring_keywords):
+        self.labels = []
+        # 各ノードの遷移・失敗リンク・そのノードで一致するキーワード番号
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+
+        for entry in scoring_keywords or []:
+            label, variants = _keyword_variants(entry)
+            patterns = {normalize_text(v) for v in variants} - {""}
+            if not patterns:
+                continue
+            index = len(self.labels)
+            self.labels.append(label)
+            for pattern in patterns:
+                self._add_pattern(pattern, index)
+        self._build_failure_links()
+
+    def _add_pattern(self, pattern, index):
+        node = 0
+        for ch in pattern:
+            next_node = self._goto[node].get(ch)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][ch] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+            node = next_node
+        self._output[node].add(index)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._output[child] |= self._output[self._fail[child]]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def find(self, normalized_answer):
+        """正規化済みの回答に含まれるキーワード番号の集合を返す"""
+        found = set()
+        node = 0
+        for ch in normalized_answer:
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            if self._output[node]:
+                found |= self._output[node]
+                if len(found) == len(self.labels):
+                    break
+        return found
+
+    def score(self, answer):
+        """キーワードごとの一致結果と部分点（一致数 / キーワード数）を返す"""
+        found = self.find(normalize_text(answer)) if self.labels else set()
+        hits = [
+            {"keyword": label, "hit": i in found} for i, label in enumerate(self.labels)
+        ]
+        partial_score = len(found) / len(self.labels) if self.labels else 0.0
+        return hits, partial_score
@@ -1,98 +1,220 @@
-from decimal import Decimal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
-import boto3
+import random
+import statistics
+import time
 import traceback
 import uuid
+from datetime import datetime, timezone
+
+from grading import KeywordMatcher, normalize_text
+from qa_common.api_response import json_body
+from qa_common.codec import DynamoTable, dumps, serialize_item, serialize_request
+from qa_common.metrics import instrument_boto3, instrument_handler
+
+instrument_boto3()
 
 TABLE_NAME = os.environ.get("TABLE_NAME")
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(TABLE_NAME)
+SUBMISSIONS_TABLE_NAME = os.environ.get("SUBMISSIONS_TABLE_NAME")
+# 実行環境内に保持する採点キーの最大件数
+ANSWER_KEY_CACHE_SIZE = int(os.environ.get("ANSWER_KEY_CACHE_SIZE", "128"))
+# 一括採点の設定
+# API Gatewayのタイムアウト（30秒）と応答の上限（6MB）に収まる件数
+MAX_BATCH_SHEETS = int(os.environ.get("MAX_BATCH_SHEETS", "500"))
+# 応答がこれを超える場合は、答案ごとの設問別の結果を省いて返す
+MAX_RESPONSE_BYTES = int(os.environ.get("MAX_RESPONSE_BYTES", str(5 * 1024 * 1024)))
+BATCH_WRITE_CONCURRENCY = int(os.environ.get("BATCH_WRITE_CONCURRENCY", "4"))
+BATCH_WRITE_MAX_ATTEMPTS = int(os.environ.get("BATCH_WRITE_MAX_ATTEMPTS", "6"))
+BATCH_WRITE_CHUNK_SIZE = 25  # BatchWriteItemの1リクエストあたりの上限
+# 数値はint/floatのまま読み書きする（Decimalへの変換とそのための項目のコピーを省く）
+table = DynamoTable(TABLE_NAME)
+dynamodb_client = table.client
 
+# qa_set_id -> 採点キー（ウォームスタート間で再利用されるLRUキャッシュ）
+_answer_key_cache = OrderedDict()
 
-def default_json_serializer(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
+class StaleAnswerKeyError(Exception):
+    """キャッシュした採点キーのversionがDB上のQAセットと一致しない"""
 
-def convert_floats_to_decimal(obj):
-    if isinstance(obj, list):
-        return [convert_floats_to_decimal(i) for i in obj]
-    elif isinstance(obj, dict):
-        return {k: convert_floats_to_decimal(v) for k, v in obj.items()}
-    elif isinstance(obj, float):
-        return Decimal(str(obj))  # strを経由して精度を守る
-    else:
-        return obj
 
+def new_submission_id():
+    """ソートキーとして時系列順に並ぶ提出IDを生成する（ミリ秒時刻 + ランダム部）"""
+    return f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:12]}"
 
-def handler(event, context):
-    try:
-        qa_set_id = event["pathParameters"]["id"]
-        submission_body = json.loads(event["body"])
-        user_answers = submission_body.get("answers", [])
 
-        # DBから正解データを取得
-        response = table.get_item(Key={"qa_set_id": qa_set_id})
-        item = response.get("Item")
-        if not item:
-            return create_error_response(404, "指定されたQAセットが見つかりません。")
+def compile_answer_key(qa_set, version):
+    """qa_setから採点に必要な情報だけを取り出し、正規化済みの採点キーを作る"""
+    questions = []
+    for qa in qa_set:
+        questions.append(
+            {
+                "question_id": qa.get("question_id"),
+                "type": qa.get("type"),
+                "correct_answer": normalize_text(qa.get("correct_answer")),
+                "keywords": KeywordMatcher(qa.get("scoring_keywords", [])),
+            }
+        )
+    return {"version": version, "questions": questions}
+
+
+def load_answer_key(qa_set_id):
+    """採点に必要な属性だけをProjectionExpressionで読み込む。存在しなければNone"""
+    response = table.get_item(
+        Key={"qa_set_id": qa_set_id},
+        ProjectionExpression="qa_set_id, qa_data.qa_set, #version",
+        ExpressionAttributeNames={"#version": "version"},
+    )
+    item = response.get("Item")
+    if not item:
+        return None
+    return compile_answer_key(
+        item.get("qa_data", {}).get("qa_set", []), item.get("version")
+    )
 
-        correct_answers = item.get("qa_data", {}).get("qa_set", [])
 
-        # 採点処理
-        score = 0
-        total = len(correct_answers)
-        results = []
+def get_answer_key(qa_set_id, refresh=False):
+    if not refresh and qa_set_id in _answer_key_cache:
+        _answer_key_cache.move_to_end(qa_set_id)
+        return _answer_key_cache[qa_set_id]
 
-        for i, qa in enumerate(correct_answers):
-            user_ans_data = user_answers[i]
-            user_ans = user_ans_data.get("answer")
-            is_flagged = user_ans_data.get("is_flagged", False)
+    answer_key = load_answer_key(qa_set_id)
+    if answer_key is None:
+        _answer_key_cache.pop(qa_set_id, None)
+        return None
+    _answer_key_cache[qa_set_id] = answer_key
+    _answer_key_cache.move_to_end(qa_set_id)
+    while len(_answer_key_cache) > ANSWER_KEY_CACHE_SIZE:
+        _answer_key_cache.popitem(last=False)
+    return answer_key
+
+
+def grade_answers(answer_key, user_answers):
+    score = 0
+    points = 0.0
+    total = len(answer_key["questions"])
+    results = []
+
+    for i, qa in enumerate(answer_key["questions"]):
+        user_ans_data = user_answers[i] if i < len(user_answers) else {}
+        user_ans = user_ans_data.get("answer")
+        is_flagged = user_ans_data.get("is_flagged", False)
+        is_correct = False
+        partial_score = 0.0
+        keyword_hits = None
+
+        if is_flagged:
             is_correct = False
+        elif qa["type"] == "一択選択式":
+            normalized = normalize_text(user_ans)
+            if normalized and normalized == qa["correct_answer"]:
+                is_correct = True
+                partial_score = 1.0
+        elif qa["type"] == "記述式":
+            matcher = qa["keywords"]
+            if len(matcher) and user_ans:
+                # 一致したキーワードの割合を部分点とし、全て含まれていれば正解とする
+                keyword_hits, partial_score = matcher.score(user_ans)
+                is_correct = partial_score == 1.0
 
-            if is_flagged:
-                is_correct = False
-            elif qa.get("type") == "一択選択式":
-                if user_ans == qa.get("correct_answer"):
-                    is_correct = True
-            elif qa.get("type") == "記述式":
-                keywords = qa.get("scoring_keywords", [])
-                if keywords and user_ans:
-                    # 全てのキーワードが回答に含まれていれば正解とする
-                    is_correct = all(
-                        keyword.lower() in user_ans.lower() for keyword in keywords
-                    )
+        if is_correct:
+            score += 1
+        points += partial_score
 
-            if is_correct:
-                score += 1
+        result = {
+            "question_id": qa["question_id"],
+            "is_correct": is_correct,
+            "is_flagged": is_flagged,
+            "partial_score": partial_score,
+        }
+        if keyword_hits is not None:
+            result["keyword_hits"] = keyword_hits
+        results.append(result)
 
-            results.append(
-                {
-                    "question_id": qa.get("question_id"),
-                    "is_correct": is_correct,
-                    "is_flagged": is_flagged,
-                }
-            )
+    return {
+        "submission_id": new_submission_id(),
+        "score": (points / total) * 100 if total > 0 else 0,
+        "correct_count": score,
+        "total_count": total,
+        "results": results,
+        "submitted_at": datetime.now(timezone.utc).isoformat(),
+    }
 
-        # 採点結果を作成
-        score_data = {
-            "submission_id": str(uuid.uuid4()),
-            "score": (score / total) * 100 if total > 0 else 0,
-            "correct_count": score,
-            "total_count": total,
-            "results": results,
-            "submitted_at": context.aws_request_id,
+
+def version_condition(version):
+    """採点に使ったversionのQAセットがまだ存在することを確認する条件式"""
+    if version is None:
+        # version導入前に作成されたQAセット
+        return {
+            "ConditionExpression": "attribute_exists(qa_set_id) AND attribute_not_exists(#version)",
+            "ExpressionAttributeNames": {"#version": "version"},
         }
+    return {
+        "ConditionExpression": "#version = :version",
+        "ExpressionAttributeNames": {"#version": "version"},
+        "ExpressionAttributeValues": {":version": version},
+    }
 
-        # DBに採点結果を追記
-        score_data_decimal = convert_floats_to_decimal(score_data)
-        table.update_item(
-            Key={"qa_set_id": qa_set_id},
-            UpdateExpression="SET submissions = list_append(if_not_exists(submissions, :empty_list), :s)",
-            ExpressionAttributeValues={":s": [score_data_decimal], ":empty_list": []},
+
+def save_submission(qa_set_id, answer_key, score_data):
+    """versionの確認と提出データの保存を1回のトランザクション書き込みで行う"""
+    try:
+        dynamodb_client.transact_write_items(
+            TransactItems=[
+                {
+                    "ConditionCheck": serialize_request(
+                        {
+                            "TableName": TABLE_NAME,
+                            "Key": {"qa_set_id": qa_set_id},
+                            **version_condition(answer_key["version"]),
+                        }
+                    )
+                },
+                {
+                    "Put": serialize_request(
+                        {
+                            "TableName": SUBMISSIONS_TABLE_NAME,
+                            "Item": {"qa_set_id": qa_set_id, **score_data},
+                        }
+                    )
+                },
+            ]
         )
+    except dynamodb_client.exceptions.TransactionCanceledException as e:
+        reasons = e.response.get("CancellationReasons", [])
+        if reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+            raise StaleAnswerKeyError(qa_set_id) from e
+        raise
+
+
+@instrument_handler
+def handler(event, context):
+    try:
+        qa_set_id = event["pathParameters"]["id"]
+        submission_body = json_body(event)
+        user_answers = submission_body.get("answers", [])
+
+        # ウォームスタート時はキャッシュ済みの採点キーで採点し、書き込み1回で完了する
+        # QAセットが更新・削除されていた場合のみDBから読み直して採点し直す
+        for refresh in (False, True):
+            answer_key = get_answer_key(qa_set_id, refresh=refresh)
+            if answer_key is None:
+                return create_error_response(
+                    404, "指定されたQAセットが見つかりません。"
+                )
+
+            score_data = grade_answers(answer_key, user_answers)
+            try:
+                save_submission(qa_set_id, answer_key, score_data)
+                break
+            except StaleAnswerKeyError:
+                print(f"Answer key for {qa_set_id} is stale. Reloading.")
+        else:
+            return create_error_response(
+                409, "QAセットが更新されたため採点できませんでした。"
+            )
 
         return create_success_response(score_data)
 
@@ -103,6 +225,150 @@ def handler(event, context):
         )
 
 
+def write_submission_chunk(items):
+    """最大25件をBatchWriteItemで書き込み、未処理分はバックオフしながら再送する。
+    最後まで書き込めなかった提出IDの集合を返す"""
+    request_items = {
+        SUBMISSIONS_TABLE_NAME: [
+            {"PutRequest": {"Item": serialize_item(item)}} for item in items
+        ]
+    }
+    for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+        response = dynamodb_client.batch_write_item(RequestItems=request_items)
+        request_items = response.get("UnprocessedItems") or {}
+        if not request_items:
+            return set()
+        # 指数バックオフ（フルジッター）
+        time.sleep(random.uniform(0, min(2.0, 0.05 * (2**attempt))))
+    return {
+        request["PutRequest"]["Item"]["submission_id"]["S"]
+        for request in request_items.get(SUBMISSIONS_TABLE_NAME, [])
+    }
+
+
+def write_submission_chunk_safely(items):
+    """1つのチャンクの失敗で一括採点全体を失敗させず、そのチャンクの提出を未保存として返す"""
+    try:
+        return write_submission_chunk(items)
+    except Exception:
+        print(f"ERROR: failed to write a submission chunk. {traceback.format_exc()}")
+        return {item["submission_id"] for item in items}
+
+
+def save_submissions_batch(qa_set_id, score_data_list):
+    items = [{"qa_set_id": qa_set_id, **score_data} for score_data in score_data_list]
+    chunks = [
+        items[i : i + BATCH_WRITE_CHUNK_SIZE]
+        for i in range(0, len(items), BATCH_WRITE_CHUNK_SIZE)
+    ]
+    unprocessed = set()
+    with ThreadPoolExecutor(max_workers=BATCH_WRITE_CONCURRENCY) as executor:
+        for failed_ids in executor.map(write_submission_chunk_safely, chunks):
+            unprocessed |= failed_ids
+    return unprocessed
+
+
+def find_invalid_sheet(sheets):
+    """形式が正しくない最初の答案の位置を返す。全て正しければNone"""
+    for i, sheet in enumerate(sheets):
+        if not isinstance(sheet, dict):
+            return i
+        answers = sheet.get("answers", [])
+        if not isinstance(answers, list) or not all(
+            isinstance(answer, dict) for answer in answers
+        ):
+            return i
+    return None
+
+
+def summarize_scores(answer_key, score_data_list):
+    """一括採点の集計（平均・中央値・分布・問題ごとの正答率）"""
+    scores = [score_data["score"] for score_data in score_data_list]
+    question_stats = []
+    for i, qa in enumerate(answer_key["questions"]):
+        correct = sum(1 for sd in score_data_list if sd["results"][i]["is_correct"])
+        flagged = sum(1 for sd in score_data_list if sd["results"][i]["is_flagged"])
+        question_stats.append(
+            {
+                "question_id": qa["question_id"],
+                "correct_count": correct,
+                "flagged_count": flagged,
+                "correct_rate": correct / len(score_data_list) * 100,
+            }
+        )
+    return {
+        "sheet_count": len(scores),
+        "mean_score": statistics.fmean(scores),
+        "median_score": statistics.median(scores),
+        "min_score": min(scores),
+        "max_score": max(scores),
+        "stdev_score": statistics.pstdev(scores),
+        "questions": question_stats,
+    }
+
+
+@instrument_handler
+def batch_handler(event, context):
+    """POST /qas/{id}/submit-batch: 複数の答案を1回の採点キー読み込みで採点する"""
+    try:
+        qa_set_id = event["pathParameters"]["id"]
+        sheets = json_body(event).get("sheets", [])
+        if not isinstance(sheets, list) or not sheets:
+            return create_error_response(400, "sheetsに答案を1件以上指定してください。")
+        if len(sheets) > MAX_BATCH_SHEETS:
+            return create_error_response(
+                400, f"一度に採点できる答案は{MAX_BATCH_SHEETS}件までです。"
+            )
+        invalid_index = find_invalid_sheet(sheets)
+        if invalid_index is not None:
+            return create_error_response(
+                400,
+                f"sheets[{invalid_index}]の形式が正しくありません。"
+                "answersは回答オブジェクトの配列で指定してください。",
+            )
+
+        # 一括書き込みは条件付きにできないため、採点前に最新の採点キーを読み込む
+        answer_key = get_answer_key(qa_set_id, refresh=True)
+        if answer_key is None:
+            return create_error_response(404, "指定されたQAセットが見つかりません。")
+
+        score_data_list = []
+        for sheet in sheets:
+            score_data = grade_answers(answer_key, sheet.get("answers", []))
+            if sheet.get("learner_id") is not None:
+                score_data["learner_id"] = str(sheet["learner_id"])
+            score_data_list.append(score_data)
+
+        unprocessed = save_submissions_batch(qa_set_id, score_data_list)
+        if unprocessed:
+            print(f"WARNING: {len(unprocessed)} submissions could not be saved.")
+
+        results = [
+            {"index": i, "saved": sd["submission_id"] not in unprocessed, **sd}
+            for i, sd in enumerate(score_data_list)
+        ]
+        body = {
+            "qa_set_id": qa_set_id,
+            "results": results,
+            "summary": summarize_scores(answer_key, score_data_list),
+            "unsaved_count": len(unprocessed),
+        }
+        response = create_success_response(body)
+        if len(response["body"].encode("utf-8")) > MAX_RESPONSE_BYTES:
+            # 設問別の結果は提出履歴（GET /qas/{id}/submissions）から取得できる
+            for result in results:
+                result.pop("results", None)
+            body["question_results_omitted"] = True
+            response = create_success_response(body)
+        return response
+
+    except Exception as e:
+        print(f"ERROR: {traceback.format_exc()}")
+        return create_error_response(
+            500, f"一括採点の処理中にエラーが発生しました: {str(e)}"
+        )
+
+
 def create_success_response(body):
     return {
         "statusCode": 200,
@@ -110,7 +376,7 @@ def create_success_response(body):
             "Content-Type": "application/json",
             "Access-Control-Allow-Origin": "*",
         },
-        "body": json.dumps(body, default=default_json_serializer),
+        "body": dumps(body),
     }
 
 
@@ -1,6 +1,7 @@
 import os
 from aws_cdk import (
     Stack,
+    BundlingOptions,
     aws_lambda as _lambda,
     aws_apigateway as apigw,
     aws_s3 as s3,
@@ -8,7 +9,9 @@ from aws_cdk import (
     aws_lambda_event_sources as lambda_event_sources,
     aws_sns as sns,
     aws_sns_subscriptions as subscriptions,
+    aws_sqs as sqs,
     Duration,
+    Size,
     CfnOutput,
     aws_iam,
     aws_dynamodb as dynamodb,
@@ -34,11 +37,14 @@ class QaSystemStack(Stack):
                 s3.CorsRule(
                     allowed_methods=[
                         s3.HttpMethods.POST,
+                        s3.HttpMethods.PUT,
                         s3.HttpMethods.GET,
                         s3.HttpMethods.HEAD,
                     ],
                     allowed_origins=["*"],  # 本番ではStreamlitのドメインに限定
                     allowed_headers=["*"],
+                    # マルチパートアップロードの完了にはパートごとのETagが必要
+                    exposed_headers=["ETag"],
                     max_age=3000,
                 )
             ],
@@ -67,11 +73,102 @@ class QaSystemStack(Stack):
             projection_type=dynamodb.ProjectionType.ALL,
         )
 
+        # 提出データはQAセット本体から分離し、(qa_set_id, submission_id)で保存する
+        submissions_table = dynamodb.Table(
+            self,
+            "SubmissionsTable",
+            partition_key=dynamodb.Attribute(
+                name="qa_set_id", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="submission_id", type=dynamodb.AttributeType.STRING
+            ),
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Bedrock生成結果のキャッシュ（プロンプトのフィンガープリントがキー）
+        generation_cache_table = dynamodb.Table(
+            self,
+            "GenerationCacheTable",
+            partition_key=dynamodb.Attribute(
+                name="cache_key", type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+        # アップロードしたPDFごとの処理状況（状態と段階ごとの時刻）
+        jobs_table = dynamodb.Table(
+            self,
+            "JobsTable",
+            partition_key=dynamodb.Attribute(
+                name="job_id", type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+        # パイプラインの状態管理（実行中のTextractジョブ数のカウンターとリース）
+        pipeline_state_table = dynamodb.Table(
+            self,
+            "PipelineStateTable",
+            partition_key=dynamodb.Attribute(
+                name="pk", type=dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # DynamoDBに収まらない大きな生成結果はS3に置き、TTLと同じ期間で削除する
+        upload_bucket.add_lifecycle_rule(
+            prefix="generation-cache/", expiration=Duration.days(30)
+        )
+        # OCRするページを切り出した部分PDF・結合用マニフェスト・範囲ごとのOCR結果は一時的なもの
+        upload_bucket.add_lifecycle_rule(
+            prefix="ocr-pages/", expiration=Duration.days(1)
+        )
+        upload_bucket.add_lifecycle_rule(
+            prefix="native-text/", expiration=Duration.days(1)
+        )
+        upload_bucket.add_lifecycle_rule(
+            prefix="ocr-parts/", expiration=Duration.days(1)
+        )
+        # 完了も中止もされなかったマルチパートアップロードのパートを片付ける
+        upload_bucket.add_lifecycle_rule(
+            prefix="uploads/",
+            abort_incomplete_multipart_upload_after=Duration.days(1),
+        )
+
+        # ----------------------------------------------------------------
+        # Lambda Layer (共有モジュール qa_common)
+        # ----------------------------------------------------------------
+        common_layer = _lambda.LayerVersion(
+            self,
+            "CommonLayer",
+            code=_lambda.Code.from_asset("lambda_common"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_11],
+            compatible_architectures=[_lambda.Architecture.ARM_64],
+            description="Shared modules for QA system Lambda functions",
+        )
+
         # ----------------------------------------------------------------
         # Lambda Functions
         # ----------------------------------------------------------------
 
         # 1. テキストからのQA生成Lambda
+        # 同時に実行するTextractジョブ数の上限（アカウントのクォータに合わせる）
+        max_textract_jobs = str(self.node.try_get_context("max_textract_jobs") or 10)
+        # QA生成Lambdaの同時実行数の上限。bedrock_tokens_per_minute はアカウント全体の
+        # クォータなので、コンテナごとのトークン予算はこの数で割った値にする
+        generation_containers = int(
+            self.node.try_get_context("generation_max_containers") or 4
+        )
+        bedrock_tokens_per_minute = int(
+            self.node.try_get_context("bedrock_tokens_per_minute") or 0
+        )
+
         # --- SNS Topic for Textract Notifications ---
         textract_sns_topic = sns.Topic(self, "TextractCompletionTopic")
 
@@ -85,27 +182,84 @@ class QaSystemStack(Stack):
 
         # --- New Lambda Functions for PDF Processing ---
 
-        # 1. Start PDF Processing Lambda (S3 Trigger)
+        # --- SQS Queue for PDF Uploads ---
+        # アップロード通知をキューに溜め、Textractの同時実行数の上限内で順に処理する
+        pdf_intake_dlq = sqs.Queue(
+            self, "PdfIntakeDeadLetterQueue", retention_period=Duration.days(14)
+        )
+        pdf_intake_queue = sqs.Queue(
+            self,
+            "PdfIntakeQueue",
+            # 関数のタイムアウトの6倍（AWSの推奨値）
+            visibility_timeout=Duration.minutes(18),
+            # 上限待ちのメッセージは遅延付きで入れ直すので、受信回数には数えられない
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5, queue=pdf_intake_dlq
+            ),
+        )
+        upload_bucket.add_event_notification(
+            s3.EventType.OBJECT_CREATED,
+            s3n.SqsDestination(pdf_intake_queue),
+            s3.NotificationKeyFilter(prefix="uploads/", suffix=".pdf"),
+        )
+
+        # 1. Start PDF Processing Lambda (SQS Trigger)
         start_pdf_lambda = _lambda.Function(
             self,
             "StartPdfProcessingFunction",
             runtime=_lambda.Runtime.PYTHON_3_11,
             architecture=_lambda.Architecture.ARM_64,
-            code=_lambda.Code.from_asset("lambda_start_pdf_processing"),
+            # テキストレイヤーの読み取りに使うpypdfを同梱する
+            code=_lambda.Code.from_asset(
+                "lambda_start_pdf_processing",
+                bundling=BundlingOptions(
+                    image=_lambda.Runtime.PYTHON_3_11.bundling_image,
+                    command=[
+                        "bash",
+                        "-c",
+                        "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output",
+                    ],
+                ),
+            ),
             handler="main.handler",
-            timeout=Duration.seconds(60),
+            layers=[common_layer],
+            # PDFの解析を関数内で行うため、CPUが割り当てられるようメモリを多めに取る
+            timeout=Duration.minutes(3),
+            memory_size=1024,
+            ephemeral_storage_size=Size.mebibytes(2048),
             environment={
                 "SNS_TOPIC_ARN": textract_sns_topic.topic_arn,
                 "TEXTRACT_ROLE_ARN": textract_role.role_arn,
+                "TEXT_CACHE_PREFIX": "text-cache/",
+                "INTAKE_QUEUE_URL": pdf_intake_queue.queue_url,
+                "DEFER_SECONDS": "30",
+                "MAX_CAPACITY_DEFERRALS": "20",
+                "INTAKE_DLQ_URL": pdf_intake_dlq.queue_url,
+                "NATIVE_EXTRACTION": "true",
+                "NATIVE_MIN_CHARS": "20",
+                "OCR_PAGES_PREFIX": "ocr-pages/",
+                "NATIVE_TEXT_PREFIX": "native-text/",
+                "OCR_SLICE_PAGES": "50",
+                "PIPELINE_STATE_TABLE": pipeline_state_table.table_name,
+                "MAX_TEXTRACT_JOBS": max_textract_jobs,
+                "TEXTRACT_LEASE_TTL_SECONDS": "21600",
+                "JOBS_TABLE_NAME": jobs_table.table_name,
             },
         )
         start_pdf_lambda.add_event_source(
-            lambda_event_sources.S3EventSource(
-                upload_bucket,
-                events=[s3.EventType.OBJECT_CREATED],
-                filters=[s3.NotificationKeyFilter(prefix="uploads/", suffix=".pdf")],
+            lambda_event_sources.SqsEventSource(
+                pdf_intake_queue,
+                batch_size=10,
+                max_batching_window=Duration.seconds(5),
+                report_batch_item_failures=True,
+                # 開始APIのTPS上限を超えないよう、同時に動く関数の数を絞る
+                max_concurrency=2,
             )
         )
+        # 上限待ちのメッセージを遅延付きで入れ直す
+        pdf_intake_queue.grant_send_messages(start_pdf_lambda)
+        # 入れ直せる回数を超えたメッセージはデッドレターキューへ送る
+        pdf_intake_dlq.grant_send_messages(start_pdf_lambda)
         start_pdf_lambda.add_to_role_policy(
             aws_iam.PolicyStatement(
                 actions=["textract:StartDocumentTextDetection"],
@@ -118,8 +272,29 @@ class QaSystemStack(Stack):
                 resources=[textract_role.role_arn],
             )
         )
+        # 内容ハッシュの計算とテキストキャッシュの確認、キャッシュヒット時の通知
+        upload_bucket.grant_read(start_pdf_lambda)
+        textract_sns_topic.grant_publish(start_pdf_lambda)
+        pipeline_state_table.grant_read_write_data(start_pdf_lambda)
+        jobs_table.grant_write_data(start_pdf_lambda)
+
+        # Bedrockが混雑している間、QA生成を後回しにするキュー
+        deferred_generation_dlq = sqs.Queue(
+            self,
+            "DeferredGenerationDeadLetterQueue",
+            retention_period=Duration.days(14),
+        )
+        deferred_generation_queue = sqs.Queue(
+            self,
+            "DeferredGenerationQueue",
+            # 関数のタイムアウト(5分)の6倍
+            visibility_timeout=Duration.minutes(30),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5, queue=deferred_generation_dlq
+            ),
+        )
 
-        # 2. Handle Textract Result Lambda (SNS Trigger)
+        # 2. Handle Textract Result Lambda (SNS / SQS Trigger)
         handle_textract_lambda = _lambda.Function(
             self,
             "HandleTextractResultFunction",
@@ -127,18 +302,57 @@ class QaSystemStack(Stack):
             architecture=_lambda.Architecture.ARM_64,
             code=_lambda.Code.from_asset("lambda_handle_textract_result"),
             handler="main.handler",
+            layers=[common_layer],
             timeout=Duration.minutes(5),
             memory_size=512,
+            # SNSからの非同期呼び出しは上限を超えるとLambda側で待たされてから再試行される
+            reserved_concurrent_executions=generation_containers,
             environment={
                 "MODEL_ID": "us.amazon.nova-lite-v1:0",
                 "TABLE_NAME": qa_table.table_name,
+                "TEXT_CACHE_PREFIX": "text-cache/",
+                "OCR_PAGES_PREFIX": "ocr-pages/",
+                "NATIVE_TEXT_PREFIX": "native-text/",
+                "OCR_PARTS_PREFIX": "ocr-parts/",
+                "MAX_CHUNK_TOKENS": "8000",
+                "GENERATION_CONCURRENCY": "4",
+                "GENERATION_CACHE_TABLE": generation_cache_table.table_name,
+                "GENERATION_CACHE_BUCKET": upload_bucket.bucket_name,
+                "GENERATION_CACHE_TTL_DAYS": "30",
+                "GENERATION_MODE": "stream",
+                "PIPELINE_STATE_TABLE": pipeline_state_table.table_name,
+                "JOBS_TABLE_NAME": jobs_table.table_name,
+                "MAX_TEXTRACT_JOBS": max_textract_jobs,
+                "BEDROCK_MAX_CONCURRENCY": "4",
+                "BEDROCK_TOKENS_PER_MINUTE": str(
+                    bedrock_tokens_per_minute // generation_containers
+                ),
+                "DEFERRED_QUEUE_URL": deferred_generation_queue.queue_url,
+                "MAX_GENERATION_DEFERRALS": "8",
+                "DEFERRED_DLQ_URL": deferred_generation_dlq.queue_url,
             },
         )
         handle_textract_lambda.add_event_source(
             lambda_event_sources.SnsEventSource(textract_sns_topic)
         )
+        handle_textract_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                deferred_generation_queue,
+                batch_size=1,
+                report_batch_item_failures=True,
+                max_concurrency=2,
+            )
+        )
+        deferred_generation_queue.grant_send_messages(handle_textract_lambda)
+        deferred_generation_dlq.grant_send_messages(handle_textract_lambda)
         handle_textract_lambda.add_to_role_policy(
-            aws_iam.PolicyStatement(actions=["bedrock:InvokeModel"], resources=["*"])
+            aws_iam.PolicyStatement(
+                actions=[
+                    "bedrock:InvokeModel",
+                    "bedrock:InvokeModelWithResponseStream",
+                ],
+                resources=["*"],
+            )
         )
         handle_textract_lambda.add_to_role_policy(
             aws_iam.PolicyStatement(
@@ -146,7 +360,10 @@ class QaSystemStack(Stack):
             )
         )
         qa_table.grant_read_write_data(handle_textract_lambda)
-        upload_bucket.grant_read(handle_textract_lambda)
+        generation_cache_table.grant_read_write_data(handle_textract_lambda)
+        upload_bucket.grant_read_write(handle_textract_lambda)
+        pipeline_state_table.grant_read_write_data(handle_textract_lambda)
+        jobs_table.grant_write_data(handle_textract_lambda)
 
         # 3. 事前署名付きURL生成Lambda
         get_upload_url_lambda = _lambda.Function(
@@ -156,11 +373,17 @@ class QaSystemStack(Stack):
             architecture=_lambda.Architecture.ARM_64,
             code=_lambda.Code.from_asset("lambda_get_upload_url"),
             handler="main.handler",
+            layers=[common_layer],
             timeout=Duration.seconds(30),
-            environment={"UPLOAD_BUCKET_NAME": upload_bucket.bucket_name},
+            environment={
+                "UPLOAD_BUCKET_NAME": upload_bucket.bucket_name,
+                "MULTIPART_PART_SIZE": str(8 * 1024 * 1024),
+                "JOBS_TABLE_NAME": jobs_table.table_name,
+            },
         )
         # S3バケットへの書き込みを許可する権限を付与
         upload_bucket.grant_write(get_upload_url_lambda)
+        jobs_table.grant_write_data(get_upload_url_lambda)
         # 3. QA一覧取得Lambda
         list_qas_lambda = _lambda.Function(
             self,
@@ -169,11 +392,26 @@ class QaSystemStack(Stack):
             architecture=_lambda.Architecture.ARM_64,
             code=_lambda.Code.from_asset("lambda_list_qas"),
             handler="main.handler",
+            layers=[common_layer],
             timeout=Duration.seconds(30),
             environment={"TABLE_NAME": qa_table.table_name},
         )
         qa_table.grant_read_data(list_qas_lambda)
 
+        # 3-2. QA詳細取得Lambda
+        get_qa_lambda = _lambda.Function(
+            self,
+            "GetQaFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            architecture=_lambda.Architecture.ARM_64,
+            code=_lambda.Code.from_asset("lambda_get_qa"),
+            handler="main.handler",
+            layers=[common_layer],
+            timeout=Duration.seconds(30),
+            environment={"TABLE_NAME": qa_table.table_name},
+        )
+        qa_table.grant_read_data(get_qa_lambda)
+
         # 4. QA削除Lambda
         delete_qa_lambda = _lambda.Function(
             self,
@@ -183,9 +421,14 @@ class QaSystemStack(Stack):
             code=_lambda.Code.from_asset("lambda_delete_qa"),
             handler="main.handler",
             timeout=Duration.seconds(30),
-            environment={"TABLE_NAME": qa_table.table_name},
+            layers=[common_layer],
+            environment={
+                "TABLE_NAME": qa_table.table_name,
+                "SUBMISSIONS_TABLE_NAME": submissions_table.table_name,
+            },
         )
         qa_table.grant_write_data(delete_qa_lambda)
+        submissions_table.grant_read_write_data(delete_qa_lambda)
 
         # 5. 回答提出Lambda
         submit_answer_lambda = _lambda.Function(
@@ -195,10 +438,65 @@ class QaSystemStack(Stack):
             architecture=_lambda.Architecture.ARM_64,
             code=_lambda.Code.from_asset("lambda_submit_answer"),
             handler="main.handler",
+            layers=[common_layer],
             timeout=Duration.seconds(30),
-            environment={"TABLE_NAME": qa_table.table_name},
+            environment={
+                "TABLE_NAME": qa_table.table_name,
+                "SUBMISSIONS_TABLE_NAME": submissions_table.table_name,
+            },
+        )
+        qa_table.grant_read_data(submit_answer_lambda)
+        submissions_table.grant_write_data(submit_answer_lambda)
+
+        # 5-2. 一括採点Lambda（回答提出Lambdaと同じコードの別ハンドラー）
+        submit_batch_lambda = _lambda.Function(
+            self,
+            "SubmitBatchFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            architecture=_lambda.Architecture.ARM_64,
+            code=_lambda.Code.from_asset("lambda_submit_answer"),
+            handler="main.batch_handler",
+            layers=[common_layer],
+            timeout=Duration.seconds(30),
+            memory_size=1024,
+            environment={
+                "TABLE_NAME": qa_table.table_name,
+                "SUBMISSIONS_TABLE_NAME": submissions_table.table_name,
+            },
+        )
+        qa_table.grant_read_data(submit_batch_lambda)
+        submissions_table.grant_write_data(submit_batch_lambda)
+
+        # 6. 提出履歴取得Lambda
+        list_submissions_lambda = _lambda.Function(
+            self,
+            "ListSubmissionsFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            architecture=_lambda.Architecture.ARM_64,
+            code=_lambda.Code.from_asset("lambda_list_submissions"),
+            handler="main.handler",
+            layers=[common_layer],
+            timeout=Duration.seconds(30),
+            environment={"SUBMISSIONS_TABLE_NAME": submissions_table.table_name},
+        )
+        submissions_table.grant_read_data(list_submissions_lambda)
+
+        # 7. 処理状況取得Lambda（状態が変わるまで最大20秒待つロングポーリング）
+        get_job_lambda = _lambda.Function(
+            self,
+            "GetJobFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            architecture=_lambda.Architecture.ARM_64,
+            code=_lambda.Code.from_asset("lambda_get_job"),
+            handler="main.handler",
+            layers=[common_layer],
+            timeout=Duration.seconds(29),
+            environment={
+                "JOBS_TABLE_NAME": jobs_table.table_name,
+                "MAX_WAIT_SECONDS": "20",
+            },
         )
-        qa_table.grant_read_write_data(submit_answer_lambda)
+        jobs_table.grant_read_data(get_job_lambda)
 
         # ----------------------------------------------------------------
         # API Gateway
@@ -215,11 +513,16 @@ class QaSystemStack(Stack):
                     "X-Amz-Date",
                     "Authorization",
                     "X-Api-Key",
+                    "If-None-Match",
                 ],
             ),
             binary_media_types=[
-                "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+                "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+                # Lambda側でgzip圧縮したJSON（isBase64Encoded）をバイナリとして返すため
+                "application/json",
             ],
+            # Lambda側で圧縮しなかった応答も、この大きさ以上ならAPI Gatewayが圧縮する
+            min_compression_size=Size.kibibytes(1),
         )
 
         # --- エンドポイントの定義 ---
@@ -235,6 +538,7 @@ class QaSystemStack(Stack):
         qas_resource.add_method("GET", apigw.LambdaIntegration(list_qas_lambda))
 
         qa_item_resource = qas_resource.add_resource("{id}")
+        qa_item_resource.add_method("GET", apigw.LambdaIntegration(get_qa_lambda))
         qa_item_resource.add_method("DELETE", apigw.LambdaIntegration(delete_qa_lambda))
 
         # 回答提出
@@ -243,6 +547,23 @@ class QaSystemStack(Stack):
             "POST", apigw.LambdaIntegration(submit_answer_lambda)
         )
 
+        # 一括採点
+        submit_batch_resource = qa_item_resource.add_resource("submit-batch")
+        submit_batch_resource.add_method(
+            "POST", apigw.LambdaIntegration(submit_batch_lambda)
+        )
+
+        # 提出履歴
+        submissions_resource = qa_item_resource.add_resource("submissions")
+        submissions_resource.add_method(
+            "GET", apigw.LambdaIntegration(list_submissions_lambda)
+        )
+
+        # 処理状況
+        jobs_resource = api.root.add_resource("jobs")
+        job_item_resource = jobs_resource.add_resource("{id}")
+        job_item_resource.add_method("GET", apigw.LambdaIntegration(get_job_lambda))
+
         # ----------------------------------------------------------------
         # Outputs
         # ----------------------------------------------------------------
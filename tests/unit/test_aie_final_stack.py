@@ -1,11 +1,12 @@
 import aws_cdk as core
 
 # import aws_cdk.assertions as assertions  <-- 削除
-from qa_system.aie_final_stack import QaSystemStack
+from qa_system.qa_system_stack import QaSystemStack
 
 
 def test_stack_synthesis():
-    app = core.App()
+    # Lambdaの依存ライブラリのバンドル（Docker）はテストでは行わない
+    app = core.App(context={"aws:cdk:bundling-stacks": []})
     # stack = AieFinalStack(app, "aie-final") <-- 削除
     QaSystemStack(
         app, "QaSystemStack-Test"
@@ -0,0 +1,37 @@
+import base64
+import gzip
+import json
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.api_response import (  # noqa: E402
+    compute_etag,
+    is_not_modified,
+    json_response,
+)
+
+
+def test_if_none_match_uses_weak_comparison():
+    etag = compute_etag("id", 1, "2026-01-01T00:00:00")
+    assert is_not_modified({"headers": {"if-none-match": etag[2:]}}, etag)
+    assert is_not_modified({"headers": {"If-None-Match": f'"x", {etag}'}}, etag)
+    assert not is_not_modified({"headers": {}}, etag)
+    assert etag != compute_etag("id", 2, "2026-01-01T00:00:00")
+
+
+def test_large_body_is_gzipped_only_when_client_can_decode_it():
+    body = {"items": ["問題文" * 1000]}
+    headers = {"Accept": "application/json", "Accept-Encoding": "gzip, br"}
+    response = json_response({"headers": headers}, body)
+    assert response["isBase64Encoded"] is True
+    assert response["headers"]["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(base64.b64decode(response["body"]))) == body
+
+    # Acceptがbinary_media_typesに一致しないとAPI Gatewayが復号しないため圧縮しない
+    response = json_response({"headers": {"Accept-Encoding": "gzip"}}, body)
+    assert "isBase64Encoded" not in response
+    assert json.loads(response["body"]) == body
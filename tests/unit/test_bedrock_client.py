@@ -0,0 +1,149 @@
+import io
+import json
+import os
+import sys
+
+import pytest
+from botocore.exceptions import ClientError, EventStreamError
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.bedrock_client import (  # noqa: E402
+    BedrockUnavailable,
+    CircuitBreaker,
+    ThrottleAwareBedrock,
+    TokenBudget,
+)
+
+REQUEST = json.dumps(
+    {
+        "system": [{"text": "sys"}],
+        "messages": [{"role": "user", "content": [{"text": "講義"}]}],
+        "inferenceConfig": {"maxTokens": 100},
+    }
+)
+
+
+class FakeClient:
+    def __init__(self, throttles):
+        self.throttles = throttles
+        self.calls = 0
+
+    def invoke_model(self, body, modelId):
+        self.calls += 1
+        if self.calls <= self.throttles:
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "slow down"}},
+                "InvokeModel",
+            )
+        payload = {"output": {}, "usage": {"inputTokens": 10, "outputTokens": 5}}
+        return {"body": io.BytesIO(json.dumps(payload).encode())}
+
+
+def test_retries_throttling_and_halves_concurrency():
+    client = FakeClient(throttles=2)
+    bedrock = ThrottleAwareBedrock(client, max_concurrency=4, base_delay=0)
+    response = bedrock.invoke_model(body=REQUEST, modelId="m")
+    assert json.loads(response["body"].read())["usage"]["outputTokens"] == 5
+    assert client.calls == 3
+    assert bedrock.concurrency.limit < 4
+
+
+def test_circuit_opens_after_repeated_failures():
+    client = FakeClient(throttles=100)
+    bedrock = ThrottleAwareBedrock(
+        client,
+        max_retries=1,
+        base_delay=0,
+        breaker=CircuitBreaker(failure_threshold=2, reset_seconds=60),
+    )
+    for _ in range(2):
+        with pytest.raises(BedrockUnavailable):
+            bedrock.invoke_model(body=REQUEST, modelId="m")
+    calls = client.calls
+    with pytest.raises(BedrockUnavailable) as excinfo:
+        bedrock.invoke_model(body=REQUEST, modelId="m")
+    assert client.calls == calls
+    assert excinfo.value.retry_after > 0
+
+
+def test_token_budget_settles_actual_usage():
+    budget = TokenBudget(tokens_per_minute=100)
+    entry = budget.reserve(80, max_wait=0)
+    with pytest.raises(BedrockUnavailable):
+        budget.reserve(30, max_wait=0)
+    budget.settle(entry, 20)
+    assert budget.reserve(30, max_wait=0) is not None
+
+
+class ScriptedClient:
+    """呼び出しごとに指定したエラーコードで失敗する（Noneなら成功する）"""
+
+    def __init__(self, codes):
+        self.codes = list(codes)
+        self.calls = 0
+
+    def invoke_model(self, body, modelId):
+        self.calls += 1
+        code = self.codes.pop(0) if self.codes else None
+        if code:
+            raise ClientError({"Error": {"Code": code, "Message": code}}, "InvokeModel")
+        return {"body": io.BytesIO(b'{"usage": {"inputTokens": 1}}')}
+
+
+def test_half_open_probe_is_released_on_any_exit():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    client = ScriptedClient(["ThrottlingException", "ValidationException", None])
+    bedrock = ThrottleAwareBedrock(client, max_retries=0, breaker=breaker)
+    with pytest.raises(BedrockUnavailable):
+        bedrock.invoke_model(body=REQUEST, modelId="m")
+
+    # 試行がスロットリング以外のエラーで終わっても、次の呼び出しで改めて試せる
+    with pytest.raises(ClientError):
+        bedrock.invoke_model(body=REQUEST, modelId="m")
+    bedrock.invoke_model(body=REQUEST, modelId="m")
+    assert client.calls == 3
+    assert breaker.allow() and breaker.retry_after() == 0.0
+
+    # トークン予算が空かずに試行できなかった場合も同様
+    breaker.record_failure()
+    bedrock.budget = TokenBudget(tokens_per_minute=1)
+    bedrock.budget.reserve(1, max_wait=0)
+    bedrock.max_budget_wait = 0
+    with pytest.raises(BedrockUnavailable):
+        bedrock.invoke_model(body=REQUEST, modelId="m")
+    assert breaker.allow()
+
+
+class ThrottledStream:
+    """1件目のイベントを返した後、スロットリングのエラーで途切れるストリーム"""
+
+    def __iter__(self):
+        yield {"chunk": {"bytes": b'{"contentBlockDelta": {}}'}}
+        raise EventStreamError(
+            {"Error": {"Code": "throttlingException", "Message": "slow down"}},
+            "InvokeModelWithResponseStream",
+        )
+
+    def close(self):
+        pass
+
+
+class StreamClient:
+    def invoke_model_with_response_stream(self, body, modelId):
+        return {"body": ThrottledStream()}
+
+
+def test_throttling_during_stream_is_recorded_and_converted():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    bedrock = ThrottleAwareBedrock(StreamClient(), max_concurrency=4, breaker=breaker)
+    response = bedrock.invoke_model_with_response_stream(body=REQUEST, modelId="m")
+    with pytest.raises(BedrockUnavailable) as excinfo:
+        for _ in response["body"]:
+            pass
+    assert excinfo.value.retry_after > 0
+    assert bedrock.concurrency.limit < 4
+    assert bedrock.concurrency._in_flight == 0
+    assert not breaker.allow()
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Key
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.codec import (  # noqa: E402
+    deserialize_item,
+    dumps,
+    serialize_item,
+    serialize_request,
+)
+
+
+def test_round_trip_keeps_native_numbers():
+    item = {
+        "qa_set_id": "a",
+        "lecture_number": 3,
+        "score": 66.7,
+        "flags": {"x", "y"},
+        "qa_data": {"qa_set": [{"question_id": 1, "ok": True, "note": None}]},
+    }
+    serialized = serialize_item(item)
+    assert serialized["score"] == {"N": "66.7"}
+    restored = deserialize_item(serialized)
+    assert restored == item
+    assert type(restored["lecture_number"]) is int
+
+
+def test_serialize_request_builds_condition_placeholders():
+    params = serialize_request(
+        {
+            "IndexName": "ThemeLectureIndex",
+            "KeyConditionExpression": Key("theme").eq("A")
+            & Key("lecture_number").eq(2),
+            "ExclusiveStartKey": {"qa_set_id": "a", "lecture_number": 2},
+        }
+    )
+    assert params["KeyConditionExpression"] == "(#n0 = :v0 AND #n1 = :v1)"
+    assert params["ExpressionAttributeValues"] == {":v0": {"S": "A"}, ":v1": {"N": "2"}}
+    assert params["ExclusiveStartKey"]["lecture_number"] == {"N": "2"}
+
+
+def test_dumps_accepts_decimal_and_sets():
+    body = json.loads(dumps({"a": Decimal("2"), "b": Decimal("0.5"), "c": {"x"}}))
+    assert body == {"a": 2, "b": 0.5, "c": ["x"]}
@@ -0,0 +1,62 @@
+import importlib.util
+import os
+import sys
+
+HANDLER_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "lambda_handle_textract_result"
+)
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ["METRICS_ENABLED"] = "false"
+
+# 他のLambdaのmain.pyと名前が衝突しないよう、ファイルから別名で読み込む
+_spec = importlib.util.spec_from_file_location(
+    "handle_textract_generation", os.path.join(HANDLER_DIR, "main.py")
+)
+handle = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(handle)
+
+
+def _question(chunk, n):
+    return {
+        "question": f"チャンク{chunk}の質問{n}",
+        "type": "一択選択式",
+        "correct_answer": "A",
+        "chunk": chunk,
+    }
+
+
+def test_merge_draws_from_chunks_across_the_document():
+    qa_sets = [[_question(c, n) for n in range(3)] for c in range(10)]
+    merged = handle.merge_qa_sets(qa_sets, 4)["qa_set"]
+    chunks = [qa["chunk"] for qa in merged]
+    assert len(set(chunks)) == 4
+    assert min(chunks) < 3 and max(chunks) > 6
+    assert [qa["question_id"] for qa in merged] == [1, 2, 3, 4]
+
+
+def test_long_text_uses_about_num_questions_chunks(monkeypatch):
+    pages = [f"ページ{i}の講義内容。" * 20 for i in range(40)]
+    offsets, position = [], 0
+    for number, page in enumerate(pages, start=1):
+        offsets.append({"page": number, "offset": position})
+        position += len(page)
+    monkeypatch.setattr(handle, "MAX_CHUNK_TOKENS", max(map(len, pages)))
+
+    calls = []
+
+    def fake_generate(chunk, count, difficulty, cache_mode):
+        calls.append(chunk)
+        page = int(chunk.split("の")[0].removeprefix("ページ"))
+        return {"qa_set": [_question(page, n) for n in range(count)]}
+
+    monkeypatch.setattr(handle, "generate_qa_from_chunk", fake_generate)
+    merged = handle.generate_qa_from_text("".join(pages), 5, "中", offsets)["qa_set"]
+
+    assert len(calls) == 5
+    chunks = sorted(qa["chunk"] for qa in merged)
+    assert len(merged) == 5 and len(set(chunks)) == 5
+    assert chunks[0] < 8 and chunks[-1] >= 32
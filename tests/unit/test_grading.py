@@ -0,0 +1,38 @@
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_submit_answer")
+)
+
+from grading import KeywordMatcher, normalize_text  # noqa: E402
+
+
+def test_normalize_text_folds_width_kana_and_punctuation():
+    assert normalize_text("ＡＷＳ　ラムダ、") == normalize_text("aws らむだ")
+    assert normalize_text("サーバー・レス！") == "さーばーれす"
+
+
+def test_keyword_matcher_partial_score_and_synonyms():
+    matcher = KeywordMatcher(
+        [
+            "サーバーレス",
+            ["関数", "ファンクション"],
+            {"keyword": "S3", "synonyms": ["ストレージ"]},
+        ]
+    )
+    hits, partial_score = matcher.score("ｻｰﾊﾞｰﾚｽなファンクションを使う")
+    assert [h["hit"] for h in hits] == [True, True, False]
+    assert partial_score == 2 / 3
+
+    hits, partial_score = matcher.score("サーバレス")
+    assert partial_score == 0.0
+
+
+def test_keyword_matcher_overlapping_patterns():
+    # 失敗リンクを辿って重なり合うキーワードも検出できること
+    matcher = KeywordMatcher(["abcd", "bc", "cde"])
+    _, partial_score = matcher.score("xabcdex")
+    assert partial_score == 1.0
+    _, partial_score = matcher.score("abce")
+    assert partial_score == 1 / 3
@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.jobs import job_id_from_key, stage_durations  # noqa: E402
+
+
+def test_job_id_is_taken_from_upload_key():
+    job_id = "0f8fad5b-d9cb-469f-a165-70867728950e"
+    assert job_id_from_key(f"uploads/{job_id}-第1回.pdf") == job_id
+    assert job_id_from_key("uploads/slides.pdf") is None
+    assert job_id_from_key(f"text-cache/{job_id}-a.pdf") is None
+
+
+def test_stage_durations_skip_unfinished_stages():
+    job = {
+        "created_at": "2026-10-17T00:00:00.000+00:00",
+        "uploaded_at": "2026-10-17T00:00:02.500+00:00",
+        "llm_started_at": "2026-10-17T00:00:03.000+00:00",
+    }
+    assert stage_durations(job) == {"upload": 2.5}
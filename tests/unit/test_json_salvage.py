@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.json_salvage import collect_questions, salvage_qa_set  # noqa: E402
+
+
+def _question(n):
+    return {"question": f"質問{n}", "type": "一択選択式", "correct_answer": "A"}
+
+
+def test_salvage_skips_noise_and_truncated_tail():
+    text = (
+        "以下が問題です。\n"
+        '{"qa_set": [{"question": "質問1", "type": "記述式", "correct_answer": "x"}, '
+        '{"question": "質問2", "type": "記述式", "correct_answer": "y"}, '
+        '{"question": "質問3", "type": "記'
+    )
+    result = salvage_qa_set(text, num_questions=3)
+    assert [qa["question"] for qa in result["qa_set"]] == ["質問1", "質問2"]
+    assert result["missing"] == 1
+    assert result["diagnostics"]["complete_document"] is False
+
+
+def test_salvage_drops_duplicates_and_invalid_objects():
+    text = (
+        '{"qa_set": [{"question": "質問 1", "type": "t", "correct_answer": "a"}, '
+        '{"question": "質問１", "type": "t", "correct_answer": "a"}, '
+        '{"question": "", "type": "t", "correct_answer": "a"}]} 補足です'
+    )
+    result = salvage_qa_set(text)
+    assert len(result["qa_set"]) == 1
+    assert result["diagnostics"]["duplicates"] == 1
+    assert result["diagnostics"]["invalid_objects"] == 1
+
+
+def test_collect_questions_regenerates_only_missing_count():
+    calls = []
+
+    def generate_text(count, exclude_questions):
+        calls.append((count, list(exclude_questions)))
+        if len(calls) == 1:
+            return str([_question(1), _question(2)]).replace("'", '"')
+        return '{"qa_set": [%s]}' % ", ".join(
+            str(_question(n)).replace("'", '"') for n in (2, 3)
+        )
+
+    result = collect_questions(generate_text, 3, max_retries=1)
+    assert calls == [(3, []), (1, ["質問1", "質問2"])]
+    assert [qa["question"] for qa in result["qa_set"]] == ["質問1", "質問2", "質問3"]
+    assert [qa["question_id"] for qa in result["qa_set"]] == [1, 2, 3]
@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.metrics import MetricsRecorder, estimate_cost  # noqa: E402
+
+
+def _emf_lines(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_flush_groups_stage_values_and_resets(capsys):
+    recorder = MetricsRecorder()
+    for latency in range(150):
+        recorder.observe("dynamodb.GetItem", "Latency", latency)
+    recorder.observe("dynamodb.GetItem", "ConsumedCapacity", 0.5, "Count")
+    recorder.add("Invocations", 1)
+    recorder.flush("fn", {"RequestId": None})
+
+    lines = _emf_lines(capsys)
+    stage_lines, total_line = lines[:-1], lines[-1]
+    assert [len(line["Latency"]) for line in stage_lines] == [100, 50]
+    assert stage_lines[0]["ConsumedCapacity"] == [0.5]
+    assert "ConsumedCapacity" not in stage_lines[1]
+    assert stage_lines[0]["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["FunctionName", "Stage"]
+    ]
+    assert "RequestId" not in total_line and total_line["Invocations"] == 1
+
+    recorder.flush("fn")
+    assert _emf_lines(capsys) == []
+
+
+def test_cost_per_question_includes_bedrock_and_textract():
+    cost = estimate_cost(
+        {
+            "InputTokens": 10000,
+            "OutputTokens": 2000,
+            "TextractPages": 4,
+            "QuestionsGenerated": 5,
+        }
+    )
+    assert cost["EstimatedCost"] == cost["BedrockCost"] + cost["TextractCost"]
+    assert cost["CostPerQuestion"] == cost["EstimatedCost"] / 5
+    assert "CostPerQuestion" not in estimate_cost({"QuestionsGenerated": 5})
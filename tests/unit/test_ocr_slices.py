@@ -0,0 +1,101 @@
+import importlib.util
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+ROOT = os.path.join(os.path.dirname(__file__), "..", "..")
+sys.path.insert(0, os.path.join(ROOT, "lambda_common", "python"))
+
+BUCKET = "uploads"
+STATE_TABLE = "PipelineState"
+CONTENT_HASH = "0" * 64
+
+
+def load_handler(directory, name):
+    # 各Lambdaのmain.pyは同じ名前なので、ファイルから別名で読み込む
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(ROOT, directory, "main.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    for name, value in {
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "TABLE_NAME": "QaTable",
+        "PIPELINE_STATE_TABLE": STATE_TABLE,
+        "MAX_TEXTRACT_JOBS": "4",
+        "OCR_SLICE_PAGES": "3",
+        "METRICS_ENABLED": "false",
+    }.items():
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+        boto3.client("dynamodb").create_table(
+            TableName=STATE_TABLE,
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield (
+            load_handler("lambda_start_pdf_processing", "start_pdf_main"),
+            load_handler("lambda_handle_textract_result", "handle_textract_main"),
+        )
+
+
+def test_plan_ocr_slices_stays_within_job_limit(handlers):
+    start, _ = handlers
+    pages = list(range(1, 8))
+    assert start.plan_ocr_slices(pages) == [[1, 2, 3], [4, 5, 6], [7]]
+    # 範囲の数はTextractの同時実行数の上限を超えない
+    slices = start.plan_ocr_slices(list(range(1, 101)))
+    assert len(slices) == 4
+    assert sum(slices, []) == list(range(1, 101))
+
+
+def test_map_slice_pages_restores_original_page_numbers(handlers):
+    _, handle = handlers
+    manifest = {"slices": [[2, 5], [7, 8, 9]]}
+    run_id, index = handle.parse_slice_key(f"ocr-pages/{CONTENT_HASH}/run-1/1.pdf")
+    assert (run_id, index) == ("run-1", 1)
+    text = "七\n八\n九\n"
+    offsets = [{"page": p, "offset": o} for p, o in ((1, 0), (2, 2), (3, 4))]
+    assert handle.map_slice_pages(manifest, index, text, offsets) == [
+        (7, "七\n"),
+        (8, "八\n"),
+        (9, "九\n"),
+    ]
+
+
+def test_fan_in_merges_once_per_run(handlers):
+    start, handle = handlers
+    start.reset_slice_fan_in(CONTENT_HASH, "run-1", 2)
+
+    def gather(run_id, index):
+        pages = [(index * 10 + 1, f"page {index}")]
+        return handle.gather_ocr_slices(BUCKET, CONTENT_HASH, run_id, index, pages, 2)
+
+    assert gather("run-1", 1) is None
+    # 別の実行の通知は数えない
+    assert gather("old-run", 0) is None
+    assert gather("run-1", 0) == [(1, "page 0"), (11, "page 1")]
+    # 揃った後に重複して届いた通知では、もう一度結合しない
+    assert gather("run-1", 1) is None
+    assert gather("run-1", 0) is None
+    # 結合後の生成が失敗した場合は、再配信された通知でもう一度結合する
+    handle.reopen_ocr_slices(CONTENT_HASH, "run-1")
+    assert gather("run-1", 1) == [(1, "page 0"), (11, "page 1")]
+    assert gather("run-1", 1) is None
+
+    # 同じ内容のPDFを再び処理する実行は、記録を作り直して最初から集める
+    start.reset_slice_fan_in(CONTENT_HASH, "run-2", 2)
+    assert gather("run-2", 0) is None
+    assert gather("run-2", 1) == [(1, "page 0"), (11, "page 1")]
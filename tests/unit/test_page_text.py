@@ -0,0 +1,15 @@
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.page_text import join_pages, split_pages  # noqa: E402
+
+
+def test_join_and_split_pages_round_trip():
+    text, page_offsets = join_pages([(1, "a\n\nb"), (2, "  \n"), (3, "c")])
+    assert text == "a\nb\nc\n"
+    assert page_offsets == [{"page": 1, "offset": 0}, {"page": 3, "offset": 4}]
+    assert split_pages(text, page_offsets) == [(1, "a\nb\n"), (3, "c\n")]
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.paging import (  # noqa: E402
+    decode_next_token,
+    encode_next_token,
+    parse_limit,
+)
+
+
+def test_next_token_round_trip_and_partition_binding():
+    key = {"qa_set_id": "set-1", "submission_id": "s-9"}
+    token = encode_next_token(key)
+    assert encode_next_token(None) is None
+    assert decode_next_token(token) == key
+    assert decode_next_token(token, partition="set-1") == key
+    # 別のQAセットのトークンや、キーを含まないトークンは受け付けない
+    for bad in (token, encode_next_token({"id": 1}), "%%%"):
+        with pytest.raises(ValueError):
+            decode_next_token(bad, partition="set-2")
+
+
+def test_parse_limit():
+    assert parse_limit(None, 20, 100) == 20
+    assert parse_limit("500", 20, 100) == 100
+    for value in ("0", "abc"):
+        with pytest.raises(ValueError):
+            parse_limit(value, 20, 100)
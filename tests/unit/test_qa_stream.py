@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.qa_stream import QaSetStreamParser, stream_model_text  # noqa: E402
+
+
+def _question(n, text=None):
+    return {
+        "question": text or f"質問{n}",
+        "type": "一択選択式",
+        "correct_answer": "A",
+    }
+
+
+TRICKY = _question(1, 'ブロック "{[ ]}" と \\ を含む \\"質問\\"')
+QA_TEXT = json.dumps(
+    {"qa_set": [TRICKY, _question(2), _question(3)]}, ensure_ascii=False
+)
+
+
+def test_parser_handles_any_fragment_boundary():
+    # 文字列内の括弧やエスケープの途中で断片が切れても同じ結果になること
+    for size in (1, 2, 3, 7, len(QA_TEXT)):
+        parser = QaSetStreamParser()
+        questions = []
+        for start in range(0, len(QA_TEXT), size):
+            questions += parser.feed(QA_TEXT[start : start + size])
+        assert questions == [TRICKY, _question(2), _question(3)]
+        assert parser.text == QA_TEXT
+
+
+def test_parser_skips_truncated_and_invalid_objects():
+    parser = QaSetStreamParser()
+    text = '{"qa_set": [{"note": "x"}, ' + json.dumps(_question(1)) + ', {"question"'
+    assert parser.feed(text) == [_question(1)]
+
+
+class FakeStream:
+    def __init__(self, fragments):
+        self.events = [
+            {
+                "chunk": {
+                    "bytes": json.dumps(
+                        {"contentBlockDelta": {"delta": {"text": fragment}}}
+                    ).encode()
+                }
+            }
+            for fragment in fragments
+        ]
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for event in self.events:
+            self.consumed += 1
+            yield event
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBedrockRuntime:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def invoke_model_with_response_stream(self, body, modelId):
+        return {"body": self.stream}
+
+
+def test_stream_stops_at_num_questions_and_closes():
+    fragments = [QA_TEXT[i : i + 5] for i in range(0, len(QA_TEXT), 5)]
+    stream = FakeStream(fragments)
+    received = []
+    text = stream_model_text(
+        FakeBedrockRuntime(stream), "model", {}, 2, on_question=received.append
+    )
+    assert received == [TRICKY, _question(2)]
+    assert stream.consumed < len(fragments)
+    assert stream.closed
+    assert text == "".join(fragments[: stream.consumed])
+
+
+def test_stream_returns_full_text_and_closes_when_short():
+    stream = FakeStream([QA_TEXT])
+    text = stream_model_text(FakeBedrockRuntime(stream), "model", {}, 5)
+    assert text == QA_TEXT
+    assert stream.closed
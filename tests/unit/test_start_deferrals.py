@@ -0,0 +1,59 @@
+import importlib.util
+import json
+import os
+import sys
+
+HANDLER_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "lambda_start_pdf_processing"
+)
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ["METRICS_ENABLED"] = "false"
+
+# 他のLambdaのmain.pyと名前が衝突しないよう、ファイルから別名で読み込む
+_spec = importlib.util.spec_from_file_location(
+    "start_pdf_deferrals", os.path.join(HANDLER_DIR, "main.py")
+)
+start = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(start)
+
+
+class FakeSqs:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.sent.append((QueueUrl, kwargs))
+
+
+def sqs_record(deferrals):
+    body = {"Records": [{"s3": {"bucket": {"name": "b"}, "object": {"key": "k"}}}]}
+    record = {"messageId": "m1", "body": json.dumps(body), "messageAttributes": {}}
+    if deferrals:
+        record["messageAttributes"]["Deferrals"] = {"stringValue": str(deferrals)}
+    return record
+
+
+def test_capacity_deferrals_are_capped(monkeypatch):
+    sqs = FakeSqs()
+    failed = []
+    monkeypatch.setattr(start, "sqs_client", sqs)
+    monkeypatch.setattr(start, "INTAKE_QUEUE_URL", "intake")
+    monkeypatch.setattr(start, "INTAKE_DLQ_URL", "dlq")
+    monkeypatch.setattr(start, "MAX_CAPACITY_DEFERRALS", 3)
+    monkeypatch.setattr(
+        start, "track_job", lambda key, state, *a, **k: failed.append((key, state))
+    )
+
+    assert start.defer_message(sqs_record(2))
+    assert sqs.sent[-1][0] == "intake"
+    assert sqs.sent[-1][1]["MessageAttributes"]["Deferrals"]["StringValue"] == "3"
+    assert not failed
+
+    # 上限に達したらジョブを失敗にし、入れ直さずにデッドレターキューへ送る
+    assert start.defer_message(sqs_record(3))
+    assert sqs.sent[-1][0] == "dlq"
+    assert failed == [("k", start.FAILED)]
@@ -0,0 +1,145 @@
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+HANDLER_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "lambda_submit_answer"
+)
+sys.path.insert(0, HANDLER_DIR)
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("TABLE_NAME", "QaTable")
+os.environ.setdefault("SUBMISSIONS_TABLE_NAME", "SubmissionsTable")
+os.environ["METRICS_ENABLED"] = "false"
+
+# 他のLambdaのmain.pyと名前が衝突しないよう、ファイルから別名で読み込む
+_spec = importlib.util.spec_from_file_location(
+    "submit_answer_main", os.path.join(HANDLER_DIR, "main.py")
+)
+submit = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(submit)
+
+ANSWER_KEY = submit.compile_answer_key(
+    [
+        {"question_id": "q1", "type": "一択選択式", "correct_answer": "A"},
+        {
+            "question_id": "q2",
+            "type": "記述式",
+            "scoring_keywords": ["サーバーレス", "関数"],
+        },
+    ],
+    1,
+)
+
+
+def batch_event(sheets):
+    return {"pathParameters": {"id": "set-1"}, "body": json.dumps({"sheets": sheets})}
+
+
+def test_batch_handler_rejects_malformed_sheets(monkeypatch):
+    monkeypatch.setattr(
+        submit, "get_answer_key", lambda *a, **k: pytest.fail("採点キーを読んだ")
+    )
+    for sheets in (
+        [{"answers": []}, "A"],
+        [{"answers": "A"}],
+        [{"answers": [{"answer": "A"}, "B"]}],
+    ):
+        response = submit.batch_handler(batch_event(sheets), None)
+        assert response["statusCode"] == 400
+
+
+def test_batch_handler_grades_and_summarizes(monkeypatch):
+    monkeypatch.setattr(submit, "get_answer_key", lambda *a, **k: ANSWER_KEY)
+    monkeypatch.setattr(submit, "save_submissions_batch", lambda *a: set())
+    sheets = [
+        {
+            "learner_id": 7,
+            "answers": [{"answer": "Ａ"}, {"answer": "サーバーレスな関数"}],
+        },
+        {"answers": [{"answer": "B"}]},
+    ]
+    response = submit.batch_handler(batch_event(sheets), None)
+    assert response["statusCode"] == 200
+    body = json.loads(response["body"])
+    assert [r["score"] for r in body["results"]] == [100, 0]
+    assert body["results"][0]["learner_id"] == "7"
+    assert all(r["saved"] for r in body["results"])
+    assert body["summary"]["questions"][0]["correct_rate"] == 50
+
+
+def test_summarize_scores():
+    score_data_list = [
+        submit.grade_answers(ANSWER_KEY, answers)
+        for answers in (
+            [{"answer": "A"}, {"answer": "サーバーレス"}],
+            [{"answer": "A"}, {"is_flagged": True}],
+            [],
+        )
+    ]
+    summary = submit.summarize_scores(ANSWER_KEY, score_data_list)
+    assert summary["sheet_count"] == 3
+    assert summary["median_score"] == 50
+    assert summary["min_score"] == 0
+    assert [q["correct_count"] for q in summary["questions"]] == [2, 0]
+    assert [q["flagged_count"] for q in summary["questions"]] == [0, 1]
+
+
+class FlakyDynamoClient:
+    """指定した回数だけ先頭の1件を未処理として返すBatchWriteItem"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = []
+
+    def batch_write_item(self, RequestItems):
+        self.calls.append(RequestItems)
+        requests = RequestItems[submit.SUBMISSIONS_TABLE_NAME]
+        if len(self.calls) > self.failures:
+            return {"UnprocessedItems": {}}
+        return {"UnprocessedItems": {submit.SUBMISSIONS_TABLE_NAME: requests[:1]}}
+
+
+def test_write_submission_chunk_retries_unprocessed_items(monkeypatch):
+    monkeypatch.setattr(submit.random, "uniform", lambda a, b: 0)
+    items = [{"submission_id": f"s{i}", "score": i} for i in range(3)]
+
+    client = FlakyDynamoClient(failures=2)
+    monkeypatch.setattr(submit, "dynamodb_client", client)
+    assert submit.write_submission_chunk(items) == set()
+    assert [len(c[submit.SUBMISSIONS_TABLE_NAME]) for c in client.calls] == [3, 1, 1]
+
+    # 再送の上限を超えた分は保存できなかった提出IDとして返す
+    client = FlakyDynamoClient(failures=submit.BATCH_WRITE_MAX_ATTEMPTS)
+    monkeypatch.setattr(submit, "dynamodb_client", client)
+    assert submit.write_submission_chunk(items) == {"s0"}
+    assert len(client.calls) == submit.BATCH_WRITE_MAX_ATTEMPTS
+
+
+def test_failed_chunk_is_reported_as_unsaved(monkeypatch):
+    def write(items):
+        if items[0]["submission_id"] == "s25":
+            raise RuntimeError("boom")
+        return set()
+
+    monkeypatch.setattr(submit, "write_submission_chunk", write)
+    score_data_list = [{"submission_id": f"s{i}"} for i in range(60)]
+    unsaved = submit.save_submissions_batch("set-1", score_data_list)
+    assert unsaved == {f"s{i}" for i in range(25, 50)}
+
+
+def test_large_batch_response_omits_question_results(monkeypatch):
+    monkeypatch.setattr(submit, "get_answer_key", lambda *a, **k: ANSWER_KEY)
+    monkeypatch.setattr(submit, "save_submissions_batch", lambda *a: set())
+    monkeypatch.setattr(submit, "MAX_RESPONSE_BYTES", 2000)
+    sheets = [{"answers": [{"answer": "A"}]} for _ in range(10)]
+    body = json.loads(submit.batch_handler(batch_event(sheets), None)["body"])
+    assert body["question_results_omitted"]
+    assert all("results" not in r for r in body["results"])
+    assert len(body["results"]) == 10 and body["summary"]["sheet_count"] == 10
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda_common", "python")
+)
+
+from qa_common.textract_slots import LEASE_PREFIX, TextractSlots  # noqa: E402
+
+TABLE_NAME = "PipelineState"
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        boto3.client("dynamodb").create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield TextractSlots(TABLE_NAME, max_in_flight=3)
+
+
+def test_acquire_respects_limit_and_release_is_idempotent(slots):
+    assert slots.acquire("a", slots=2)
+    assert not slots.acquire("b", slots=2)
+    # 同じ文書は実行中の間は二重に確保できない
+    assert not slots.acquire("a")
+    assert slots.acquire("b")
+    assert slots.in_flight() == 3
+
+    assert slots.release("a", "0")
+    assert not slots.release("a", "0")
+    assert slots.in_flight() == 2
+    assert slots.release("a", "1")
+    # 全てのpartを返却したらリースが消え、同じ文書を再び処理できる
+    assert slots.acquire("a")
+    assert slots.in_flight() == 2
+
+
+def test_reconcile_returns_slots_of_lost_and_expired_leases(slots):
+    assert slots.acquire("lost", slots=2)
+    assert slots.acquire("expired")
+    assert not slots.acquire("new")
+    assert slots.release("lost", "0")
+
+    # 完了通知が届かないままTTLで消えたリースと、期限切れのリース
+    table = boto3.resource("dynamodb").Table(TABLE_NAME)
+    table.delete_item(Key={"pk": LEASE_PREFIX + "lost"})
+    table.update_item(
+        Key={"pk": LEASE_PREFIX + "expired"},
+        UpdateExpression="SET expires_at = :past",
+        ExpressionAttributeValues={":past": int(time.time()) - 1},
+    )
+    assert slots.reconcile() == 2
+    assert slots.in_flight() == 0
+    assert slots.acquire("expired")
+    assert slots.reconcile() == 0
+
+    # 照合した後に届いた古い通知では減算しない
+    assert not slots.release("lost", "1")
+    assert slots.in_flight() == 1
+
+
+def test_release_ignores_notifications_of_another_run(slots):
+    assert slots.acquire("doc", {"run_id": "run-2"}, slots=1)
+    assert not slots.release("doc", "0", "run-1")
+    assert slots.in_flight() == 1
+    assert slots.release("doc", "0", "run-2")
+    assert slots.in_flight() == 0